@@ -0,0 +1,422 @@
+# bench.py
+# coding: utf-8
+"""Микробенчмарки горячих путей бота.
+
+Запуск из корня проекта: python bench.py
+"""
+import os
+import json
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import requests
+
+import migrations
+from db import DBManager
+from callbacks import CallbackCodec
+import render
+from sessions import MessageSessions
+from transport import TelegramTransport
+from carts import CartStore
+from idempotency import IdempotencyStore
+
+
+def timeit(func, repeat=200):
+    """Среднее время вызова func в миллисекундах."""
+    func()  # прогрев
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def make_db(tmpdir, items=500):
+    """Создаёт временную БД с одной категорией на items товаров."""
+    db = DBManager(os.path.join(tmpdir, 'bench.db'))
+    with sqlite3.connect(db.db_path) as conn:
+        cat_id = conn.execute("INSERT INTO categories (name) VALUES ('Кофе')").lastrowid
+        conn.executemany(
+            "INSERT INTO stock (category_id, name, size, has_size, price, quantity) VALUES (?, ?, ?, ?, ?, ?)",
+            [(cat_id, f"Напиток {i}", "0.3", 1, 100 + i, 50) for i in range(items)]
+        )
+    db.add_user('1', 'Бенч')
+    for stock_id in range(1, 31):
+        db.add_to_cart('1', stock_id, 1)
+    return db
+
+
+def bench_stock_rows(db):
+    dict_ms = timeit(lambda: db.get_stock_by_category('Кофе'))
+    rows_ms = timeit(lambda: db.get_stock_rows_by_category('Кофе'))
+    print(f"stock_by_category: dict {dict_ms:.3f} ms, StockRow {rows_ms:.3f} ms ({dict_ms / rows_ms:.1f}x)")
+
+
+def bench_cart_rows(db):
+    dict_ms = timeit(lambda: db.get_cart('1'))
+    rows_ms = timeit(lambda: db.get_cart_rows('1'))
+    print(f"cart: dict {dict_ms:.3f} ms, CartRow {rows_ms:.3f} ms ({dict_ms / rows_ms:.1f}x)")
+
+
+def bench_search(tmpdir, items=100_000):
+    """Поиск по FTS5-индексу на items товаров со случайными названиями."""
+    rnd = random.Random(42)
+    syllables = [
+        "ла", "те", "ка", "пу", "чи", "но", "раф", "мо", "ко", "ва", "ни", "ль", "ме", "ро",
+        "си", "бер", "гус", "ён", "дра", "зе", "ми", "ша", "фи", "хо", "ту", "ны", "жу", "пле",
+        "стр", "ак", "ор", "ус", "ем", "ир", "ол", "ба", "де", "го", "ры", "цы",
+    ]
+    word = lambda: "".join(rnd.choice(syllables) for _ in range(rnd.randint(2, 4)))
+    names = [f"{word()} {word()}".capitalize() for _ in range(items)]
+    
+    db = DBManager(os.path.join(tmpdir, 'search.db'))
+    with sqlite3.connect(db.db_path) as conn:
+        cat_ids = [conn.execute("INSERT INTO categories (name) VALUES (?)", (f"Категория {i}",)).lastrowid
+                   for i in range(50)]
+        conn.executemany(
+            "INSERT INTO stock (category_id, name, size, has_size, price, quantity) VALUES (?, ?, ?, ?, ?, ?)",
+            [(cat_ids[i % len(cat_ids)], name, None, 0, 100, 10) for i, name in enumerate(names)]
+        )
+    
+    queries = [names[i].lower()[:rnd.randint(4, 8)] for i in rnd.sample(range(items), 200)]
+    ms = timeit(lambda: [db.search_stock(q) for q in queries], repeat=5) / len(queries)
+    print(f"search @ {items} SKU: {ms:.3f} ms/запрос (префиксы названий)")
+
+def bench_startup(db):
+    """Старт на актуальной схеме: прежний executescript(models.sql) против PRAGMA user_version."""
+    def executescript_boot():
+        with sqlite3.connect(db.db_path) as conn:
+            with open(migrations.MODELS_SQL, 'r', encoding='utf-8') as f:
+                conn.executescript(f.read())
+    
+    script_ms = timeit(executescript_boot, repeat=50)
+    migrate_ms = timeit(lambda: migrations.migrate(db.db_path), repeat=50)
+    print(f"startup schema check: executescript {script_ms:.3f} ms, user_version {migrate_ms:.3f} ms")
+
+
+def bench_callbacks():
+    """Разбор callback_data: split("|") против CallbackCodec (с проверкой MAC)."""
+    codec = CallbackCodec("bench-secret")
+    codec.register(1, "add", stock_id=int, qty=int)
+    codec.register(3, "ready", tg=int, order_id=int)
+    
+    def split_parse(data):
+        parts = data.split("|")
+        return parts[0], [int(p) for p in parts[1:]]
+    
+    for name, args in (("add", (123456, 2)), ("ready", (-1001234567890, 987654))):
+        legacy = "|".join([name, *map(str, args)])
+        packed = codec.encode(name, *args)
+        split_us = timeit(lambda: split_parse(legacy), repeat=100_000) * 1000
+        codec_us = timeit(lambda: codec.decode(packed), repeat=100_000) * 1000
+        print(f"callback {name}: split {split_us:.2f} us ({len(legacy)} B), "
+              f"codec {codec_us:.2f} us ({len(packed)} B)")
+
+
+def bench_render(items=100):
+    """Корзина + подтверждение + сообщение админу: f-строки на каждый текст против render."""
+    from db import CartRow
+    rows = [CartRow(i, i, f"Напиток {i}", "0.3", 100 + i, 1 + i % 3) for i in range(items)]
+    
+    def fstring_checkout():
+        def fmt(rows):
+            lines = []
+            for r in rows:
+                sz = f" {r.size}л" if r.size else ""
+                lines.append(f"• {r.name}{sz} x{r.qty} — {r.price}₽")
+            return "\n".join(lines)
+        cart = f"🛒 <b>Твоя корзина:</b>\n{fmt(rows)}\n\n💰 Итого: 1000₽\n"
+        placed = f"✅ <b>Заказ №1 оформлен!</b>\n{fmt(rows)}\n💳 К оплате: 1000₽\n"
+        admin = f"📦 <b>Новый заказ №1</b>\n👤 Бенч (ID: 1)\n📋 {fmt(rows)}\n💰 <b>К оплате: 1000₽</b>\n"
+        return cart, placed, admin
+    
+    def render_checkout():
+        cart = render.cart_text(lines=render.cart_lines(rows), total=1000, disc=0, final=1000, points=0, remaining=0)
+        lines = render.cart_lines(rows)
+        placed = render.order_placed_text(oid=1, lines=lines, final=1000, earned=0)
+        admin = render.admin_order_text(oid=1, name="Бенч", tg="1", lines=lines, final=1000, disc=0, time="12:00:00")
+        return cart, placed, admin
+    
+    old_us = timeit(fstring_checkout, repeat=5000) * 1000
+    new_us = timeit(render_checkout, repeat=5000) * 1000
+    print(f"render {items} позиций: f-строки {old_us:.1f} us, render {new_us:.1f} us ({old_us / new_us:.1f}x)")
+
+
+def bench_cart_store(db, adds=300):
+    """Нажатие «Добавить»: ключ callback + корзина. SQLite на всё против памяти + flush."""
+    items = [db.get_stock_row(stock_id) for stock_id in range(1, 101)]
+    processed = IdempotencyStore(db)
+    presses = iter(range(10 ** 9))  # Каждое нажатие — новый id callback
+    
+    def direct():
+        db.clear_cart('1')
+        for i in range(adds):
+            processed.run(
+                f"cb:{next(presses)}", lambda: db.add_to_cart('1', items[i % len(items)].id, 1), keep=lambda r: True
+            )
+    
+    carts = CartStore(db)
+    
+    def in_memory():
+        carts.clear('1')
+        for i in range(adds):
+            processed.run(
+                f"cb:{next(presses)}", lambda: carts.add('1', items[i % len(items)], 1),
+                keep=lambda r: True, durable=False
+            )
+        carts.flush()
+    
+    db_ms = timeit(direct, repeat=5) / adds
+    mem_ms = timeit(in_memory, repeat=5) / adds
+    print(f"add_to_cart: SQLite {db_ms:.3f} ms, память {mem_ms:.3f} ms с учётом flush ({db_ms / mem_ms:.1f}x)")
+
+
+def bench_bulk_adjust(tmpdir, items=100_000):
+    """+10% к цене всех товаров: транзакция на товар против одного bulk_adjust."""
+    db = DBManager(os.path.join(tmpdir, 'adjust.db'))
+    with sqlite3.connect(db.db_path) as conn:
+        cat_id = conn.execute("INSERT INTO categories (name) VALUES ('Кофе')").lastrowid
+        conn.executemany(
+            "INSERT INTO stock (category_id, name, price, quantity) VALUES (?, ?, ?, ?)",
+            [(cat_id, f"Напиток {i}", 100 + i % 500, 50) for i in range(items)]
+        )
+    
+    def per_item(limit=2000):
+        # Как правка товаров по одному: чтение, UPDATE и строка аудита в своей транзакции
+        for stock_id in range(1, limit + 1):
+            with db.get_connection() as conn:
+                old = conn.execute("SELECT price FROM stock WHERE id = ?", (stock_id,)).fetchone()[0]
+                new = max(1, round(old * 1.1))
+                conn.execute("UPDATE stock SET price = ? WHERE id = ?", (new, stock_id))
+                conn.execute(
+                    "INSERT INTO audit_log (action, details) VALUES ('price_adjust', ?)",
+                    (json.dumps({'stock_id': stock_id, 'old': old, 'new': new}),)
+                )
+        return limit
+    
+    start = time.perf_counter()
+    done = per_item()
+    item_s = (time.perf_counter() - start) / done * items
+    start = time.perf_counter()
+    r = db.bulk_adjust('price', 'percent', 10, category_id=cat_id)
+    bulk_s = time.perf_counter() - start
+    print(
+        f"bulk_adjust {items} товаров: по одному ~{item_s:.1f} s (оценка по {done}), "
+        f"одним UPDATE {bulk_s:.2f} s, изменено {r.changed} ({item_s / bulk_s:.0f}x)"
+    )
+
+
+def bench_query_audit(tmpdir, rows=500_000):
+    """Поиск в журнале по order_id: скан с json.loads против query_audit по индексу."""
+    db = DBManager(os.path.join(tmpdir, 'audit.db'))
+    for t in threading.enumerate():
+        if t.name == "migrations":
+            t.join()  # Индексы журнала — online-миграция
+    with sqlite3.connect(db.db_path) as conn:
+        conn.executemany(
+            "INSERT INTO audit_log (action, details) VALUES (?, ?)",
+            (
+                ('order_created', json.dumps({'order_id': i, 'total': 100 + i % 900})) if i % 2 else
+                ('user_created', json.dumps({'name': 'Бенч', 'referrer': i % 1000}))
+                for i in range(rows)
+            )
+        )
+    targets = random.Random(7).sample(range(1, rows, 2), 20)
+    
+    def scan():
+        with db.get_connection() as conn:
+            cur = conn.execute("SELECT id, action, details FROM audit_log ORDER BY id DESC")
+            return [r['id'] for r in cur if json.loads(r['details']).get('order_id') == targets[0]]
+    
+    scan_ms = timeit(scan, repeat=2)
+    query_ms = timeit(lambda: [db.query_audit({'order_id': t}) for t in targets], repeat=20) / len(targets)
+    print(f"audit_log {rows} строк, поиск заказа: json.loads {scan_ms:.0f} ms, query_audit {query_ms:.3f} ms")
+
+
+def bench_recommendations(tmpdir, orders=50_000, items=300):
+    """«Часто берут вместе»: self-join order_items на запрос против топа из item_pairs."""
+    db = DBManager(os.path.join(tmpdir, 'pairs.db'))
+    rnd = random.Random(11)
+    with sqlite3.connect(db.db_path) as conn:
+        cat_id = conn.execute("INSERT INTO categories (name) VALUES ('Кофе')").lastrowid
+        conn.executemany(
+            "INSERT INTO stock (category_id, name, price, quantity) VALUES (?, ?, 100, 50)",
+            [(cat_id, f"Напиток {i}") for i in range(items)]
+        )
+        user_id = conn.execute("INSERT INTO users (telegram_id, name) VALUES ('1', 'Бенч')").lastrowid
+        conn.executemany(
+            "INSERT INTO orders (id, user_id, total, status, completed_at) VALUES (?, ?, 100, 'completed', '2026-01-01')",
+            [(i, user_id) for i in range(1, orders + 1)]
+        )
+        conn.executemany(
+            "INSERT INTO order_items (order_id, stock_id, name, price, qty) VALUES (?, ?, 'x', 100, 1)",
+            [
+                (i, stock_id) for i in range(1, orders + 1)
+                for stock_id in rnd.sample(range(1, items + 1), rnd.randint(1, 4))
+            ]
+        )
+    start = time.perf_counter()
+    db.rebuild_item_pairs(pause=0)
+    rebuild_s = time.perf_counter() - start
+    
+    def self_join(stock_id=1):
+        with db.get_connection() as conn:
+            return conn.execute(
+                "SELECT b.stock_id, COUNT(*) AS n FROM order_items a "
+                "JOIN order_items b ON b.order_id = a.order_id AND b.stock_id != a.stock_id "
+                "WHERE a.stock_id = ? GROUP BY b.stock_id ORDER BY n DESC LIMIT 3",
+                (stock_id,)
+            ).fetchall()
+    
+    join_ms = timeit(self_join, repeat=5)
+    top_ms = timeit(lambda: db.get_recommendations(1), repeat=2000)
+    print(
+        f"рекомендации, {orders} заказов: self-join {join_ms:.1f} ms, item_pairs {top_ms:.3f} ms "
+        f"({join_ms / top_ms:.0f}x), полный пересчёт {rebuild_s:.2f} s"
+    )
+
+
+class FakeAPI:
+    """Подмена Telegram Bot API: только считает вызовы по методам."""
+    
+    def __init__(self):
+        self.calls = Counter()
+        self.next_id = 0
+    
+    def send_message(self, chat_id, text, reply_markup=None):
+        self.calls['send_message'] += 1
+        self.next_id += 1
+        return type('Message', (), {'message_id': self.next_id})
+    
+    def __getattr__(self, method):
+        return lambda *args, **kwargs: self.calls.update((method,))
+
+
+def bench_message_sessions(adds=5, pause=0.02, window=0.2):
+    """Вызовы API на сценарий «категория → adds быстрых нажатий → корзина → заказ».
+    
+    Раньше: новое сообщение на каждое добавление и на чек. Теперь: правка
+    страницы на месте через MessageSessions со склейкой правок.
+    """
+    old = FakeAPI()
+    old.send_message(1, "категория")
+    for _ in range(adds):
+        old.answer_callback_query("cb")
+        old.send_message(1, "добавлено")
+    old.send_message(1, "корзина")
+    old.answer_callback_query("cb")
+    old.edit_message_reply_markup(1, 2)
+    old.send_message(1, "чек")
+    old.send_message(-1, "заказ админу")
+    
+    new = FakeAPI()
+    sessions = MessageSessions(lambda *args: new.edit_message_text(*args), window=window)
+    sessions.track(1, new.send_message(1, "категория"), "категория")
+    for i in range(adds):
+        new.answer_callback_query("cb")
+        sessions.edit(1, 1, f"категория, в корзине {i + 1}")
+        time.sleep(pause)
+    time.sleep(window * 2)  # Пользователь смотрит на страницу
+    new.answer_callback_query("cb")
+    sessions.edit(1, 1, "корзина")
+    time.sleep(window * 2)
+    new.answer_callback_query("cb")
+    sessions.edit(1, 1, "чек")
+    new.send_message(-1, "заказ админу")
+    time.sleep(window * 2)
+    
+    for name, api in (("до", old), ("после", new)):
+        print(f"message sessions {name}: {sum(api.calls.values())} вызовов API, "
+              f"{api.calls['send_message']} новых сообщений ({dict(api.calls)})")
+
+
+class StandInAPI(BaseHTTPRequestHandler):
+    """Локальная замена api.telegram.org: отвечает через latency секунд.
+    
+    Запоминает порядок текстов по чатам и число открытых соединений.
+    """
+    protocol_version = "HTTP/1.1"  # keep-alive
+    disable_nagle_algorithm = True
+    latency = 0.03
+    received = defaultdict(list)
+    connections = 0
+    
+    def setup(self):
+        super().setup()
+        type(self).connections += 1
+    
+    def do_POST(self):
+        query = parse_qs(urlsplit(self.path).query)
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        time.sleep(self.latency)
+        chat_id = query['chat_id'][0]
+        self.received[chat_id].append(query['text'][0])
+        message = {"message_id": len(self.received[chat_id]), "date": int(time.time()),
+                   "chat": {"id": int(chat_id), "type": "private"}}
+        body = json.dumps({"ok": True, "result": message}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, *args):
+        pass
+
+
+def bench_transport(messages=200, chats=20, latency=0.03):
+    """sendMessage по одному (как apihelper) против TelegramTransport.submit на stand-in сервере."""
+    StandInAPI.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/bot0:bench/sendMessage"
+    batch = [{'chat_id': i % chats, 'text': str(i)} for i in range(messages)]
+    
+    def run(send):
+        StandInAPI.received.clear()
+        StandInAPI.connections = 0
+        start = time.perf_counter()
+        send()
+        elapsed = time.perf_counter() - start
+        ordered = all(texts == sorted(texts, key=int) for texts in StandInAPI.received.values())
+        return elapsed, StandInAPI.connections, ordered
+    
+    def blocking():
+        session = requests.Session()
+        for params in batch:
+            session.request('post', url, params=params, timeout=5)
+    
+    transport = TelegramTransport(max_in_flight=8)
+    
+    def pooled():
+        futures = [transport.submit(p['chat_id'], transport.request, 'post', url, params=p, timeout=5) for p in batch]
+        for f in futures:
+            f.result()
+    
+    for name, send in (("по одному", blocking), ("transport", pooled)):
+        elapsed, conns, ordered = run(send)
+        print(f"transport {name}: {messages} сообщений в {chats} чатов за {elapsed:.2f}s "
+              f"({messages / elapsed:.0f}/s), соединений {conns}, порядок в чатах {'ok' if ordered else 'НАРУШЕН'}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = make_db(tmpdir)
+        bench_stock_rows(db)
+        bench_cart_rows(db)
+        bench_startup(db)
+        bench_cart_store(db)
+        bench_search(tmpdir)
+        bench_bulk_adjust(tmpdir)
+        bench_query_audit(tmpdir)
+        bench_recommendations(tmpdir)
+    bench_callbacks()
+    bench_render()
+    bench_message_sessions()
+    bench_transport()
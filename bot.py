@@ -1,18 +1,52 @@
 # bot.py
 # coding: utf-8
 import os
+import atexit
+import hashlib
+import html
 import time
 import io
 import csv
+import pickle
 import re
 import logging
+import tempfile
 import threading
+import contextvars
 from datetime import datetime
-from telebot import TeleBot, types, apihelper
+from collections import namedtuple
+from functools import wraps, partial
+from concurrent.futures import ThreadPoolExecutor
+from telebot import TeleBot, types
+from telebot.handler_backends import FileHandlerBackend
 
-from config import BOT_TOKEN, ADMIN_GROUP_ID, BONUS_PERCENT, MAX_DISCOUNT, REFERRAL_BONUS
-from db import DBManager
-from keyboards import main_keyboard, add_more_kb, admin_keyboard
+from config import (
+    BOT_TOKEN, ADMIN_GROUP_ID, BONUS_PERCENT, MAX_DISCOUNT, REFERRAL_BONUS,
+    BROADCAST_RATE, BROADCAST_WORKERS, POINTS_RECONCILE_INTERVAL,
+    ORDER_EXPIRE_HOURS, ORDER_EXPIRE_INTERVAL, DB_PATH, BACKUP_DIR, BACKUP_INTERVAL, BACKUP_KEEP,
+    ADMIN_WORKERS, ANALYTICS_SNAPSHOT_PATH, ANALYTICS_SNAPSHOT_INTERVAL, IDEMPOTENCY_TTL, EDIT_COALESCE,
+    API_MAX_IN_FLIGHT, API_MAX_RETRIES, CART_FLUSH_INTERVAL, CART_IDLE, SHOPS, TENANTS_DB, OWNER_CHAT_ID,
+    PROFILE_DIR, PROFILE_SECONDS, PROFILE_MAX_SECONDS, PROFILE_INTERVAL,
+    RECOMMEND_TOP, RECOMMEND_REBUILD_INTERVAL,
+    DRAIN_TIMEOUT, HANDOFF_TIMEOUT, POLL_TIMEOUT, NEXT_STEPS_PATH
+)
+from db import DBManager, AUDIT_FILTERS
+from carts import CartStore
+from broadcast import Broadcaster, TokenBucket
+import jobs
+import export
+import render
+from callbacks import CallbackCodec
+from idempotency import IdempotencyStore
+from sessions import MessageSessions
+from transport import TelegramTransport
+from profiler import Profiler, MODES as PROFILE_MODES
+from lifecycle import Lifecycle, InFlight
+from tenants import TenantRegistry, Tenant, Current, run_in, start_payload
+from keyboards import (
+    main_keyboard, add_more_kb, admin_keyboard, cursor_pagination_keyboard,
+    price_update_keyboard, stock_management_keyboard, reply_labels
+)
 
 # ===============================
 # ==== ЛОГИРОВАНИЕ ==============
@@ -25,8 +59,81 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-bot = TeleBot(BOT_TOKEN, parse_mode="HTML")
-db = DBManager()
+class RoutedTeleBot(TeleBot):
+    """TeleBot, выполняющий каждую задачу (обработчик, шаг диалога) в контексте точки обновления."""
+    
+    def _exec_task(self, task, *args, **kwargs):
+        inflight.enter()
+        super()._exec_task(run_routed, task, *args, **kwargs)
+
+def run_routed(task, *args, **kwargs):
+    # Маршрутизация — уже в потоке обработчика: привязка может читать tenants.db
+    try:
+        return run_in(shops.route(args[0]) if args else None, profiler.call, task, *args, **kwargs)
+    finally:
+        inflight.exit()
+
+inflight = InFlight()  # Начатые обработчики: остановка ждёт их завершения
+
+bot = RoutedTeleBot(BOT_TOKEN, parse_mode="HTML")
+transport = TelegramTransport(API_MAX_IN_FLIGHT, max_retries=API_MAX_RETRIES)
+transport.install()
+profiler = Profiler(PROFILE_DIR, interval=PROFILE_INTERVAL)
+
+# ===============================
+# ==== ТОЧКИ ====================
+# ===============================
+broadcast_bucket = TokenBucket(BROADCAST_RATE)  # Лимит Telegram — на бота, а не на точку
+transport.on_retry_after(broadcast_bucket.pause)  # 429 любого запроса тормозит всю рассылку
+
+def open_tenant(slug, shop):
+    """Файл БД точки и всё, что над ним: корзины, идемпотентность, рассылка."""
+    tdb = DBManager(shop['db_path'], snapshot_path=shop.get('snapshot_path'))
+    carts = CartStore(tdb, idle=CART_IDLE)
+    atexit.register(carts.flush)  # Остановка бота — последние изменения корзин в БД
+    return Tenant(
+        slug, shop.get('title', slug), str(shop['admin_group_id']), tdb, carts,
+        IdempotencyStore(tdb, ttl=IDEMPOTENCY_TTL),
+        Broadcaster(bot, tdb, shop['admin_group_id'], workers=BROADCAST_WORKERS, bucket=broadcast_bucket)
+    )
+
+shops = TenantRegistry(
+    SHOPS or {"main": {"db_path": DB_PATH, "admin_group_id": ADMIN_GROUP_ID, "snapshot_path": ANALYTICS_SNAPSHOT_PATH}},
+    open_tenant, TENANTS_DB
+)
+
+# Данные точки текущего обновления
+db = Current(shops, 'db')
+carts = Current(shops, 'carts')
+processed = Current(shops, 'processed')
+broadcaster = Current(shops, 'broadcaster')
+
+def admin_chat():
+    """Админская группа точки текущего обновления."""
+    return shops.get().admin_group_id
+
+# ===============================
+# ==== CALLBACK-ДАННЫЕ ==========
+# ===============================
+# ID действий зашиты в уже отправленные кнопки — только добавлять, не менять
+# legacy — действия, чьи кнопки "name|a|b" разосланы до появления подписанного формата
+callbacks = CallbackCodec(BOT_TOKEN, store=db, legacy=("add", "admin_view", "ready"))
+callbacks.register(1, "add", stock_id=int, qty=int)
+callbacks.register(2, "admin_view", cat_id=int)
+callbacks.register(3, "ready", tg=int, order_id=int)
+callbacks.register(4, "top_ref", invited=int, user_id=int, rank=int)
+callbacks.register(5, "top_pts", points=int, user_id=int, rank=int)
+callbacks.register(6, "my_refs", after_id=int)
+callbacks.register(7, "my_orders", after_id=int)
+callbacks.register(8, "adm_orders", created_at=str, order_id=int)
+callbacks.register(9, "bc_stop", broadcast_id=int)
+callbacks.register(10, "cancel_order", tg=int, order_id=int)
+callbacks.register(11, "export", table=str, fmt=str)
+callbacks.register(12, "audit", filters=str, created_at=str, log_id=int)
+
+@bot.callback_query_handler(func=callbacks.owns)
+def cb_dispatch(c):
+    callbacks.dispatch(c)
 
 # ===============================
 # ==== RATE LIMITING ============
@@ -70,7 +177,7 @@ def validate_quantity(qty):
 # ==== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===
 # ===============================
 def is_admin(chat_id):
-    return str(chat_id) == str(ADMIN_GROUP_ID)
+    return str(chat_id) == admin_chat()
 
 def admin_only(func):
     def wrapper(m):
@@ -81,10 +188,28 @@ def admin_only(func):
         return func(m)
     return wrapper
 
+# Админские экраны и отчёты — в отдельном пуле: тяжёлый запрос не занимает
+# потоки TeleBot, обслуживающие покупателей
+admin_pool = ThreadPoolExecutor(ADMIN_WORKERS, thread_name_prefix="admin")
+
+def in_admin_pool(func):
+    @wraps(func)
+    def wrapper(*args):
+        # Контекст (точка обновления) переходит в поток пула вместе с задачей
+        admin_pool.submit(
+            contextvars.copy_context().run, profiler.call, func, *args
+        ).add_done_callback(log_admin_error)
+    return wrapper
+
+def log_admin_error(future):
+    e = future.exception()
+    if e is not None:
+        logger.error(f"Ошибка админской задачи: {e}", exc_info=e)
+
 def safe_send_message(chat_id, text, **kwargs):
-    """Безопасная отправка сообщения с обработкой ошибок."""
+    """Безопасная отправка сообщения с обработкой ошибок. Возвращает Message или None."""
     try:
-        bot.send_message(chat_id, text, **kwargs)
+        return bot.send_message(chat_id, text, **kwargs)
     except Exception as e:
         logger.error(f"Ошибка отправки сообщения {chat_id}: {e}")
         try:
@@ -92,22 +217,85 @@ def safe_send_message(chat_id, text, **kwargs):
         except:
             pass
 
+def send_later(chat_id, text, **kwargs):
+    """safe_send_message в фоне: не ждёт ответа API, порядок сообщений в чате сохраняется."""
+    return transport.submit(chat_id, safe_send_message, chat_id, text, **kwargs)
+
+def edit_message(chat_id, message_id, text, reply_markup=None):
+    """Правка сообщения для MessageSessions: ошибка только логируется."""
+    try:
+        bot.edit_message_text(text, chat_id, message_id, reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"Ошибка правки сообщения {chat_id}/{message_id}: {e}")
+
+# Категории, поиск и корзина правятся на месте вместо новых сообщений
+sessions = MessageSessions(edit_message, window=EDIT_COALESCE)
+
+def send_page(chat_id, view, *args):
+    """Отправляет страницу view(*args) новым сообщением и делает его живым."""
+    text, kb = view(*args)
+    sessions.track(chat_id, safe_send_message(chat_id, text, reply_markup=kb), text, kb, partial(view, *args))
+    return text, kb
+
+def cart_button(kb, tg, shown=()):
+    """Кнопка корзины с числом позиций и суммой — обновляется вместе со страницей.
+    
+    Над ней — «часто берут вместе» с последним добавленным товаром, кроме
+    уже лежащих в корзине и показанных на странице (shown — их ID).
+    """
+    rows = carts.rows(tg)
+    if rows:
+        skip = set(shown) | {r.stock_id for r in rows}
+        picks = [it for it in db.get_recommendations(rows[-1].stock_id, RECOMMEND_TOP + len(skip))
+                 if it.id not in skip]
+        for it in picks[:RECOMMEND_TOP]:
+            kb.add(types.InlineKeyboardButton(
+                f"Добавить {item_title(it)} — часто берут вместе",
+                callback_data=callbacks.encode("add", it.id, 1)
+            ))
+        qty = sum(r.qty for r in rows)
+        total = sum(r.price * r.qty for r in rows)
+        kb.add(types.InlineKeyboardButton(f"🛒 Корзина: {qty} шт — {total}₽", callback_data="cart"))
+    return {r.stock_id: r.qty for r in rows}
+
 def calc_discount(total, points):
     """Рассчитывает скидку (не может быть больше MAX_DISCOUNT% от суммы)."""
     max_disc = int(total * MAX_DISCOUNT / 100)
     return min(points, max_disc)
 
-def format_cart_rows(rows):
-    """Форматирует строки корзины."""
-    lines = []
-    for r in rows:
-        sz = f" {r['size']}л" if r['size'] else ""
-        lines.append(f"• {r['name']}{sz} x{r['qty']} — {r['price']}₽")
-    return "\n".join(lines)
-
 # ===============================
 # ==== СТАРТ & РЕГИСТРАЦИЯ ======
 # ===============================
+def parse_referrer(tg, text):
+    """Реферальный код из "/start <код>" или None, если он невалиден."""
+    _, ref = start_payload(text)  # "/start <код>" или "/start <точка>-<код>"
+    if not ref or ref == tg or not ref.isdigit() or not db.get_user_profile(ref):
+        return None
+    return ref
+
+def welcome_back(tg):
+    """Приветствие зарегистрированного пользователя или None для нового."""
+    user = db.get_user_profile(tg)
+    if not user:
+        return None
+    logger.info(f"Повторный вход: {tg} ({user.name})")
+    return f"☕ <b>С возвращением, {user.name}</b>!", main_keyboard(db.get_categories())
+
+def register_user(tg, text, ref=None):
+    """Регистрирует пользователя по введённому имени.
+    
+    Возвращает (текст, клавиатура, готово); при невалидном имени готово=False
+    и имя нужно спросить ещё раз.
+    """
+    name, error = validate_name(text)
+    if error:
+        logger.warning(f"Невалидное имя от {tg}: {text}")
+        return f"❌ {error} Введи ещё раз.", None, False
+    
+    db.add_user(tg, name, ref)
+    logger.info(f"Пользователь зарегистрирован: {tg} ({name})")
+    return f"🎉 Добро пожаловать, <b>{name}</b>!", main_keyboard(db.get_categories()), True
+
 @bot.message_handler(commands=['start'])
 def cmd_start(msg):
     chat_id = msg.chat.id
@@ -118,23 +306,12 @@ def cmd_start(msg):
     
     try:
         tg = str(chat_id)
-        ref = None
+        ref = parse_referrer(tg, msg.text)
         
-        # Парсим реферальный код
-        if msg.text and msg.text.startswith("/start "):
-            ref = msg.text.split(" ", 1)[1].strip()
-            # Валидируем реферальный код
-            if ref == tg or not ref.isdigit() or not db.get_user(ref):
-                ref = None
-        
-        user = db.get_user(tg)
-        if user:
-            logger.info(f"Повторный вход: {tg} ({user['name']})")
-            safe_send_message(
-                chat_id,
-                f"☕ <b>С возвращением, {user['name']}</b>!",
-                reply_markup=main_keyboard(db.get_categories())
-            )
+        back = welcome_back(tg)
+        if back:
+            text, kb = back
+            safe_send_message(chat_id, text, reply_markup=kb)
             return
         
         logger.info(f"Новый пользователь: {tg}, реферер: {ref}")
@@ -150,22 +327,12 @@ def finish_registration(msg, ref=None):
     chat_id = msg.chat.id
     
     try:
-        name, error = validate_name(msg.text)
-        if error:
-            logger.warning(f"Невалидное имя от {chat_id}: {msg.text}")
-            m = bot.send_message(chat_id, f"❌ {error} Введи ещё раз.")
+        text, kb, done = register_user(str(chat_id), msg.text, ref)
+        if not done:
+            m = bot.send_message(chat_id, text)
             bot.register_next_step_handler(m, finish_registration, ref)
             return
-        
-        tg = str(chat_id)
-        db.add_user(tg, name, ref)
-        
-        logger.info(f"Пользователь зарегистрирован: {tg} ({name})")
-        safe_send_message(
-            chat_id,
-            f"🎉 Добро пожаловать, <b>{name}</b>!",
-            reply_markup=main_keyboard(db.get_categories())
-        )
+        safe_send_message(chat_id, text, reply_markup=kb)
     
     except Exception as e:
         logger.error(f"Ошибка регистрации {chat_id}: {e}", exc_info=True)
@@ -174,6 +341,33 @@ def finish_registration(msg, ref=None):
 # ===============================
 # ==== ПОКАЗ КАТЕГОРИЙ ==========
 # ===============================
+def category_view(cat_name, tg=None):
+    """Текст и кнопки категории (доступные товары); с tg — ещё и содержимое корзины."""
+    items = db.get_stock_rows_by_category(cat_name)
+    if not items:
+        logger.info(f"Пустая категория: {cat_name}")
+        return f"😅 В категории <b>{cat_name}</b> пока пусто.", None
+    
+    text = f"📂 <b>{cat_name}</b>\n\n"
+    kb = types.InlineKeyboardMarkup()
+    
+    for it in items:
+        if it.quantity > 0:  # Показываем только доступные товары
+            stock_id, name, price = it.id, it.name, it.price
+            sz = f" {it.size}л" if it.has_size else ""
+            text += f"• {name}{sz} — {price}₽ (Ост: {it.quantity} шт)\n"
+            kb.add(types.InlineKeyboardButton(
+                f"Добавить {name}{sz}",
+                callback_data=callbacks.encode("add", stock_id, 1)
+            ))
+    if tg is not None:
+        in_cart = cart_button(kb, tg, (it.id for it in items if it.quantity > 0))
+        if in_cart:
+            text += "\n🛒 В корзине: " + ", ".join(
+                f"{it.name} x{in_cart[it.id]}" for it in items if it.id in in_cart
+            )
+    return text, kb
+
 @bot.message_handler(func=lambda m: m.text and m.text in db.get_categories())
 def show_category(m):
     chat_id = m.chat.id
@@ -182,32 +376,8 @@ def show_category(m):
         return
     
     try:
-        cat_name = m.text
-        items = db.get_stock_by_category(cat_name)
-        
-        if not items:
-            logger.info(f"Пустая категория: {cat_name} от {chat_id}")
-            safe_send_message(
-                chat_id,
-                f"😅 В категории <b>{cat_name}</b> пока пусто."
-            )
-            return
-        
-        text = f"📂 <b>{cat_name}</b>\n\n"
-        kb = types.InlineKeyboardMarkup()
-        
-        for it in items:
-            if it["quantity"] > 0:  # Показываем только доступные товары
-                stock_id, name, price = it["id"], it["name"], it["price"]
-                sz = f" {it['size']}л" if it["has_size"] else ""
-                text += f"• {name}{sz} — {price}₽ (Ост: {it['quantity']} шт)\n"
-                kb.add(types.InlineKeyboardButton(
-                    f"Добавить {name}{sz}",
-                    callback_data=f"add|{stock_id}|1"
-                ))
-        
-        logger.info(f"Показана категория {cat_name} пользователю {chat_id}")
-        safe_send_message(chat_id, text, reply_markup=kb)
+        send_page(chat_id, category_view, m.text, str(chat_id))
+        logger.info(f"Показана категория {m.text} пользователю {chat_id}")
     
     except Exception as e:
         logger.error(f"Ошибка show_category {chat_id}: {e}", exc_info=True)
@@ -216,8 +386,57 @@ def show_category(m):
 # ===============================
 # ==== ДОБАВЛЕНИЕ В КОРЗИНУ =====
 # ===============================
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("add|"))
-def cb_add_to_cart(c):
+def add_to_cart_action(tg, stock_id, qty):
+    """Кладёт товар в корзину. Возвращает (ответ на нажатие, текст подтверждения или None)."""
+    qty, error = validate_quantity(qty)
+    if error:
+        return f"❌ {error}", None
+    
+    item = db.get_stock_row(stock_id)
+    if not item:
+        logger.warning(f"Товар не найден: {stock_id}")
+        return "❌ Товар не найден.", None
+    
+    if item.quantity < qty:
+        logger.info(f"Недостаточно товара: {stock_id}, запрос {qty}, остаток {item.quantity}")
+        return f"❌ Осталось только {item.quantity} шт.", None
+    
+    try:
+        carts.add(tg, item, qty)
+    except ValueError as e:
+        logger.warning(f"Ошибка добавления в корзину {tg}: {e}")
+        return str(e), None
+    
+    sz = f" {item.size}л" if item.has_size else ""
+    logger.info(f"Товар добавлен в корзину: {tg}, {item.name}, кол-во {qty}")
+    return f"✅ Добавлено: {item.name}{sz} x{qty}", f"✅ {item.name}{sz} добавлено в корзину"
+
+def add_to_cart_once(callback_id, tg, stock_id, qty):
+    """add_to_cart_action, устойчивый к повторной доставке того же callback."""
+    result, duplicate = processed.run(
+        f"cb:{callback_id}",
+        lambda: add_to_cart_action(tg, stock_id, qty),
+        answer=lambda r: r[0],
+        keep=lambda r: r[1] is not None,
+        durable=False  # Корзина в памяти: ключ в SQLite не защитил бы её надёжнее
+    )
+    return (result, None) if duplicate else result
+
+def refresh_page(c):
+    """Перерисовывает живое сообщение, в котором нажата кнопка (через склейку правок).
+    
+    Возвращает False, если перерисовать нечего: inline-сообщение или страница,
+    отправленная до перезапуска бота.
+    """
+    view = c.message and sessions.view(c.message.chat.id, c.message.message_id)
+    if view is None:
+        return False
+    text, kb = view()
+    sessions.edit(c.message.chat.id, c.message.message_id, text, kb, view)
+    return True
+
+@callbacks.on("add")
+def cb_add_to_cart(c, stock_id, qty):
     chat_id = c.from_user.id
     
     if not check_rate_limit(chat_id):
@@ -225,50 +444,13 @@ def cb_add_to_cart(c):
         return
     
     try:
-        parts = c.data.split("|")
-        if len(parts) < 3:
-            bot.answer_callback_query(c.id, "❌ Ошибка данных.")
-            return
-        
-        stock_id = int(parts[1])
-        qty = int(parts[2])
-        
-        qty, error = validate_quantity(qty)
-        if error:
-            bot.answer_callback_query(c.id, f"❌ {error}")
-            return
-        
-        item = db.get_stock_item(stock_id)
-        if not item:
-            logger.warning(f"Товар не найден: {stock_id}")
-            bot.answer_callback_query(c.id, "❌ Товар не найден.")
-            return
-        
-        if item["quantity"] < qty:
-            bot.answer_callback_query(c.id, f"❌ Осталось только {item['quantity']} шт.")
-            logger.info(f"Недостаточно товара: {stock_id}, запрос {qty}, остаток {item['quantity']}")
-            return
-        
-        tg = str(chat_id)
-        try:
-            db.add_to_cart(tg, stock_id, qty)
-        except ValueError as e:
-            logger.warning(f"Ошибка добавления в корзину {tg}: {e}")
-            bot.answer_callback_query(c.id, str(e))
-            return
-        
-        sz = f" {item['size']}л" if item["has_size"] else ""
-        logger.info(f"Товар добавлен в корзину: {tg}, {item['name']}, кол-во {qty}")
-        bot.answer_callback_query(c.id, f"✅ Добавлено: {item['name']}{sz} x{qty}")
-        safe_send_message(
-            chat_id,
-            f"✅ {item['name']}{sz} добавлено в корзину",
-            reply_markup=add_more_kb()
-        )
+        answer, confirm = add_to_cart_once(c.id, str(chat_id), stock_id, qty)
+        bot.answer_callback_query(c.id, answer)
+        # Количество и сумма обновляются в той же странице; новое сообщение —
+        # только если её нельзя перерисовать
+        if confirm and not refresh_page(c):
+            safe_send_message(chat_id, confirm, reply_markup=add_more_kb())
     
-    except ValueError as e:
-        logger.error(f"Ошибка парсинга cb_add_to_cart {chat_id}: {e}")
-        bot.answer_callback_query(c.id, "❌ Ошибка. Попробуйте позже.")
     except Exception as e:
         logger.error(f"Ошибка cb_add_to_cart {chat_id}: {e}", exc_info=True)
         bot.answer_callback_query(c.id, "❌ Техническая ошибка.")
@@ -276,6 +458,36 @@ def cb_add_to_cart(c):
 # ===============================
 # ==== КОРЗИНА и ОФОРМЛЕНИЕ =====
 # ===============================
+def cart_view(tg):
+    """Текст и кнопки корзины с расчётом скидки."""
+    user = db.get_user_profile(tg)
+    if not user:
+        logger.warning(f"Пользователь не найден при показе корзины: {tg}")
+        return "⚠️ Сначала /start.", None
+    
+    rows = carts.rows(tg)
+    if not rows:
+        logger.info(f"Пустая корзина: {tg}")
+        return "🛒 Корзина пуста.", main_keyboard(db.get_categories())
+    
+    total = sum(r.price * r.qty for r in rows)
+    points = user.points or 0
+    disc = calc_discount(total, points)
+    final = total - disc
+    remaining_points = max(0, points - disc)
+    
+    text = render.cart_text(
+        lines=render.cart_lines(rows), total=total, disc=disc, final=final,
+        points=points, remaining=remaining_points
+    )
+    
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("✅ Оформить заказ", callback_data="checkout"))
+    kb.add(types.InlineKeyboardButton("↩️ Отмена", callback_data="cancel_checkout"))
+    
+    logger.info(f"Показана корзина: {tg}, сумма {total}, скидка {disc}")
+    return text, kb
+
 @bot.message_handler(func=lambda m: m.text == "🛒 Корзина")
 def show_cart(m):
     chat_id = m.chat.id
@@ -284,49 +496,31 @@ def show_cart(m):
         return
     
     try:
-        tg = str(chat_id)
-        user = db.get_user(tg)
-        
-        if not user:
-            logger.warning(f"Пользователь не найден при показе корзины: {tg}")
-            safe_send_message(chat_id, "⚠️ Сначала /start.")
-            return
-        
-        rows = db.get_cart(tg)
-        if not rows:
-            logger.info(f"Пустая корзина: {tg}")
-            safe_send_message(
-                chat_id,
-                "🛒 Корзина пуста.",
-                reply_markup=main_keyboard(db.get_categories())
-            )
-            return
-        
-        total = sum(r["price"] * r["qty"] for r in rows)
-        points = user["points"] or 0
-        disc = calc_discount(total, points)
-        final = total - disc
-        remaining_points = max(0, points - disc)
-        
-        text = (
-            f"🛒 <b>Твоя корзина:</b>\n{format_cart_rows(rows)}\n\n"
-            f"💰 Итого: {total}₽\n"
-            f"🎁 Скидка (баллов: {disc}): -{disc}₽\n"
-            f"📦 <b>К оплате: {final}₽</b>\n"
-            f"💎 Баллов: {points} → {remaining_points} (после использования)"
-        )
-        
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("✅ Оформить заказ", callback_data="checkout"))
-        kb.add(types.InlineKeyboardButton("↩️ Отмена", callback_data="cancel_checkout"))
-        
-        logger.info(f"Показана корзина: {tg}, сумма {total}, скидка {disc}")
-        safe_send_message(chat_id, text, reply_markup=kb)
+        send_page(chat_id, cart_view, str(chat_id))
     
     except Exception as e:
         logger.error(f"Ошибка show_cart {chat_id}: {e}", exc_info=True)
         safe_send_message(chat_id, "❌ Ошибка при загрузке корзины.")
 
+def inline_page(view, *args):
+    """Страница для правки сообщения: в нём возможны только inline-кнопки."""
+    text, kb = view(*args)
+    return text, kb if isinstance(kb, types.InlineKeyboardMarkup) else None
+
+@bot.callback_query_handler(func=lambda c: c.data == "cart")
+def cb_cart(c):
+    """Кнопка корзины на странице категории или поиска: корзина на месте той же страницы."""
+    chat_id = c.from_user.id
+    
+    try:
+        view = partial(inline_page, cart_view, str(chat_id))
+        text, kb = view()
+        bot.answer_callback_query(c.id)
+        sessions.edit(c.message.chat.id, c.message.message_id, text, kb, view)
+    except Exception as e:
+        logger.error(f"Ошибка cb_cart {chat_id}: {e}", exc_info=True)
+        bot.answer_callback_query(c.id, "❌ Техническая ошибка.")
+
 @bot.callback_query_handler(func=lambda c: c.data == "cancel_checkout")
 def cb_cancel_checkout(c):
     """Отмена оформления заказа."""
@@ -339,138 +533,179 @@ def cb_cancel_checkout(c):
             c.message.message_id,
             reply_markup=None
         )
+        sessions.close(c.message.chat.id, c.message.message_id)
         bot.answer_callback_query(c.id, "❌ Заказ отменён.")
         logger.info(f"Заказ отменён: {tg}")
     except Exception as e:
         logger.error(f"Ошибка отмены: {e}")
 
-@bot.callback_query_handler(func=lambda c: c.data == "checkout")
-def cb_checkout(c):
-    chat_id = c.from_user.id
-    tg = str(chat_id)
-    
-    if not check_rate_limit(chat_id, cooldown=2):  # 2 сек защита от двойного клика
-        bot.answer_callback_query(c.id, "⏳ Подождите...")
-        return
+# Результат оформления: ответ на нажатие, исходящие сообщения, нужно ли убрать
+# кнопки с корзины и чек, которым заменяется сообщение корзины. Отправку делает
+# вызывающий рантайм (потоки или asyncio).
+Outgoing = namedtuple('Outgoing', 'chat_id text reply_markup')
+Checkout = namedtuple('Checkout', 'answer messages close_markup ok receipt', defaults=(False, None))
+
+def place_order(tg, rows):
+    """Оформляет заказ из строк корзины rows: склад, заказ, баллы, уведомления.
     
+    Корзину не очищает — это делает checkout_once после записи ответа.
+    """
+    chat_id = int(tg)
     try:
-        user = db.get_user(tg)
-        rows = db.get_cart(tg)
+        user = db.get_user_profile(tg)
         
         if not rows:
             logger.warning(f"Корзина пуста при оформлении: {tg}")
-            bot.answer_callback_query(c.id, "Корзина пуста.")
-            bot.edit_message_reply_markup(c.message.chat.id, c.message.message_id, reply_markup=None)
-            return
-        
-        # КРИТИЧЕСКАЯ ПРОВЕРКА: наличие на складе
-        unavailable = []
-        for r in rows:
-            s = db.get_stock_item(r["stock_id"])
-            if not s or s["quantity"] < r["qty"]:
-                unavailable.append((r['name'], r['qty'], s['quantity'] if s else 0))
-        
-        if unavailable:
-            error_text = "❌ Некоторые товары недоступны:\n"
-            for name, needed, available in unavailable:
-                error_text += f"• {name}: осталось {available}, нужно {needed}\n"
-            bot.answer_callback_query(c.id, error_text[:100])
-            logger.warning(f"Недостаток товара при заказе {tg}: {unavailable}")
-            return
+            return Checkout("Корзина пуста.", [], True)
         
-        total = sum(r["price"] * r["qty"] for r in rows)
-        points = user["points"] or 0
+        total = sum(r.price * r.qty for r in rows)
+        points = user.points or 0
         disc = calc_discount(total, points)
         final = total - disc
-        is_first = user["orders"] == 0
+        is_first = user.orders == 0
         
         # КРИТИЧЕСКАЯ ПРОВЕРКА: достаточно ли баллов для скидки
         if points < disc:
-            bot.answer_callback_query(c.id, "❌ Недостаточно баллов.")
             logger.warning(f"Недостаточно баллов {tg}: есть {points}, нужно {disc}")
-            return
+            return Checkout("❌ Недостаточно баллов.", [], False)
+        
+        items = [
+            {
+                "stock_id": r.stock_id,
+                "name": r.name,
+                "size": r.size,
+                "price": r.price,
+                "qty": r.qty
+            }
+            for r in rows
+        ]
         
-        # === ИСПОЛЬЗУЕМ ТРАНЗАКЦИЮ ===
+        # КРИТИЧЕСКАЯ ОПЕРАЦИЯ: склад, заказ и списание скидки — одна транзакция.
+        # Ошибка (нехватка товара или баллов) не оставляет ни заказа, ни
+        # списаний, и повтор оформления безопасен
+        try:
+            oid, short = db.checkout(tg, items, final, disc)
+        except ValueError as e:
+            logger.error(f"Ошибка при оформлении заказа {tg}: {e}")
+            return Checkout(f"❌ {str(e)}", [], False)
+        if short:
+            names = {r.stock_id: r.name for r in rows}
+            error_text = "❌ Некоторые товары недоступны:\n"
+            for stock_id, needed, available in short:
+                error_text += f"• {names[stock_id]}: осталось {available}, нужно {needed}\n"
+            logger.warning(f"Недостаток товара при заказе {tg}: {short}")
+            return Checkout(error_text[:100], [], False)
+        
+        # Заказ уже создан: начисления ниже идут с ключом "{oid}:{reason}" и не
+        # задваиваются, а их ошибка не должна превращать заказ в «неудачный»
+        # (повтор оформления создал бы второй заказ) — расхождение найдёт сверка баллов
+        messages = []
+        earned = int(final * BONUS_PERCENT / 100)
         try:
-            # Списание баллов
-            if disc > 0:
-                db.update_points(tg, -disc)
-            
-            # Уменьшение остатков (повторная проверка перед вычитанием)
-            for r in rows:
-                s = db.get_stock_item(r["stock_id"])
-                if not s or s["quantity"] < r["qty"]:
-                    raise ValueError(f"Товар {r['name']} недоступен (race condition)")
-                db.reduce_stock(r["stock_id"], r["qty"])
-            
-            # Создание заказа
-            items = [
-                {
-                    "name": r["name"],
-                    "size": r["size"],
-                    "price": r["price"],
-                    "qty": r["qty"]
-                }
-                for r in rows
-            ]
-            oid = db.create_order(tg, items, final)
-            
             # Реферальный бонус
             if is_first:
                 ref = db.get_referrer(tg)
-                if ref:
-                    db.update_points(ref, REFERRAL_BONUS)
-                    safe_send_message(
+                if ref and db.update_points(ref, REFERRAL_BONUS, reason='referral', order_id=oid):
+                    messages.append(Outgoing(
                         int(ref),
-                        f"🎉 Ваш друг <b>{user['name']}</b> сделал первый заказ! +{REFERRAL_BONUS} 💎"
-                    )
+                        f"🎉 Ваш друг <b>{user.name}</b> сделал первый заказ! +{REFERRAL_BONUS} 💎",
+                        None
+                    ))
                     logger.info(f"Реферальный бонус: {ref} получил {REFERRAL_BONUS}")
             
             # Начисление баллов
-            earned = int(final * BONUS_PERCENT / 100)
-            db.update_points(tg, earned)
-            
-            # Очистка корзины
-            db.clear_cart(tg)
-            
-        except ValueError as e:
-            logger.error(f"Ошибка при оформлении заказа {tg}: {e}")
-            bot.answer_callback_query(c.id, f"❌ {str(e)}")
-            return
+            if earned > 0:
+                db.update_points(tg, earned, reason='purchase', order_id=oid)
+        except Exception as e:
+            logger.error(f"Ошибка начисления баллов по заказу {oid}: {e}", exc_info=True)
         
         # Успешное оформление
         logger.info(f"Заказ оформлен: {oid}, пользователь {tg}, сумма {final}₽")
         
-        bot.answer_callback_query(c.id, f"✅ Заказ №{oid} оформлен!")
-        safe_send_message(
-            chat_id,
-            (f"✅ <b>Заказ №{oid} оформлен!</b>\n"
-             f"💳 К оплате: {final}₽\n"
-             f"🎯 Баллы: +{earned} 💎"),
-            reply_markup=main_keyboard(db.get_categories())
-        )
+        # Позиции форматируются один раз — для покупателя и для админа
+        lines = render.cart_lines(rows)
+        receipt = render.order_placed_text(oid=oid, lines=lines, final=final, earned=earned)
         
         # Уведомление администратора
         admin_kb = types.InlineKeyboardMarkup()
-        admin_kb.add(types.InlineKeyboardButton("✅ Готов", callback_data=f"ready|{tg}|{oid}"))
-        admin_text = (
-            f"📦 <b>Новый заказ №{oid}</b>\n"
-            f"👤 {user['name']} (ID: {tg})\n"
-            f"📋 {format_cart_rows(rows)}\n"
-            f"💰 <b>К оплате: {final}₽</b>\n"
-            f"🎁 Скидка: {disc}₽\n"
-            f"⏰ {datetime.now().strftime('%H:%M:%S')}"
+        admin_kb.add(
+            types.InlineKeyboardButton("✅ Готов", callback_data=callbacks.encode("ready", chat_id, oid)),
+            types.InlineKeyboardButton("❌ Отменить", callback_data=callbacks.encode("cancel_order", chat_id, oid))
         )
-        safe_send_message(ADMIN_GROUP_ID, admin_text, reply_markup=admin_kb)
+        admin_text = render.admin_order_text(
+            oid=oid, name=user.name, tg=tg, lines=lines, final=final, disc=disc,
+            time=datetime.now().strftime('%H:%M:%S')
+        )
+        messages.append(Outgoing(admin_chat(), admin_text, admin_kb))
+        return Checkout(f"✅ Заказ №{oid} оформлен!", messages, False, True, receipt)
     
     except Exception as e:
         logger.error(f"Критическая ошибка checkout {tg}: {e}", exc_info=True)
-        bot.answer_callback_query(c.id, "❌ Техническая ошибка при оформлении.")
-        safe_send_message(
-            ADMIN_GROUP_ID,
-            f"🔴 <b>ОШИБКА ЗАКАЗА</b>\nПользователь: {tg}\nОшибка: {str(e)}"
+        return Checkout(
+            "❌ Техническая ошибка при оформлении.",
+            [Outgoing(admin_chat(), f"🔴 <b>ОШИБКА ЗАКАЗА</b>\nПользователь: {tg}\nОшибка: {str(e)}", None)],
+            False
         )
 
+def checkout_once(tg):
+    """place_order не более одного раза на намерение «пользователь оформляет эту корзину».
+    
+    Ключ — хеш строк корзины (id строки + количество): параллельные нажатия по
+    одной корзине дают тот же ключ, а новая корзина после оформления — новые id
+    строк и новый ключ. Ответ успешного оформления запоминается по пользователю
+    до очистки корзины, поэтому двойной клик, поздний повтор и повторная
+    доставка, пришедшие уже к пустой корзине, получают «Заказ №N оформлен»,
+    а не «Корзина пуста».
+    """
+    last_key = f"checkout:{tg}:last"
+    rows = carts.rows(tg)
+    if not rows:
+        last = processed.recall(last_key)
+        if last is not None:
+            return Checkout(last, [], False)
+    
+    def attempt():
+        result = place_order(tg, rows)
+        if result.ok:
+            processed.remember(last_key, result.answer)
+            carts.clear(tg)
+        return result
+    
+    intent = hashlib.blake2s(",".join(f"{r.id}x{r.qty}" for r in rows).encode(), digest_size=8).hexdigest()
+    result, duplicate = processed.run(
+        f"checkout:{tg}:{intent}",
+        attempt,
+        answer=lambda r: r.answer,
+        keep=lambda r: r.ok
+    )
+    return Checkout(result, [], False) if duplicate else result
+
+@bot.callback_query_handler(func=lambda c: c.data == "checkout")
+def cb_checkout(c):
+    chat_id = c.from_user.id
+    try:
+        result = checkout_once(str(chat_id))
+    except Exception as e:
+        logger.error(f"Ошибка оформления {chat_id}: {e}", exc_info=True)
+        bot.answer_callback_query(c.id, "❌ Ошибка...")
+        return
+    
+    # Результат уже зафиксирован: сбой ответа или правки корзины (например, 400
+    # «message is not modified») не должен терять уведомления ниже
+    try:
+        bot.answer_callback_query(c.id, result.answer)
+        if result.receipt:
+            # Чек — на месте корзины, без отдельного сообщения покупателю
+            sessions.edit(c.message.chat.id, c.message.message_id, result.receipt)
+            sessions.close(c.message.chat.id, c.message.message_id)
+        elif result.close_markup:
+            sessions.close(c.message.chat.id, c.message.message_id)
+            bot.edit_message_reply_markup(c.message.chat.id, c.message.message_id, reply_markup=None)
+    except Exception as e:
+        logger.error(f"Ошибка правки корзины после оформления {chat_id}: {e}")
+    for out in result.messages:
+        send_later(out.chat_id, out.text, reply_markup=out.reply_markup)
+
 # ===============================
 # ==== ДОБАВИТЬ ЕЩЁ ============
 # ===============================
@@ -497,8 +732,66 @@ def admin_panel(m):
     logger.info(f"Админ вошёл в панель: {chat_id}")
     safe_send_message(chat_id, "🔥 Админ-панель:", reply_markup=admin_keyboard())
 
+@bot.message_handler(commands=['shops'], func=lambda m: str(m.chat.id) == str(OWNER_CHAT_ID))
+@in_admin_pool
+def owner_shops(m):
+    """Сводка по всем точкам для владельца сети."""
+    try:
+        lines = [
+            f"<b>{shops.tenants[slug].title}</b>: 👥 {users} | ⏳ {pending} | "
+            f"📦 {orders} за сутки на {revenue}₽"
+            for slug, users, pending, orders, revenue in shops.report()
+        ]
+        safe_send_message(m.chat.id, "🏪 Точки:\n" + "\n".join(lines))
+    except Exception as e:
+        logger.error(f"Ошибка сводки по точкам: {e}")
+        safe_send_message(m.chat.id, "❌ Ошибка загрузки сводки.")
+
+# ===============================
+# ==== ПРОФИЛИРОВАНИЕ ===========
+# ===============================
+# Структуры в памяти, растущие с числом пользователей, — в каждом отчёте
+profiler.watch("last_action", lambda: last_action)
+profiler.watch("next_step_handlers", lambda: getattr(bot.next_step_backend, 'handlers', {}))
+profiler.watch("sessions", lambda: sessions._chats)
+profiler.watch("carts", lambda: {t.slug: t.carts.carts for t in shops})
+profiler.watch("idempotency", lambda: {t.slug: t.processed.local for t in shops})
+profiler.watch("chat_bindings", lambda: shops.bindings)
+profiler.watch("api_turns", lambda: transport.turns)
+
+def start_profile(chat_id, mode, seconds):
+    """Запускает сессию профилирования; отчёт приходит файлами в chat_id (None — только в лог)."""
+    def done(paths):
+        if chat_id is None:
+            logger.info(f"Отчёт профилирования: {', '.join(paths) or 'ошибка, см. выше'}")
+            return
+        if not paths:
+            safe_send_message(chat_id, "❌ Ошибка профилирования, подробности в bot.log.")
+        for path in paths:
+            try:
+                with open(path, 'rb') as f:
+                    bot.send_document(chat_id, f, caption=f"🩺 {mode}, {seconds} сек")
+            except Exception as e:
+                logger.error(f"Ошибка отправки отчёта {path}: {e}")
+    
+    profiler.start(mode, seconds, done)
+
+@bot.message_handler(commands=['profile'])
+@admin_only
+def admin_profile(m):
+    args = m.text.split()[1:]
+    mode = args[0] if args else "sample"
+    try:
+        seconds = min(int(args[1]), PROFILE_MAX_SECONDS) if len(args) > 1 else PROFILE_SECONDS
+        start_profile(m.chat.id, mode, seconds)
+    except (ValueError, RuntimeError) as e:
+        safe_send_message(m.chat.id, f"❌ {e}\nФормат: /profile [{'|'.join(PROFILE_MODES)}] [секунд]")
+        return
+    safe_send_message(m.chat.id, f"⏳ Профилирование {mode} на {seconds} сек, отчёт придёт файлом.")
+
 @bot.message_handler(func=lambda m: m.text == "📋 Просмотр меню")
 @admin_only
+@in_admin_pool
 def admin_view_menu(m):
     chat_id = m.chat.id
     try:
@@ -507,7 +800,7 @@ def admin_view_menu(m):
         cats = db.get_categories_with_id()
         
         for cat_id, cat_name in cats:
-            kb.add(types.InlineKeyboardButton(cat_name[:30], callback_data=f"admin_view|{cat_id}"))
+            kb.add(types.InlineKeyboardButton(cat_name[:30], callback_data=callbacks.encode("admin_view", cat_id)))
         
         logger.info(f"Админ просмотр меню: {chat_id}, загрузка {time.time() - start:.2f}s")
         safe_send_message(chat_id, "Выберите категорию:", reply_markup=kb)
@@ -516,20 +809,18 @@ def admin_view_menu(m):
         logger.error(f"Ошибка admin_view_menu: {e}")
         safe_send_message(chat_id, "❌ Ошибка загрузки меню.")
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("admin_view|"))
-def cb_admin_view(c):
-    chat_id = c.from_user.id
+@callbacks.on("admin_view")
+@in_admin_pool
+def cb_admin_view(c, cat_id):
+    chat_id = c.message.chat.id
     
     if not is_admin(chat_id):
         bot.answer_callback_query(c.id, "❌ Доступ запрещён.")
         return
     
     try:
-        _, cat_id = c.data.split("|")
-        cat_id = int(cat_id)
-        
         cat_name = db.get_category_name_by_id(cat_id)
-        items = db.get_stock_by_category_id(cat_id)
+        items = db.get_stock_rows_by_category_id(cat_id)
         
         if not items:
             bot.edit_message_text(
@@ -541,7 +832,7 @@ def cb_admin_view(c):
             return
         
         text = f"📋 <b>{cat_name}</b>\n\n" + "\n".join(
-            f"• {i['name']} {i['size'] if i['has_size'] else ''} — {i['price']}₽ (Ост: {i['quantity']})"
+            f"• {i.name} {i.size if i.has_size else ''} — {i.price}₽ (Ост: {i.quantity})"
             for i in items
         )
         
@@ -552,23 +843,658 @@ def cb_admin_view(c):
         logger.error(f"Ошибка cb_admin_view: {e}")
         bot.answer_callback_query(c.id, "❌ Ошибка.")
 
+# ===============================
+# ==== РЕФЕРАЛЫ И ТОПЫ ==========
+# ===============================
+PAGE_SIZE = 10
+
+def split_page(rows):
+    """Отрезает лишнюю строку (запрашиваем PAGE_SIZE + 1), возвращает (строки, есть_ещё)."""
+    return rows[:PAGE_SIZE], len(rows) > PAGE_SIZE
+
+def top_referrers_page(cursor=None, rank=0):
+    """Страница топа рефереров. cursor = (invited, user_id) последней строки."""
+    rows, has_next = split_page(db.get_top_referrers(PAGE_SIZE + 1, cursor))
+    if not rows:
+        return "👥 Рефереров пока нет.", None
+    
+    lines = []
+    for rank, r in enumerate(rows, rank + 1):
+        lines.append(f"{rank}. {r['name']} — {r['invited']} друзей ({r['converted']} с заказом)")
+    
+    last = rows[-1]
+    next_data = callbacks.encode("top_ref", last['invited'], last['user_id'], rank) if has_next else None
+    return "👥 <b>Топ рефереров:</b>\n" + "\n".join(lines), cursor_pagination_keyboard(next_data)
+
+def top_points_page(cursor=None, rank=0):
+    """Страница топа по баллам. cursor = (points, id) последней строки."""
+    rows, has_next = split_page(db.get_top_by_points(PAGE_SIZE + 1, cursor))
+    if not rows:
+        return "💎 Пользователей пока нет.", None
+    
+    lines = []
+    for rank, r in enumerate(rows, rank + 1):
+        lines.append(f"{rank}. {r['name']} — {r['points']} 💎")
+    
+    last = rows[-1]
+    next_data = callbacks.encode("top_pts", last['points'], last['id'], rank) if has_next else None
+    return "💎 <b>Топ по баллам:</b>\n" + "\n".join(lines), cursor_pagination_keyboard(next_data)
+
+def my_referrals_page(tg, cursor=None):
+    """Страница приглашённых друзей. cursor = id последнего друга."""
+    rows, has_next = split_page(db.get_referrals(tg, PAGE_SIZE + 1, cursor))
+    if not rows:
+        return "👥 Ты пока никого не пригласил.", None
+    
+    invited, converted = db.get_referral_counts(tg)
+    lines = [f"• {r['name']}{' ✅' if r['converted'] else ''}" for r in rows]
+    next_data = callbacks.encode("my_refs", rows[-1]['id']) if has_next else None
+    text = (
+        f"👥 <b>Твои друзья</b> (всего {invited}, с заказом {converted}):\n"
+        + "\n".join(lines)
+    )
+    return text, cursor_pagination_keyboard(next_data)
+
+@bot.message_handler(func=lambda m: m.text == "👥 Топ рефереров")
+@admin_only
+@in_admin_pool
+def admin_top_referrers(m):
+    try:
+        text, kb = top_referrers_page()
+        safe_send_message(m.chat.id, text, reply_markup=kb)
+    except Exception as e:
+        logger.error(f"Ошибка admin_top_referrers: {e}")
+        safe_send_message(m.chat.id, "❌ Ошибка загрузки топа.")
+
+@bot.message_handler(func=lambda m: m.text == "💎 Топ по баллам")
+@admin_only
+@in_admin_pool
+def admin_top_points(m):
+    try:
+        text, kb = top_points_page()
+        safe_send_message(m.chat.id, text, reply_markup=kb)
+    except Exception as e:
+        logger.error(f"Ошибка admin_top_points: {e}")
+        safe_send_message(m.chat.id, "❌ Ошибка загрузки топа.")
+
+def edit_top_page(c, page, cursor, rank):
+    if not is_admin(c.message.chat.id):
+        bot.answer_callback_query(c.id, "❌ Доступ запрещён.")
+        return
+    
+    try:
+        text, kb = page(cursor, rank)
+        bot.edit_message_text(text, c.message.chat.id, c.message.message_id, reply_markup=kb)
+        bot.answer_callback_query(c.id)
+    except Exception as e:
+        logger.error(f"Ошибка листания топа: {e}")
+        bot.answer_callback_query(c.id, "❌ Ошибка.")
+
+@callbacks.on("top_ref")
+@in_admin_pool
+def cb_top_referrers(c, invited, user_id, rank):
+    edit_top_page(c, top_referrers_page, (invited, user_id), rank)
+
+@callbacks.on("top_pts")
+@in_admin_pool
+def cb_top_points(c, points, user_id, rank):
+    edit_top_page(c, top_points_page, (points, user_id), rank)
+
+@bot.message_handler(func=lambda m: m.text == "👥 Мои рефереры")
+def msg_my_referrals(m):
+    chat_id = m.chat.id
+    
+    if not check_rate_limit(chat_id):
+        return
+    
+    try:
+        text, kb = my_referrals_page(str(chat_id))
+        safe_send_message(chat_id, text, reply_markup=kb)
+    except Exception as e:
+        logger.error(f"Ошибка msg_my_referrals {chat_id}: {e}")
+        safe_send_message(chat_id, "❌ Ошибка загрузки рефералов.")
+
+@callbacks.on("my_refs")
+def cb_my_referrals(c, after_id):
+    chat_id = c.from_user.id
+    try:
+        text, kb = my_referrals_page(str(chat_id), after_id)
+        bot.edit_message_text(text, c.message.chat.id, c.message.message_id, reply_markup=kb)
+        bot.answer_callback_query(c.id)
+    except Exception as e:
+        logger.error(f"Ошибка cb_my_referrals {chat_id}: {e}")
+        bot.answer_callback_query(c.id, "❌ Ошибка.")
+
+# ===============================
+# ==== ИСТОРИЯ ЗАКАЗОВ ==========
+# ===============================
+ORDER_STATUS = {
+    'pending': '⏳ готовится',
+    'completed': '✅ выдан',
+    'cancelled': '❌ отменён',
+}
+
+def format_order(o):
+    """Форматирует заказ с позициями."""
+    status = ORDER_STATUS.get(o.status, o.status)
+    return render.order_summary_text(
+        oid=o.id, total=o.total, status=status, created_at=o.created_at, lines=render.cart_lines(o.items)
+    )
+
+def user_orders_page(tg, cursor=None):
+    """Страница истории заказов пользователя. cursor = id последнего заказа."""
+    orders, has_next = split_page(db.get_user_orders(tg, PAGE_SIZE + 1, cursor))
+    if not orders:
+        return "📦 Заказов пока нет.", None
+    
+    next_data = callbacks.encode("my_orders", orders[-1].id) if has_next else None
+    text = "📦 <b>История заказов:</b>\n\n" + "\n\n".join(format_order(o) for o in orders)
+    return text, cursor_pagination_keyboard(next_data)
+
+def recent_orders_page(cursor=None):
+    """Страница последних незакрытых заказов. cursor = (created_at, id)."""
+    orders, has_next = split_page(db.get_orders_by_status('pending', PAGE_SIZE + 1, cursor))
+    if not orders:
+        return "🧾 Новых заказов нет.", None
+    
+    last = orders[-1]
+    next_data = callbacks.encode("adm_orders", last.created_at, last.id) if has_next else None
+    text = "🧾 <b>Последние заказы:</b>\n\n" + "\n\n".join(format_order(o) for o in orders)
+    return text, cursor_pagination_keyboard(next_data)
+
+@bot.message_handler(func=lambda m: m.text == "📦 История заказов")
+def msg_order_history(m):
+    chat_id = m.chat.id
+    
+    if not check_rate_limit(chat_id):
+        return
+    
+    try:
+        text, kb = user_orders_page(str(chat_id))
+        safe_send_message(chat_id, text, reply_markup=kb)
+    except Exception as e:
+        logger.error(f"Ошибка msg_order_history {chat_id}: {e}")
+        safe_send_message(chat_id, "❌ Ошибка загрузки истории.")
+
+@callbacks.on("my_orders")
+def cb_order_history(c, after_id):
+    chat_id = c.from_user.id
+    try:
+        text, kb = user_orders_page(str(chat_id), after_id)
+        bot.edit_message_text(text, c.message.chat.id, c.message.message_id, reply_markup=kb)
+        bot.answer_callback_query(c.id)
+    except Exception as e:
+        logger.error(f"Ошибка cb_order_history {chat_id}: {e}")
+        bot.answer_callback_query(c.id, "❌ Ошибка.")
+
+@bot.message_handler(func=lambda m: m.text == "🧾 Последние заказы")
+@admin_only
+@in_admin_pool
+def admin_recent_orders(m):
+    try:
+        text, kb = recent_orders_page()
+        safe_send_message(m.chat.id, text, reply_markup=kb)
+    except Exception as e:
+        logger.error(f"Ошибка admin_recent_orders: {e}")
+        safe_send_message(m.chat.id, "❌ Ошибка загрузки заказов.")
+
+@callbacks.on("adm_orders")
+@in_admin_pool
+def cb_recent_orders(c, created_at, order_id):
+    if not is_admin(c.message.chat.id):
+        bot.answer_callback_query(c.id, "❌ Доступ запрещён.")
+        return
+    
+    try:
+        text, kb = recent_orders_page((created_at, order_id))
+        bot.edit_message_text(text, c.message.chat.id, c.message.message_id, reply_markup=kb)
+        bot.answer_callback_query(c.id)
+    except Exception as e:
+        logger.error(f"Ошибка cb_recent_orders: {e}")
+        bot.answer_callback_query(c.id, "❌ Ошибка.")
+
+# ===============================
+# ==== ЖУРНАЛ ОПЕРАЦИЙ ==========
+# ===============================
+def parse_audit_filters(text):
+    """"order_id=15 action=order_created" -> {ключ: значение} для db.query_audit."""
+    filters = {}
+    for part in text.split():
+        key, sep, value = part.partition("=")
+        if not sep or key not in AUDIT_FILTERS:
+            raise ValueError(f"Неизвестный фильтр «{part}». Есть: {', '.join(AUDIT_FILTERS)}")
+        filters[key] = value.replace("_", " ") if key in ("since", "until") else value
+    return filters
+
+def audit_page(filters_text="", cursor=None):
+    """Страница журнала операций с фильтрами. cursor = (created_at, id)."""
+    rows, has_next = split_page(db.query_audit(parse_audit_filters(filters_text), cursor, PAGE_SIZE + 1))
+    if not rows:
+        return "📋 Записей нет.", None
+    
+    last = rows[-1]
+    next_data = callbacks.encode("audit", filters_text, last.created_at, last.id) if has_next else None
+    lines = [
+        f"<code>{r.created_at}</code> <b>{r.action}</b> {html.escape((r.details or '')[:200], quote=False)}"
+        for r in rows
+    ]
+    title = f"📋 <b>Журнал</b> {html.escape(filters_text, quote=False)}".rstrip()
+    return f"{title}:\n\n" + "\n".join(lines), cursor_pagination_keyboard(next_data)
+
+@bot.message_handler(func=lambda m: m.text == "📋 Логи операций")
+@bot.message_handler(commands=['audit'])
+@admin_only
+@in_admin_pool
+def admin_audit(m):
+    # /audit order_id=15 | action=order_created since=2026-10-01 | total_min=1000 ...
+    # Первое слово команды — "/audit" или, в группах, "/audit@имя_бота"; у кнопки фильтров нет
+    parts = m.text.split(maxsplit=1) if m.text.startswith("/") else []
+    filters_text = parts[1] if len(parts) > 1 else ""
+    try:
+        text, kb = audit_page(filters_text)
+        safe_send_message(m.chat.id, text, reply_markup=kb)
+    except ValueError as e:
+        safe_send_message(m.chat.id, f"❌ {e}")
+    except Exception as e:
+        logger.error(f"Ошибка admin_audit: {e}", exc_info=True)
+        safe_send_message(m.chat.id, "❌ Ошибка загрузки журнала.")
+
+@callbacks.on("audit")
+@in_admin_pool
+def cb_audit(c, filters, created_at, log_id):
+    if not is_admin(c.message.chat.id):
+        bot.answer_callback_query(c.id, "❌ Доступ запрещён.")
+        return
+    
+    try:
+        text, kb = audit_page(filters, (created_at, log_id))
+        bot.edit_message_text(text, c.message.chat.id, c.message.message_id, reply_markup=kb)
+        bot.answer_callback_query(c.id)
+    except Exception as e:
+        logger.error(f"Ошибка cb_audit: {e}")
+        bot.answer_callback_query(c.id, "❌ Ошибка.")
+
+# ===============================
+# ==== ВЫДАЧА И ОТМЕНА ЗАКАЗОВ ==
+# ===============================
+def close_order_message(c, note):
+    """Убирает кнопки с сообщения о заказе и дописывает итог."""
+    try:
+        bot.edit_message_text(
+            f"{c.message.html_text}\n\n{note}",
+            c.message.chat.id, c.message.message_id, reply_markup=None
+        )
+    except Exception as e:
+        logger.error(f"Ошибка обновления сообщения о заказе: {e}")
+
+@callbacks.on("ready")
+def cb_order_ready(c, tg, order_id):
+    if not is_admin(c.message.chat.id):
+        bot.answer_callback_query(c.id, "❌ Доступ запрещён.")
+        return
+    
+    try:
+        if not db.complete_orders([order_id]):
+            bot.answer_callback_query(c.id, "Заказ уже закрыт.")
+            close_order_message(c, "ℹ️ Заказ уже закрыт.")
+            return
+        
+        logger.info(f"Заказ {order_id} выдан ({c.from_user.id})")
+        bot.answer_callback_query(c.id, f"✅ Заказ №{order_id} готов")
+        close_order_message(c, f"✅ Готов ({c.from_user.first_name})")
+        send_later(tg, f"🍽 <b>Заказ №{order_id} готов!</b> Можно забирать.")
+    except Exception as e:
+        logger.error(f"Ошибка cb_order_ready {order_id}: {e}", exc_info=True)
+        bot.answer_callback_query(c.id, "❌ Ошибка.")
+
+@callbacks.on("cancel_order")
+def cb_order_cancel(c, tg, order_id):
+    if not is_admin(c.message.chat.id):
+        bot.answer_callback_query(c.id, "❌ Доступ запрещён.")
+        return
+    
+    try:
+        cancelled = db.cancel_orders([order_id])
+        if not cancelled:
+            bot.answer_callback_query(c.id, "Заказ уже закрыт.")
+            close_order_message(c, "ℹ️ Заказ уже закрыт.")
+            return
+        
+        _, _, change = cancelled[0]
+        logger.info(f"Заказ {order_id} отменён админом ({c.from_user.id}), баллы {change:+d}")
+        bot.answer_callback_query(c.id, f"❌ Заказ №{order_id} отменён")
+        close_order_message(c, f"❌ Отменён ({c.from_user.first_name})")
+        send_later(
+            tg,
+            f"❌ <b>Заказ №{order_id} отменён.</b>" + (f"\n💎 Баллы: {change:+d}" if change else "")
+        )
+    except Exception as e:
+        logger.error(f"Ошибка cb_order_cancel {order_id}: {e}", exc_info=True)
+        bot.answer_callback_query(c.id, "❌ Ошибка.")
+
+# ===============================
+# ==== ЦЕНЫ И ОСТАТКИ ===========
+# ===============================
+# Кнопка -> (колонка stock, знак изменения; 0 — установить значение)
+ADJUSTMENTS = {
+    "🔺 Увеличить цену": ('price', 1),
+    "🔻 Уменьшить цену": ('price', -1),
+    "⚖️ Установить цену": ('price', 0),
+    "📈 Увеличить остатки": ('quantity', 1),
+    "📉 Уменьшить остатки": ('quantity', -1),
+    "⚖️ Установить остатки": ('quantity', 0),
+}
+
+@bot.message_handler(func=lambda m: m.text in ("💲 Цены", "📦 Остатки"))
+@admin_only
+def admin_adjust_menu(m):
+    kb = price_update_keyboard() if m.text == "💲 Цены" else stock_management_keyboard()
+    safe_send_message(m.chat.id, "Что изменить?", reply_markup=kb)
+
+@bot.message_handler(func=lambda m: m.text in ADJUSTMENTS)
+@admin_only
+def admin_adjust(m):
+    field, sign = ADJUSTMENTS[m.text]
+    example = "«Кофе 250» или «все 300»" if sign == 0 else "«Кофе 10%», «Кофе 20» или «все 5%»"
+    m2 = bot.send_message(
+        m.chat.id, f"{m.text}: категория и значение, например {example} (или «отмена»):"
+    )
+    bot.register_next_step_handler(m2, admin_adjust_apply, field, sign)
+
+def admin_adjust_apply(m, field, sign):
+    chat_id = m.chat.id
+    text = (m.text or "").strip()
+    if not text or text.lower() == "отмена":
+        safe_send_message(chat_id, "❌ Изменение отменено.", reply_markup=admin_keyboard())
+        return
+    
+    target, _, amount = text.rpartition(" ")
+    percent = amount.endswith("%") and sign != 0
+    try:
+        value = int(amount.rstrip("%"))
+        # Установить можно и 0 (нет в наличии), нижнюю границу поля проверит bulk_adjust
+        if value < 0 or (value == 0 and sign != 0):
+            raise ValueError
+    except ValueError:
+        safe_send_message(chat_id, "❌ Значение — целое положительное число (или процент); установить можно и 0.")
+        return
+    
+    cats = dict((name.lower(), cat_id) for cat_id, name in db.get_categories_with_id())
+    key = target.strip().lower()
+    if key not in cats and key != "все":
+        safe_send_message(chat_id, f"❌ Категория «{target.strip()}» не найдена.")
+        return
+    
+    mode = 'set' if sign == 0 else 'percent' if percent else 'add'
+    run_adjust(chat_id, field, mode, value if sign == 0 else sign * value, cats.get(key), text)
+
+@in_admin_pool
+def run_adjust(chat_id, field, mode, value, category_id, request):
+    try:
+        r = db.bulk_adjust(field, mode, value, category_id=category_id)
+        logger.info(f"Админ {chat_id}: {field} {mode} {value}, изменено {r.changed}")
+        safe_send_message(
+            chat_id,
+            f"✅ «{request}»: подходит {r.matched}, изменено {r.changed}. Версия каталога: {r.version}",
+            reply_markup=admin_keyboard()
+        )
+    except ValueError as e:
+        safe_send_message(chat_id, f"❌ {e}")
+    except Exception as e:
+        logger.error(f"Ошибка массового изменения: {e}", exc_info=True)
+        safe_send_message(chat_id, "❌ Не удалось изменить товары.")
+
+# ===============================
+# ==== РАССЫЛКА =================
+# ===============================
+@bot.message_handler(func=lambda m: m.text == "📣 Рассылка")
+@admin_only
+def admin_broadcast(m):
+    m2 = bot.send_message(m.chat.id, "📣 Отправь текст рассылки (или «отмена»):")
+    bot.register_next_step_handler(m2, admin_broadcast_text)
+
+def admin_broadcast_text(m):
+    chat_id = m.chat.id
+    text = (m.text or "").strip()
+    
+    if not text or text.lower() == "отмена":
+        safe_send_message(chat_id, "❌ Рассылка отменена.")
+        return
+    
+    try:
+        broadcast_id = broadcaster.start(text)
+        logger.info(f"Админ запустил рассылку {broadcast_id}: {chat_id}")
+        kb = types.InlineKeyboardMarkup()
+        kb.add(types.InlineKeyboardButton("⛔ Остановить", callback_data=callbacks.encode("bc_stop", broadcast_id)))
+        safe_send_message(chat_id, f"📣 Рассылка №{broadcast_id} поставлена в очередь.", reply_markup=kb)
+    except Exception as e:
+        logger.error(f"Ошибка запуска рассылки: {e}", exc_info=True)
+        safe_send_message(chat_id, "❌ Не удалось запустить рассылку.")
+
+@callbacks.on("bc_stop")
+def cb_broadcast_stop(c, broadcast_id):
+    if not is_admin(c.message.chat.id):
+        bot.answer_callback_query(c.id, "❌ Доступ запрещён.")
+        return
+    
+    try:
+        broadcaster.cancel(broadcast_id)
+        bot.answer_callback_query(c.id, "⛔ Рассылка будет остановлена.")
+    except Exception as e:
+        logger.error(f"Ошибка остановки рассылки {broadcast_id}: {e}")
+        bot.answer_callback_query(c.id, "❌ Ошибка.")
+
+# ===============================
+# ==== БЭКАП И ВЫГРУЗКА =========
+# ===============================
+def backup_dir():
+    """Каталог копий точки: у нескольких точек — свой подкаталог по slug."""
+    return BACKUP_DIR if len(shops) == 1 else os.path.join(BACKUP_DIR, shops.get().slug)
+
+@bot.message_handler(func=lambda m: m.text == "💾 Бэкап")
+@admin_only
+@in_admin_pool
+def admin_backup(m):
+    try:
+        path = jobs.backup_database(db, backup_dir(), BACKUP_KEEP)
+        safe_send_message(m.chat.id, f"💾 Резервная копия создана: <code>{path}</code>")
+    except Exception as e:
+        logger.error(f"Ошибка ручного бэкапа: {e}", exc_info=True)
+        safe_send_message(m.chat.id, "❌ Не удалось создать резервную копию.")
+
+@bot.message_handler(func=lambda m: m.text == "📤 Выгрузка")
+@admin_only
+def admin_export(m):
+    kb = types.InlineKeyboardMarkup()
+    for table, title in (("orders", "🧾 Заказы"), ("users", "👥 Пользователи")):
+        kb.row(*[
+            types.InlineKeyboardButton(f"{title} {fmt.upper()}", callback_data=callbacks.encode("export", table, fmt))
+            for fmt in export.FORMATS
+        ])
+    safe_send_message(m.chat.id, "📤 Что выгрузить?", reply_markup=kb)
+
+@callbacks.on("export")
+@in_admin_pool
+def cb_export(c, table, fmt):
+    if not is_admin(c.message.chat.id):
+        bot.answer_callback_query(c.id, "❌ Доступ запрещён.")
+        return
+    
+    bot.answer_callback_query(c.id, "⏳ Готовлю файл...")
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, f"{table}-{datetime.now():%Y%m%d-%H%M}.{fmt}")
+            count = export.export_table(db, table, path, fmt)
+            with open(path, 'rb') as f:
+                bot.send_document(c.message.chat.id, f, caption=f"📤 {table}: {count} строк")
+    except Exception as e:
+        logger.error(f"Ошибка выгрузки {table}.{fmt}: {e}", exc_info=True)
+        safe_send_message(c.message.chat.id, "❌ Ошибка выгрузки.")
+
+# ===============================
+# ==== ПОИСК ПО МЕНЮ ============
+# ===============================
+def item_title(it):
+    sz = f" {it.size}л" if it.has_size else ""
+    return f"{it.name}{sz}"
+
+def inline_results(query):
+    """Карточки товаров для inline-режима."""
+    results = []
+    for it in db.search_stock(query, limit=20):
+        kb = types.InlineKeyboardMarkup()
+        kb.add(types.InlineKeyboardButton(f"Добавить {item_title(it)}", callback_data=callbacks.encode("add", it.id, 1)))
+        results.append(types.InlineQueryResultArticle(
+            id=str(it.id),
+            title=f"{item_title(it)} — {it.price}₽",
+            description=f"Осталось: {it.quantity} шт",
+            input_message_content=types.InputTextMessageContent(f"☕ {item_title(it)} — {it.price}₽"),
+            reply_markup=kb
+        ))
+    return results
+
+@bot.inline_handler(func=lambda q: len(q.query.strip()) >= 2)
+def inline_search(q):
+    try:
+        bot.answer_inline_query(q.id, inline_results(q.query), cache_time=30)
+    except Exception as e:
+        logger.error(f"Ошибка inline_search: {e}", exc_info=True)
+
+def search_view(query, tg=None):
+    """Текст и кнопки результатов поиска по меню; с tg — и кнопка корзины."""
+    items = db.search_stock(query, limit=10)
+    if not items:
+        return f"🔍 По запросу «{query[:50]}» ничего не найдено.", None
+    
+    text = "🔍 <b>Нашлось:</b>\n\n"
+    kb = types.InlineKeyboardMarkup()
+    for it in items:
+        text += f"• {item_title(it)} — {it.price}₽ (Ост: {it.quantity} шт)\n"
+        kb.add(types.InlineKeyboardButton(f"Добавить {item_title(it)}", callback_data=callbacks.encode("add", it.id, 1)))
+    if tg is not None:
+        cart_button(kb, tg, (it.id for it in items))
+    
+    logger.info(f"Поиск '{query}': {len(items)} товаров")
+    return text, kb
+
+# Кнопки клавиатур без своего обработчика ("👤 Профиль", "🔴 Выход") — не запрос поиска
+MENU_LABELS = reply_labels()
+
+# Регистрируется последним: ловит текст покупателя, не подошедший ни одному обработчику выше
+@bot.message_handler(
+    content_types=['text'],
+    func=lambda m: not m.text.startswith("/") and m.text not in MENU_LABELS and not is_admin(m.chat.id)
+)
+def msg_search(m):
+    chat_id = m.chat.id
+    
+    if not check_rate_limit(chat_id):
+        return
+    
+    try:
+        send_page(chat_id, search_view, m.text, str(chat_id))
+    except Exception as e:
+        logger.error(f"Ошибка msg_search {chat_id}: {e}", exc_info=True)
+        safe_send_message(chat_id, "❌ Ошибка поиска.")
+
 # ===============================
 # ==== ЗАПУСК ===================
 # ===============================
+def housekeeping():
+    """Чистка служебных таблиц: ключи идемпотентности и токены старых кнопок."""
+    processed.purge()
+    db.purge_callback_tokens()
+
+def for_each_shop(func, snapshots_only=False):
+    """Фоновая задача по всем точкам, каждая в своём контексте: ошибка одной не мешает другим."""
+    def run():
+        for t in shops:
+            if snapshots_only and not t.db.snapshot_path:
+                continue
+            try:
+                run_in(t, func)
+            except Exception as e:
+                logger.error(f"Ошибка фоновой задачи точки {t.slug}: {e}", exc_info=True)
+    return run
+
+def start_background_jobs():
+    """Фоновые задачи, общие для потокового и asyncio-рантайма (bot_async.py)."""
+    for_each_shop(lambda: broadcaster.resume())()
+    jobs.run_periodically(
+        POINTS_RECONCILE_INTERVAL,
+        for_each_shop(lambda: jobs.reconcile_points(db, lambda text: safe_send_message(admin_chat(), text))),
+        "points-reconcile"
+    )
+    jobs.run_periodically(
+        ORDER_EXPIRE_INTERVAL,
+        for_each_shop(lambda: jobs.expire_orders(db, ORDER_EXPIRE_HOURS, send_later)),
+        "orders-expire"
+    )
+    if any(t.db.snapshot_path for t in shops):
+        refresh = for_each_shop(lambda: db.refresh_snapshot(), snapshots_only=True)
+        admin_pool.submit(refresh).add_done_callback(log_admin_error)
+        jobs.run_periodically(ANALYTICS_SNAPSHOT_INTERVAL, refresh, "analytics-snapshot")
+    # Первый запуск после миграции — заполнить пары по истории заказов
+    admin_pool.submit(for_each_shop(lambda: db.rebuild_item_pairs(if_empty=True))).add_done_callback(log_admin_error)
+    jobs.run_periodically(
+        RECOMMEND_REBUILD_INTERVAL, for_each_shop(lambda: db.rebuild_item_pairs()), "recommendations-rebuild"
+    )
+    jobs.run_periodically(CART_FLUSH_INTERVAL, for_each_shop(lambda: carts.flush()), "cart-flush", quiet=True)
+    jobs.run_periodically(60 * 60, for_each_shop(housekeeping), "db-housekeeping")
+    jobs.run_periodically(
+        BACKUP_INTERVAL, for_each_shop(lambda: jobs.backup_database(db, backup_dir(), BACKUP_KEEP)), "db-backup"
+    )
+
+def save_next_steps():
+    """Шаги диалогов (ждём имя, сумму, текст рассылки) — в файл для следующего процесса."""
+    handlers = {}
+    for chat_id, steps in list(bot.next_step_backend.handlers.items()):
+        try:
+            pickle.dumps(steps)
+        except Exception as e:
+            logger.warning(f"Шаг диалога чата {chat_id} не сохранён: {e}")
+            continue
+        handlers[chat_id] = steps
+    FileHandlerBackend.dump_handlers(handlers, NEXT_STEPS_PATH)
+    logger.info(f"Сохранено шагов диалогов: {len(handlers)}")
+
+def load_next_steps():
+    """Шаги диалогов, сохранённые предыдущим процессом (файл удаляется)."""
+    try:
+        handlers = FileHandlerBackend.return_load_handlers(NEXT_STEPS_PATH)
+    except Exception as e:
+        logger.error(f"Не удалось загрузить шаги диалогов: {e}", exc_info=True)
+        return
+    if handlers:
+        bot.next_step_backend.handlers.update(handlers)
+        logger.info(f"Загружено шагов диалогов: {len(handlers)}")
+
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Telegram-бот кофейни")
+    parser.add_argument("--profile", choices=PROFILE_MODES, help="профилировать после запуска, отчёт — в админскую группу (с несколькими точками — в лог)")
+    parser.add_argument("--profile-seconds", type=int, default=PROFILE_SECONDS)
+    cli = parser.parse_args()
+    
     logger.info("🚀 Бот запускается...")
     print("🚀 Бот запускается...")
     
-    apihelper.API_MAX_ASYNC_REQUESTS = 5
+    def on_start():
+        load_next_steps()
+        start_background_jobs()
+        if cli.profile:
+            # Профиль общий на процесс: с несколькими точками — не в чужую админку, а в лог
+            start_profile(shops.default.admin_group_id if len(shops) == 1 else None, cli.profile, cli.profile_seconds)
     
-    while True:
-        try:
-            bot.infinity_polling(timeout=60, long_polling_timeout=30)
-        except KeyboardInterrupt:
-            logger.info("🛑 Бот остановлен вручную (Ctrl+C).")
-            print("🛑 Бот остановлен.")
-            break
-        except Exception as e:
-            logger.error(f"⚠️ Ошибка polling: {e}", exc_info=True)
-            print(f"⚠️ Ошибка: {e}. Перезапуск через 3 сек...")
-            time.sleep(3)
+    # SIGTERM/Ctrl+C — мягкая остановка, SIGHUP — смена процесса без простоя
+    lifecycle = Lifecycle(
+        bot, inflight, drain_timeout=DRAIN_TIMEOUT, poll_timeout=POLL_TIMEOUT, handoff_timeout=HANDOFF_TIMEOUT
+    )
+    lifecycle.before_handoff("корзины", for_each_shop(lambda: carts.flush()))
+    lifecycle.before_handoff("рассылки", for_each_shop(lambda: broadcaster.stop(timeout=DRAIN_TIMEOUT)))
+    lifecycle.before_handoff("шаги диалогов", save_next_steps)
+    lifecycle.after_handoff("админские задачи", admin_pool.shutdown)
+    lifecycle.after_handoff("отложенные правки", sessions.flush_pending)
+    lifecycle.after_handoff("отправки", transport.close)
+    lifecycle.run(on_start)
+    print("🛑 Бот остановлен.")
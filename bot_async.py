@@ -0,0 +1,292 @@
+# bot_async.py
+# coding: utf-8
+"""Asyncio-рантайм бота: python bot_async.py вместо python bot.py.
+
+Покупательские сценарии (старт, меню, корзина, заказ, история, поиск) —
+корутины поверх AsyncTeleBot с той же логикой, что в bot.py: работа с БД
+уходит в отдельный пул потоков, отправки в Telegram идут параллельно.
+Ожидающий пользователь стоит корутину, а не поток ОС.
+
+Категории, поиск и корзина правятся на месте через свой MessageSessions:
+отложенные правки — задачи event loop, а не таймеры-потоки.
+
+Админские экраны и пошаговые диалоги админа передаются потоковым
+обработчикам bot.py, поэтому функциональность обоих режимов совпадает.
+"""
+import asyncio
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from telebot.async_telebot import AsyncTeleBot
+
+import bot as threaded
+from callbacks import TOKEN
+from config import BOT_TOKEN, ASYNC_DB_WORKERS, EDIT_COALESCE
+from keyboards import main_keyboard, add_more_kb
+from sessions import MessageSessions
+from tenants import current
+
+logger = logging.getLogger(__name__)
+
+abot = AsyncTeleBot(BOT_TOKEN, parse_mode="HTML")
+db = threaded.db
+callbacks = threaded.callbacks
+
+# Все вызовы sqlite3 — только здесь: event loop не блокируется на диске
+db_executor = ThreadPoolExecutor(ASYNC_DB_WORKERS, thread_name_prefix="db")
+
+awaiting_name = {}  # {chat_id: реферальный код} — ждём имя при регистрации
+
+async def run_db(func, *args):
+    """Выполняет синхронную функцию с обращениями к БД в db_executor (в контексте точки)."""
+    return await asyncio.get_running_loop().run_in_executor(
+        db_executor, partial(contextvars.copy_context().run, func, *args)
+    )
+
+async def enter_shop(update):
+    """Точка обновления — в контекст задачи-обработчика (как RoutedTeleBot в bot.py)."""
+    current.set(await run_db(threaded.shops.route, update))
+
+async def safe_send_message(chat_id, text, **kwargs):
+    """Асинхронный аналог bot.safe_send_message."""
+    try:
+        return await abot.send_message(chat_id, text, **kwargs)
+    except Exception as e:
+        logger.error(f"Ошибка отправки сообщения {chat_id}: {e}")
+
+async def edit_message(chat_id, message_id, text, reply_markup=None):
+    """Асинхронный аналог bot.edit_message."""
+    try:
+        await abot.edit_message_text(text, chat_id, message_id, reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"Ошибка правки сообщения {chat_id}/{message_id}: {e}")
+
+background = set()  # Ссылки на фоновые задачи, чтобы их не собрал GC
+
+def spawn(coro):
+    if coro is not None:
+        task = asyncio.ensure_future(coro)
+        background.add(task)
+        task.add_done_callback(background.discard)
+
+def schedule(delay, func):
+    """Отложенная правка MessageSessions — через event loop."""
+    asyncio.get_running_loop().call_later(delay, lambda: spawn(func()))
+
+sessions = MessageSessions(edit_message, window=EDIT_COALESCE, schedule=schedule)
+
+async def send_outgoing(messages):
+    """Отправляет пачку сообщений конвейером, не дожидаясь каждого по очереди."""
+    await asyncio.gather(*(
+        safe_send_message(out.chat_id, out.text, reply_markup=out.reply_markup) for out in messages
+    ))
+
+# ===============================
+# ==== СООБЩЕНИЯ ================
+# ===============================
+async def on_start(m, tg):
+    ref, back = await asyncio.gather(
+        run_db(threaded.parse_referrer, tg, m.text),
+        run_db(threaded.welcome_back, tg)
+    )
+    if back:
+        text, kb = back
+        await safe_send_message(m.chat.id, text, reply_markup=kb)
+        return
+    
+    logger.info(f"Новый пользователь: {tg}, реферер: {ref}")
+    awaiting_name[m.chat.id] = ref
+    await safe_send_message(m.chat.id, "☕ Привет! Как тебя зовут?")
+
+async def on_name(m, tg):
+    text, kb, done = await run_db(threaded.register_user, tg, m.text or "", awaiting_name[m.chat.id])
+    if done:
+        awaiting_name.pop(m.chat.id, None)
+    await safe_send_message(m.chat.id, text, reply_markup=kb)
+
+async def on_view(m, view, *args):
+    """Сообщение, ответ на которое — готовая страница (текст, клавиатура) из bot.py."""
+    text, kb = await run_db(view, *args)
+    await safe_send_message(m.chat.id, text, reply_markup=kb)
+
+async def on_live_view(m, view, *args):
+    """Как on_view, но сообщение становится живым: дальше оно правится на месте."""
+    text, kb = await run_db(view, *args)
+    sessions.track(m.chat.id, await safe_send_message(m.chat.id, text, reply_markup=kb), text, kb, partial(view, *args))
+
+async def on_add_more(m, tg):
+    kb = main_keyboard(await run_db(db.get_categories))
+    await safe_send_message(m.chat.id, "📋 Выбери ещё блюда:", reply_markup=kb)
+
+# Фиксированные кнопки главного меню -> страница из bot.py
+MENU_VIEWS = {
+    "📦 История заказов": threaded.user_orders_page,
+    "👥 Мои рефереры": threaded.my_referrals_page,
+}
+
+@abot.message_handler(content_types=['text'])
+async def handle_message(m):
+    await enter_shop(m)
+    chat_id = m.chat.id
+    tg = str(chat_id)
+    text = m.text or ""
+    
+    # Админка и её пошаговые диалоги — потоковые обработчики bot.py
+    if threaded.is_admin(chat_id):
+        threaded.bot.process_new_messages([m])
+        return
+    
+    try:
+        if chat_id in awaiting_name and not text.startswith("/"):
+            await on_name(m, tg)
+            return
+        if not threaded.check_rate_limit(chat_id):
+            return
+        
+        if text.startswith("/start"):
+            await on_start(m, tg)
+        elif text == "🛒 Корзина":
+            await on_live_view(m, threaded.cart_view, tg)
+        elif text in MENU_VIEWS:
+            await on_view(m, MENU_VIEWS[text], tg)
+        elif text == "➕ Добавить ещё":
+            await on_add_more(m, tg)
+        elif text in await run_db(db.get_categories):
+            await on_live_view(m, threaded.category_view, text, tg)
+        elif not text.startswith("/") and text not in threaded.MENU_LABELS:
+            await on_live_view(m, threaded.search_view, text, tg)
+        else:
+            threaded.bot.process_new_messages([m])
+    except Exception as e:
+        logger.error(f"Ошибка async-обработчика сообщения {chat_id}: {e}", exc_info=True)
+        await safe_send_message(chat_id, "❌ Техническая ошибка. Попробуйте позже.")
+
+# ===============================
+# ==== CALLBACK-КНОПКИ ==========
+# ===============================
+async def refresh_page(c):
+    """Асинхронный аналог bot.refresh_page."""
+    view = c.message and sessions.view(c.message.chat.id, c.message.message_id)
+    if view is None:
+        return False
+    text, kb = await run_db(view)
+    edit = sessions.edit(c.message.chat.id, c.message.message_id, text, kb, view)
+    if edit is not None:
+        await edit
+    return True
+
+async def refresh_or_confirm(c, confirm):
+    if not await refresh_page(c):
+        await safe_send_message(c.from_user.id, confirm, reply_markup=add_more_kb())
+
+async def on_add(c, stock_id, qty):
+    chat_id = c.from_user.id
+    if not threaded.check_rate_limit(chat_id):
+        await abot.answer_callback_query(c.id, "⏳ Не спешите, подождите секунду.")
+        return
+    
+    answer, confirm = await run_db(threaded.add_to_cart_once, c.id, str(chat_id), stock_id, qty)
+    sends = [abot.answer_callback_query(c.id, answer)]
+    if confirm:
+        sends.append(refresh_or_confirm(c, confirm))
+    await asyncio.gather(*sends)
+
+async def on_page(c, view, *args):
+    text, kb = await run_db(view, str(c.from_user.id), *args)
+    await asyncio.gather(
+        abot.edit_message_text(text, c.message.chat.id, c.message.message_id, reply_markup=kb),
+        abot.answer_callback_query(c.id)
+    )
+
+async def on_cart(c):
+    view = partial(threaded.inline_page, threaded.cart_view, str(c.from_user.id))
+    text, kb = await run_db(view)
+    sends = [abot.answer_callback_query(c.id)]
+    edit = sessions.edit(c.message.chat.id, c.message.message_id, text, kb, view)
+    if edit is not None:
+        sends.append(edit)
+    await asyncio.gather(*sends)
+
+async def on_checkout(c):
+    result = await run_db(threaded.checkout_once, str(c.from_user.id))
+    sends = [abot.answer_callback_query(c.id, result.answer)]
+    if result.receipt:
+        edit = sessions.edit(c.message.chat.id, c.message.message_id, result.receipt)
+        if edit is not None:
+            sends.append(edit)
+        sessions.close(c.message.chat.id, c.message.message_id)
+    elif result.close_markup:
+        sends.append(abot.edit_message_reply_markup(c.message.chat.id, c.message.message_id, reply_markup=None))
+        sessions.close(c.message.chat.id, c.message.message_id)
+    # Результат уже зафиксирован: сбой правки корзины логируется здесь, а не
+    # уходит в handle_callback — тот ответил бы на нажатие второй раз
+    for r in await asyncio.gather(*sends, send_outgoing(result.messages), return_exceptions=True):
+        if isinstance(r, Exception):
+            logger.error(f"Ошибка ответа на оформление {c.from_user.id}: {r}")
+
+async def on_cancel_checkout(c):
+    sessions.close(c.message.chat.id, c.message.message_id)
+    await asyncio.gather(
+        abot.edit_message_reply_markup(c.message.chat.id, c.message.message_id, reply_markup=None),
+        abot.answer_callback_query(c.id, "❌ Заказ отменён.")
+    )
+    logger.info(f"Заказ отменён: {c.from_user.id}")
+
+# Действия CallbackCodec, обслуживаемые корутинами; остальные — в bot.py
+ASYNC_ACTIONS = {
+    "add": on_add,
+    "my_orders": lambda c, after_id: on_page(c, threaded.user_orders_page, after_id),
+    "my_refs": lambda c, after_id: on_page(c, threaded.my_referrals_page, after_id),
+}
+
+@abot.callback_query_handler(func=lambda c: True)
+async def handle_callback(c):
+    try:
+        await enter_shop(c)
+        if c.data == "checkout":
+            await on_checkout(c)
+            return
+        if c.data == "cancel_checkout":
+            await on_cancel_checkout(c)
+            return
+        if c.data == "cart":
+            await on_cart(c)
+            return
+        
+        if not c.data:
+            decoded = None
+        elif c.data.startswith(TOKEN):
+            decoded = await run_db(callbacks.decode, c.data)  # Длинный payload лежит в БД
+        else:
+            decoded = callbacks.decode(c.data)
+        handler = decoded and ASYNC_ACTIONS.get(decoded[0].name)
+        if handler is None:
+            threaded.bot.process_new_callback_query([c])
+            return
+        await handler(c, *decoded[1])
+    except Exception as e:
+        logger.error(f"Ошибка async-обработчика кнопки {c.from_user.id}: {e}", exc_info=True)
+        await abot.answer_callback_query(c.id, "❌ Техническая ошибка.")
+
+# ===============================
+# ==== INLINE-ПОИСК =============
+# ===============================
+@abot.inline_handler(func=lambda q: len(q.query.strip()) >= 2)
+async def handle_inline(q):
+    try:
+        await enter_shop(q)
+        await abot.answer_inline_query(q.id, await run_db(threaded.inline_results, q.query), cache_time=30)
+    except Exception as e:
+        logger.error(f"Ошибка async inline_search: {e}", exc_info=True)
+
+# ===============================
+# ==== ЗАПУСК ===================
+# ===============================
+if __name__ == "__main__":
+    logger.info("🚀 Бот запускается (asyncio)...")
+    print("🚀 Бот запускается (asyncio)...")
+    
+    threaded.start_background_jobs()
+    asyncio.run(abot.infinity_polling(timeout=60, request_timeout=90))
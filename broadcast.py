@@ -0,0 +1,173 @@
+# broadcast.py
+# coding: utf-8
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from telebot.apihelper import ApiTelegramException
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Ограничитель скорости: не более rate отправок в секунду (с паузой по 429)."""
+    
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Блокирует поток, пока не появится свободный токен."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+    
+    def pause(self, seconds):
+        """Останавливает выдачу токенов всем потокам (Telegram вернул retry_after)."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+def retry_after(e):
+    """Секунды ожидания из ответа 429 или None для остальных ошибок."""
+    if isinstance(e, ApiTelegramException) and e.error_code == 429:
+        return (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+    return None
+
+
+class Broadcaster:
+    """Рассылка по всем пользователям: пачки из БД -> пул потоков -> token bucket."""
+    
+    def __init__(self, bot, db, admin_chat_id, rate=25, workers=4, batch_size=500, bucket=None):
+        self.bot = bot
+        self.db = db
+        self.admin_chat_id = admin_chat_id
+        self.bucket = bucket or TokenBucket(rate)  # Общий bucket — общий лимит на бота
+        self.workers = workers
+        self.batch_size = batch_size
+        self.cancelled = set()  # ID рассылок, отменённых админом
+        self.stopped = threading.Event()  # Процесс останавливается: рассылки продолжит следующий
+        self.threads = []
+    
+    def start(self, text):
+        """Создаёт задание и запускает его в фоне. Возвращает ID рассылки."""
+        broadcast_id = self.db.create_broadcast(text)
+        self._spawn(broadcast_id, text, 0)
+        return broadcast_id
+    
+    def resume(self):
+        """Продолжает рассылки, прерванные рестартом процесса."""
+        for job in self.db.get_running_broadcasts():
+            logger.info(f"Продолжение рассылки {job['id']} с пользователя {job['last_user_id']}")
+            self._spawn(job['id'], job['text'], job['last_user_id'])
+    
+    def cancel(self, broadcast_id):
+        """Останавливает рассылку перед следующей пачкой."""
+        self.cancelled.add(broadcast_id)
+    
+    def stop(self, timeout=None):
+        """Останавливает рассылки после текущей пачки, ждёт не дольше timeout.
+        
+        Задания остаются в статусе running — их продолжит resume() следующего
+        процесса. False — какая-то пачка не успела досылаться.
+        """
+        self.stopped.set()
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for t in self.threads:
+            t.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        return not any(t.is_alive() for t in self.threads)
+    
+    def _spawn(self, broadcast_id, text, after_user_id):
+        t = threading.Thread(
+            target=self._run, args=(broadcast_id, text, after_user_id),
+            name=f"broadcast-{broadcast_id}", daemon=True
+        )
+        self.threads = [th for th in self.threads if th.is_alive()] + [t]
+        t.start()
+    
+    def _send(self, chat_id, text):
+        """Отправка одному получателю. True — доставлено.
+        
+        429 повторяет транспорт (transport.py) и он же ставит bucket на паузу;
+        дошедший сюда 429 — окончательный отказ после его повторов.
+        """
+        self.bucket.acquire()
+        try:
+            self.bot.send_message(chat_id, text)
+            return True
+        except Exception as e:
+            delay = retry_after(e)
+            if delay is not None:
+                # Повторы транспорта исчерпаны — остальные потоки тоже ждут
+                logger.warning(f"Рассылка: 429 после повторов, не доставлено {chat_id}, пауза {delay} сек")
+                self.bucket.pause(delay)
+            else:
+                # 403 (бот заблокирован), удалённый чат и т.п. — не повторяем
+                logger.info(f"Рассылка: не доставлено {chat_id}: {e}")
+            return False
+    
+    def _run(self, broadcast_id, text, after_user_id):
+        started = time.monotonic()
+        total_sent = total_failed = 0
+        last_user_id = after_user_id
+        status = 'done'
+        self._report(f"📣 Рассылка №{broadcast_id} запущена.")
+        
+        try:
+            with ThreadPoolExecutor(self.workers, thread_name_prefix=f"bc{broadcast_id}") as pool:
+                for batch in self.db.iter_recipients(after_user_id, self.batch_size):
+                    if self.stopped.is_set():
+                        logger.info(f"Рассылка {broadcast_id} приостановлена на пользователе {last_user_id}")
+                        return
+                    if broadcast_id in self.cancelled:
+                        status = 'cancelled'
+                        break
+                    
+                    futures = [pool.submit(self._send, int(tg), text) for _, tg in batch]
+                    wait(futures)
+                    sent = sum(1 for f in futures if f.result())
+                    failed = len(futures) - sent
+                    total_sent += sent
+                    total_failed += failed
+                    
+                    # Прогресс фиксируется после пачки: при падении повторится максимум одна пачка
+                    last_user_id = batch[-1][0]
+                    self.db.update_broadcast_progress(broadcast_id, last_user_id, sent, failed)
+            
+            self.db.update_broadcast_progress(broadcast_id, last_user_id, 0, 0, status)
+        except Exception as e:
+            logger.error(f"Ошибка рассылки {broadcast_id}: {e}", exc_info=True)
+            self._report(f"🔴 Рассылка №{broadcast_id} прервана: {e}")
+            return
+        
+        elapsed = time.monotonic() - started
+        rate = (total_sent + total_failed) / elapsed if elapsed else 0
+        logger.info(f"Рассылка {broadcast_id} {status}: отправлено {total_sent}, ошибок {total_failed}, {rate:.1f} сообщ/сек")
+        self._report(
+            f"📣 Рассылка №{broadcast_id} {'завершена' if status == 'done' else 'отменена'}\n"
+            f"✅ Доставлено: {total_sent}\n"
+            f"❌ Ошибок: {total_failed}\n"
+            f"⏱ {elapsed:.0f} сек, {rate:.1f} сообщ/сек"
+        )
+    
+    def _report(self, text):
+        try:
+            self.bot.send_message(self.admin_chat_id, text)
+        except Exception as e:
+            logger.error(f"Ошибка отчёта о рассылке: {e}")
@@ -0,0 +1,160 @@
+# callbacks.py
+# coding: utf-8
+"""Компактный формат callback_data вместо строк вида "add|{stock_id}|{qty}".
+
+Формат: "!" + base64url(версия, ID действия, аргументы varint/строки, 4 байта MAC).
+Если результат не влезает в 64 байта Telegram, полезная нагрузка кладётся
+в таблицу callback_tokens, а в кнопку уходит "~" + токен.
+Старые кнопки "action|a|b" (уже разосланные в чатах) разбираются только для
+действий, существовавших до этого формата (legacy): у них нет MAC, и
+подделать такую строку для нового действия было бы тривиально.
+"""
+import base64
+import hashlib
+import hmac
+import logging
+import secrets
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+MAX_CALLBACK_DATA = 64  # Лимит Telegram
+TAG_SIZE = 4            # Усечённый MAC: защита от подделанных кнопок
+PACKED = "!"
+TOKEN = "~"
+
+
+# =============== УПАКОВКА ЗНАЧЕНИЙ ===============
+
+def _put_int(out, n):
+    n = (n << 1) ^ (n >> 63)  # zigzag: отрицательные ID групп тоже коротко
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def _get_int(buf, pos):
+    n = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return (n >> 1) ^ -(n & 1), pos
+        shift += 7
+
+def _put_str(out, s):
+    raw = s.encode('utf-8')
+    _put_int(out, len(raw))
+    out += raw
+
+def _get_str(buf, pos):
+    size, pos = _get_int(buf, pos)
+    return buf[pos:pos + size].decode('utf-8'), pos + size
+
+_CODERS = {int: (_put_int, _get_int), str: (_put_str, _get_str)}
+
+
+class Action:
+    """Схема одного действия: ID, имена и типы аргументов, обработчик."""
+    __slots__ = ('id', 'name', 'fields', 'types', 'encoders', 'decoders', 'handler')
+    
+    def __init__(self, action_id, name, fields):
+        self.id = action_id
+        self.name = name
+        self.fields = tuple(fields)
+        self.types = tuple(fields.values())
+        # Кодеры подбираются один раз при регистрации, а не на каждое нажатие
+        self.encoders = tuple(_CODERS[t][0] for t in self.types)
+        self.decoders = tuple(_CODERS[t][1] for t in self.types)
+        self.handler = None
+
+
+class CallbackCodec:
+    def __init__(self, secret, store=None, legacy=()):
+        self.key = hashlib.blake2s(f"callbacks:{secret}".encode('utf-8')).digest()
+        self.store = store  # DBManager для длинных payload (или None)
+        self.legacy = frozenset(legacy)  # Действия, чьи старые кнопки "name|a|b" ещё в чатах
+        self.by_id = {}
+        self.by_name = {}
+    
+    def register(self, action_id, name, **fields):
+        """Объявляет действие. action_id нельзя менять: он уже сохранён в кнопках."""
+        if action_id in self.by_id or name in self.by_name or not 0 < action_id < 256:
+            raise ValueError(f"Некорректное или повторное действие: {action_id} {name}")
+        action = Action(action_id, name, fields)
+        self.by_id[action_id] = self.by_name[name] = action
+        return action
+    
+    def on(self, name):
+        """Декоратор: обработчик получает (callback, *аргументы нужных типов)."""
+        def decorator(func):
+            self.by_name[name].handler = func
+            return func
+        return decorator
+    
+    def _tag(self, body):
+        # Keyed BLAKE2s — MAC без обёртки hmac, в ~3 раза быстрее HMAC-SHA256
+        return hashlib.blake2s(body, key=self.key, digest_size=TAG_SIZE).digest()
+    
+    def encode(self, name, *args):
+        """Упаковывает действие и аргументы в строку для callback_data."""
+        action = self.by_name[name]
+        body = bytearray((VERSION, action.id))
+        for put, value in zip(action.encoders, args):
+            put(body, value)
+        body += self._tag(body)
+        data = PACKED + base64.urlsafe_b64encode(body).rstrip(b"=").decode('ascii')
+        if len(data) <= MAX_CALLBACK_DATA:
+            return data
+        if self.store is None:
+            raise ValueError(f"callback_data длиннее {MAX_CALLBACK_DATA} байт: {name}")
+        token = secrets.token_urlsafe(12)
+        self.store.save_callback_token(token, bytes(body))
+        return TOKEN + token
+    
+    def decode(self, data):
+        """Возвращает (Action, аргументы) или None для чужих/испорченных данных."""
+        try:
+            if data[0] == PACKED:
+                body = base64.urlsafe_b64decode(data[1:] + "=" * (-len(data[1:]) % 4))
+            elif data[0] == TOKEN and self.store is not None:
+                body = self.store.load_callback_token(data[1:])
+                if body is None:
+                    return None
+            else:
+                return self._decode_legacy(data)
+            
+            payload, tag = body[:-TAG_SIZE], body[-TAG_SIZE:]
+            if payload[0] != VERSION or not hmac.compare_digest(tag, self._tag(payload)):
+                return None
+            action = self.by_id[payload[1]]
+            args, pos = [], 2
+            for get in action.decoders:
+                value, pos = get(payload, pos)
+                args.append(value)
+            return action, args
+        except (ValueError, LookupError, UnicodeDecodeError):
+            # LookupError — и неизвестный ID действия, и хранилище токенов вне точки
+            return None
+    
+    def _decode_legacy(self, data):
+        """Разбор старого формата "name|a|b" по той же схеме типов."""
+        parts = data.split("|")
+        action = self.by_name.get(parts[0]) if parts[0] in self.legacy else None
+        if action is None or len(parts) - 1 != len(action.types):
+            return None
+        return action, [t(v) for t, v in zip(action.types, parts[1:])]
+    
+    def owns(self, c):
+        """Фильтр для callback_query_handler: данные наши и у действия есть обработчик."""
+        if not c.data:
+            return False
+        decoded = self.decode(c.data)
+        c.decoded_callback = decoded  # Чтобы dispatch не декодировал второй раз
+        return decoded is not None and decoded[0].handler is not None
+    
+    def dispatch(self, c):
+        """Вызывает обработчик действия с уже типизированными аргументами."""
+        action, args = c.decoded_callback
+        return action.handler(c, *args)
@@ -0,0 +1,133 @@
+# carts.py
+# coding: utf-8
+"""Корзины в памяти с отложенной записью в таблицу cart.
+
+Корзина меняется на каждое нажатие «Добавить», а нужна только до
+оформления. Поэтому добавление — операция над словарём в памяти, а
+изменённые корзины раз в flush_interval секунд (и при остановке бота)
+одной транзакцией переписываются в cart. При падении процесса теряются
+изменения не старше одного интервала; очистка после оформления заказа
+пишется в БД сразу.
+
+Оформление заказа читает корзину отсюда же. Корзина пользователя
+загружается из БД при первом обращении; чистые корзины, не тронутые
+дольше idle секунд, выгружаются из памяти после записи.
+"""
+import time
+import logging
+import threading
+
+from db import CartRow
+
+logger = logging.getLogger(__name__)
+
+MAX_QTY = 999        # Как CHECK в таблице cart
+ID_BLOCK = 1000      # Сколько ID строк резервировать в БД за раз
+
+
+class _Cart:
+    """Корзина пользователя: {stock_id: CartRow} в порядке добавления."""
+    __slots__ = ('lines', 'dirty', 'touched')
+    
+    def __init__(self, rows):
+        self.lines = {r.stock_id: r for r in rows}
+        self.dirty = False
+        self.touched = time.monotonic()
+
+
+class CartStore:
+    """Активные корзины в памяти поверх таблицы cart (write-behind)."""
+    
+    def __init__(self, db, idle=30 * 60):
+        self.db = db
+        self.idle = idle
+        self.carts = {}  # {telegram_id: _Cart}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()  # Записи не обгоняют друг друга
+        self.next_id = self.end_id = 0
+    
+    def _cart(self, tg):
+        """Корзина из памяти или из БД (вызывается под self.lock)."""
+        cart = self.carts.get(tg)
+        if cart is None:
+            cart = self.carts[tg] = _Cart(self.db.get_cart_rows(tg))
+        cart.touched = time.monotonic()
+        return cart
+    
+    def _new_id(self):
+        # ID строк идут в ключ идемпотентности оформления, поэтому они
+        # уникальны навсегда: блоки резервируются в БД (hi/lo)
+        if self.next_id == self.end_id:
+            self.next_id = self.db.reserve_cart_ids(ID_BLOCK)
+            self.end_id = self.next_id + ID_BLOCK
+        self.next_id += 1
+        return self.next_id - 1
+    
+    def rows(self, tg):
+        """Корзина как список CartRow (как DBManager.get_cart_rows)."""
+        tg = str(tg)
+        with self.lock:
+            return list(self._cart(tg).lines.values())
+    
+    def add(self, tg, item, qty):
+        """Кладёт товар item (StockRow) в корзину или увеличивает количество."""
+        tg = str(tg)
+        if self.db.get_user_profile(tg) is None:
+            raise ValueError("Пользователь не найден")
+        if item.quantity < qty:
+            raise ValueError(f"Нет в наличии (осталось {item.quantity}, запрос {qty})")
+        
+        with self.lock:
+            cart = self._cart(tg)
+            line = cart.lines.get(item.id)
+            if line is None:
+                cart.lines[item.id] = CartRow(self._new_id(), item.id, item.name, item.size, item.price, qty)
+            elif line.qty + qty > MAX_QTY:
+                raise ValueError(f"Максимум {MAX_QTY} товаров одного вида в корзине")
+            else:
+                cart.lines[item.id] = line._replace(qty=line.qty + qty)
+            cart.dirty = True
+    
+    def clear(self, tg):
+        """Очищает корзину пользователя — сразу и в БД (write-through).
+        
+        Корзину чистит оформление заказа: оставленная до следующего flush,
+        после падения процесса она вернулась бы из БД с теми же id строк, и
+        повторное оформление совпало бы с ключом идемпотентности старого.
+        flush_lock — чтобы flush со снимком до очистки не записал её обратно.
+        """
+        tg = str(tg)
+        with self.flush_lock:
+            with self.lock:
+                cart = self._cart(tg)
+                cart.lines.clear()
+                cart.dirty = False
+            self.db.clear_cart(tg)
+    
+    def flush(self):
+        """Записывает изменённые корзины в БД. Возвращает их число."""
+        with self.flush_lock:
+            with self.lock:
+                dirty = [(tg, cart) for tg, cart in self.carts.items() if cart.dirty]
+                snapshot = [(tg, list(cart.lines.values())) for tg, cart in dirty]
+                for _, cart in dirty:
+                    cart.dirty = False
+            
+            try:
+                if snapshot:
+                    self.db.save_carts(snapshot)
+            except Exception:
+                with self.lock:
+                    for _, cart in dirty:
+                        cart.dirty = True  # Попробуем в следующий раз
+                raise
+            
+            with self.lock:
+                stale = time.monotonic() - self.idle
+                for tg in [tg for tg, cart in self.carts.items()
+                           if not cart.dirty and (not cart.lines or cart.touched < stale)]:
+                    del self.carts[tg]
+        
+        if snapshot:
+            logger.debug(f"Корзины записаны в БД: {len(snapshot)}")
+        return len(snapshot)
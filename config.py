@@ -2,9 +2,76 @@
 
 BOT_TOKEN = "ВСТАВЬ СВОЙ ТОКЕН"
 ADMIN_GROUP_ID = "ВСТАВЬ СВОЙ АЙДИ"   # id группы с админами
-DB_PATH = "database.db"
+DB_PATH = "data.db"          # тот же файл, что по умолчанию у DBManager
 
 # бонусы и скидки (можешь подправить)
 BONUS_PERCENT = 0.05      # начисление баллов как доля от суммы
 MAX_DISCOUNT = 0.15       # максимум скидки (15%)
 REFERRAL_BONUS = 100      # баллов за реферала
+
+# рассылки (лимит Telegram ~30 сообщений/сек на бота)
+BROADCAST_RATE = 25       # сообщений в секунду
+BROADCAST_WORKERS = 4     # потоков отправки
+
+# сверка баланса баллов с журналом points_history
+POINTS_RECONCILE_INTERVAL = 6 * 60 * 60  # секунд
+
+# заказы, не выданные за это время, отменяются автоматически
+ORDER_EXPIRE_HOURS = 24
+ORDER_EXPIRE_INTERVAL = 15 * 60  # секунд между проверками
+
+# резервные копии БД (онлайн, через sqlite3 backup API)
+BACKUP_DIR = "backups"
+BACKUP_INTERVAL = 6 * 60 * 60  # секунд
+BACKUP_KEEP = 14               # сколько последних копий хранить
+
+# админские экраны и отчёты: отдельный пул и read-only соединения
+ADMIN_WORKERS = 2
+ANALYTICS_SNAPSHOT_PATH = None         # например "analytics.db" — копия БД для долгих отчётов
+ANALYTICS_SNAPSHOT_INTERVAL = 30 * 60  # секунд между обновлениями копии
+
+# asyncio-рантайм (bot_async.py)
+ASYNC_DB_WORKERS = 4  # потоков для запросов к БД
+
+# повторные нажатия/доставки callback получают сохранённый ответ в течение TTL
+IDEMPOTENCY_TTL = 24 * 60 * 60  # секунд
+
+# правки одного сообщения (категория, корзина) чаще этого склеиваются в одну
+EDIT_COALESCE = 1.0  # секунд
+
+# запросы к Telegram Bot API (transport.py): общий пул keep-alive соединений
+API_MAX_IN_FLIGHT = 8  # одновременных запросов (и соединений в пуле)
+API_MAX_RETRIES = 3    # повторов после 429 Too Many Requests
+
+# корзины живут в памяти и пишутся в таблицу cart пачкой раз в интервал
+CART_FLUSH_INTERVAL = 5   # секунд (столько изменений теряется при падении)
+CART_IDLE = 30 * 60       # секунд: неактивная корзина выгружается из памяти
+
+# несколько точек в одном боте: {slug: настройки}; у каждой свой файл БД и
+# своя админская группа. Пусто — одна точка с DB_PATH и ADMIN_GROUP_ID.
+# Ссылка на точку: t.me/<бот>?start=<slug> (или <slug>-<реферальный код>)
+SHOPS = {
+    # "center": {"title": "Центр", "db_path": "center.db", "admin_group_id": -1001111111111},
+    # "park": {"title": "Парк", "db_path": "park.db", "admin_group_id": -1002222222222,
+    #          "snapshot_path": "park-analytics.db"},
+}
+TENANTS_DB = "tenants.db"        # привязки чатов покупателей к точкам
+OWNER_CHAT_ID = ADMIN_GROUP_ID   # кому доступна сводка по всем точкам (/shops)
+
+# профилирование по команде /profile <sample|cprofile|memory> [секунд] в админской
+# группе или при запуске: python bot.py --profile sample --profile-seconds 60
+PROFILE_DIR = "profiles"     # куда сохраняются отчёты
+PROFILE_SECONDS = 30         # длительность по умолчанию
+PROFILE_MAX_SECONDS = 600
+PROFILE_INTERVAL = 0.01      # секунд между сэмплами стеков
+
+# «часто берут вместе»: до RECOMMEND_TOP кнопок на странице категории/поиска;
+# пары считаются при выдаче заказа, полный пересчёт — раз в интервал
+RECOMMEND_TOP = 3
+RECOMMEND_REBUILD_INTERVAL = 24 * 60 * 60  # секунд
+
+# остановка (SIGTERM) и перезапуск без простоя (SIGHUP, см. lifecycle.py)
+DRAIN_TIMEOUT = 20       # секунд: дождаться начатых обработчиков и отправок
+HANDOFF_TIMEOUT = 60     # секунд на запуск нового процесса при SIGHUP
+POLL_TIMEOUT = 30        # секунд long polling getUpdates
+NEXT_STEPS_PATH = ".handler-saves/next-steps.save"  # шаги диалогов между процессами
@@ -1,30 +1,168 @@
 # db.py
 # coding: utf-8
+import os
 import sqlite3
 import json
 import logging
+import re
+import urllib.parse
+import time
 from datetime import datetime
-from contextlib import contextmanager
-from threading import Lock
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager, closing
+from threading import Lock, local
+
+import migrations
 
 logger = logging.getLogger(__name__)
 
+
+# =============== ЛЁГКИЕ ЗАПИСИ (FAST PATH) ===============
+
+StockRow = namedtuple('StockRow', 'id category_id name size has_size price quantity')
+CartRow = namedtuple('CartRow', 'id stock_id name size price qty')
+UserRow = namedtuple('UserRow', 'id telegram_id name points referrer_id orders')
+OrderRow = namedtuple('OrderRow', 'id user_id total discount status created_at items')
+OrderItemRow = namedtuple('OrderItemRow', 'order_id name size price qty')
+AuditRow = namedtuple('AuditRow', 'id action user_id details created_at')
+AdjustResult = namedtuple('AdjustResult', 'matched changed version rows')  # rows: [(stock_id, было, стало)]
+
+# Реестр горячих запросов: один и тот же текст SQL -> попадание в кеш
+# подготовленных выражений sqlite3 на соединении потока.
+STATEMENTS = {
+    'stock_by_category': (
+        "SELECT s.id, s.category_id, s.name, s.size, s.has_size, s.price, s.quantity "
+        "FROM stock s JOIN categories c ON s.category_id = c.id "
+        "WHERE c.name = ? ORDER BY s.name"
+    ),
+    'stock_by_category_id': (
+        "SELECT id, category_id, name, size, has_size, price, quantity "
+        "FROM stock WHERE category_id = ? ORDER BY name"
+    ),
+    'stock_item': (
+        "SELECT id, category_id, name, size, has_size, price, quantity "
+        "FROM stock WHERE id = ?"
+    ),
+    'cart_by_tg': (
+        "SELECT c.id, c.stock_id, c.name, c.size, c.price, c.qty "
+        "FROM cart c JOIN users u ON c.user_id = u.id "
+        "WHERE u.telegram_id = ? ORDER BY c.id"
+    ),
+    'user_by_tg': (
+        "SELECT id, telegram_id, name, points, referrer_id, orders "
+        "FROM users WHERE telegram_id = ?"
+    ),
+    'item_pairs_top': (
+        "SELECT s.id, s.category_id, s.name, s.size, s.has_size, s.price, s.quantity "
+        "FROM item_pairs p JOIN stock s ON s.id = p.other_id "
+        "WHERE p.stock_id = ? AND s.quantity > 0 ORDER BY p.count DESC LIMIT ?"
+    ),
+    'stock_search': (
+        "SELECT s.id, s.category_id, s.name, s.size, s.has_size, s.price, s.quantity "
+        "FROM stock_fts f JOIN stock s ON s.id = f.rowid "
+        "WHERE stock_fts MATCH ? AND s.quantity > 0 "
+        "ORDER BY bm25(stock_fts, 10.0, 1.0) LIMIT ?"  # Совпадение в названии весомее категории
+    ),
+    # История заказов: покрывающие индексы idx_orders_user_history / idx_orders_status_created
+    'orders_by_user': (
+        "SELECT o.id, o.user_id, o.total, o.discount, o.status, o.created_at "
+        "FROM orders o WHERE o.user_id = (SELECT id FROM users WHERE telegram_id = ?) "
+        "AND o.id < ? ORDER BY o.id DESC LIMIT ?"
+    ),
+    'orders_by_status': (
+        "SELECT id, user_id, total, discount, status, created_at "
+        "FROM orders WHERE status = ? AND (created_at, id) < (?, ?) "
+        "ORDER BY created_at DESC, id DESC LIMIT ?"
+    ),
+}
+
+# Выгрузки для аналитики: читаются потоково, без загрузки таблицы в память
+EXPORTS = {
+    'orders': (
+        "SELECT o.id, u.telegram_id, o.total, o.discount, o.status, o.created_at, o.completed_at, "
+        "(SELECT SUM(i.qty) FROM order_items i WHERE i.order_id = o.id) AS items "
+        "FROM orders o JOIN users u ON u.id = o.user_id ORDER BY o.id"
+    ),
+    'users': (
+        "SELECT id, telegram_id, name, points, orders, referrer_id, created_at "
+        "FROM users ORDER BY id"
+    ),
+}
+
+# Массовое изменение цен/остатков: новое значение колонки (один параметр ?)
+# и нижняя граница, которую не пропускают CHECK таблицы stock
+ADJUST_EXPR = {
+    'add': "{f} + ?",
+    'percent': "CAST(ROUND({f} * (100 + ?) / 100.0) AS INTEGER)",
+    'set': "?",
+}
+ADJUST_FLOOR = {'price': 1, 'quantity': 0}
+
+# Пары товаров из заказов, выбранных подзапросом {orders}: +1 за каждый заказ с парой
+PAIRS_UPSERT = (
+    "INSERT INTO {table} (stock_id, other_id, count) "
+    "SELECT a.stock_id, b.stock_id, COUNT(DISTINCT a.order_id) "
+    "FROM order_items a JOIN order_items b ON b.order_id = a.order_id AND b.stock_id != a.stock_id "
+    "WHERE a.order_id IN ({orders}) "
+    "GROUP BY a.stock_id, b.stock_id "
+    "ON CONFLICT (stock_id, other_id) DO UPDATE SET count = count + excluded.count"
+)
+
+# Фильтры журнала операций -> условие; order_id, total, referrer, stock_id —
+# колонки audit_log из details (миграции 6-7), у каждой свой индекс
+AUDIT_FILTERS = {
+    'action': "action = ?",
+    'user_id': "user_id = ?",
+    'order_id': "order_id = ?",
+    'stock_id': "stock_id = ?",
+    'referrer': "referrer = ?",
+    'total_min': "total >= ?",
+    'total_max': "total <= ?",
+    'since': "created_at >= ?",
+    'until': "created_at < ?",
+}
+
+# Запас сверх реестра под прочие запросы на том же соединении
+STATEMENT_CACHE_SIZE = len(STATEMENTS) + 64
+
+
+class UserProfile:
+    """Компактный профиль пользователя для кеша (без лишних полей users)."""
+    __slots__ = ('id', 'telegram_id', 'name', 'points', 'orders', 'referrer_id')
+    
+    def __init__(self, id, telegram_id, name, points, orders, referrer_id):
+        self.id = id
+        self.telegram_id = telegram_id
+        self.name = name
+        self.points = points
+        self.orders = orders
+        self.referrer_id = referrer_id
+
+
 class DBManager:
-    def __init__(self, db_path='data.db'):
+    def __init__(self, db_path='data.db', user_cache_size=10000, snapshot_path=None, busy_timeout=30):
         self.db_path = db_path
+        # Сколько запись ждёт чужой write-lock (фоновая миграция строит индекс)
+        # до "database is locked"; у sqlite3 по умолчанию 5 секунд
+        self.busy_timeout = busy_timeout
+        self.snapshot_path = snapshot_path  # Копия БД для долгих отчётов (или None)
+        self._snapshot_gen = 0
         self.lock = Lock()  # Защита от race conditions
+        self.user_cache_size = user_cache_size
+        self._users = OrderedDict()  # {telegram_id: UserProfile}, LRU
+        self._users_lock = Lock()
+        self._local = local()  # Соединение и курсор на поток для fast path
         self._init_db()
     
     def _init_db(self):
-        """Инициализирует БД из models.sql."""
+        """Доводит схему БД до актуальной версии (см. migrations.py)."""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.execute("PRAGMA foreign_keys = ON")
-                conn.execute("PRAGMA journal_mode = WAL")
-                with open('models.sql', 'r', encoding='utf-8') as f:
-                    conn.executescript(f.read())
-                conn.commit()
-            logger.info("БД инициализирована успешно.")
+            start = time.perf_counter()
+            version = migrations.migrate(self.db_path)
+            logger.info(
+                f"БД инициализирована: схема v{version} -> v{migrations.SCHEMA_VERSION}, "
+                f"{(time.perf_counter() - start) * 1000:.1f} мс"
+            )
         except Exception as e:
             logger.error(f"Ошибка инициализации БД: {e}", exc_info=True)
             raise
@@ -32,7 +170,7 @@ class DBManager:
     @contextmanager
     def get_connection(self):
         """Context manager для безопасной работы с БД."""
-        conn = sqlite3.connect(self.db_path)
+        conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout)
         conn.row_factory = sqlite3.Row
         conn.execute("PRAGMA foreign_keys = ON")
         try:
@@ -45,6 +183,58 @@ class DBManager:
         finally:
             conn.close()
     
+    def _read_cursor(self):
+        """Переиспользуемый курсор потока (без row_factory, с кешем выражений)."""
+        cur = getattr(self._local, 'cursor', None)
+        if cur is None:
+            conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout, cached_statements=STATEMENT_CACHE_SIZE)
+            conn.execute("PRAGMA foreign_keys = ON")
+            cur = self._local.cursor = conn.cursor()
+        return cur
+    
+    def _analytics_cursor(self, snapshot=False):
+        """Курсор потока для админских и аналитических чтений.
+        
+        Отдельное соединение mode=ro + query_only: не берёт self.lock и не может
+        ничего записать. snapshot=True читает копию snapshot_path (если она
+        настроена и уже создана), не трогая рабочую БД вовсе.
+        """
+        key = (snapshot, self._snapshot_gen)
+        if getattr(self._local, 'analytics_key', None) != key:
+            old = getattr(self._local, 'analytics', None)
+            if old is not None:
+                old.connection.close()
+            self._local.analytics = self._connect_ro(snapshot, cached_statements=STATEMENT_CACHE_SIZE).cursor()
+            self._local.analytics_key = key
+        return self._local.analytics
+    
+    def _connect_ro(self, snapshot=False, **kwargs):
+        """Новое read-only соединение к рабочей БД или к копии для отчётов."""
+        use_snapshot = snapshot and self.snapshot_path and os.path.exists(self.snapshot_path)
+        path = os.path.abspath(self.snapshot_path if use_snapshot else self.db_path)
+        conn = sqlite3.connect(f"file:{urllib.parse.quote(path)}?mode=ro", uri=True, **kwargs)
+        conn.execute("PRAGMA query_only = ON")
+        return conn
+    
+    def refresh_snapshot(self):
+        """Обновляет копию для отчётов; потоки переоткроют соединения к новому файлу."""
+        if not self.snapshot_path:
+            return None
+        size = self.backup(self.snapshot_path)
+        self._snapshot_gen += 1
+        return size
+    
+    @staticmethod
+    def _dicts(cur, rows):
+        """Строки курсора без row_factory -> список dict по именам колонок."""
+        columns = [d[0] for d in cur.description]
+        return [dict(zip(columns, r)) for r in rows]
+    
+    def _fetch(self, name, params, record):
+        """Выполняет запрос из реестра и упаковывает строки в record."""
+        cur = self._read_cursor()
+        return list(map(record._make, cur.execute(STATEMENTS[name], params).fetchall()))
+    
     # =============== ПОЛЬЗОВАТЕЛИ ===============
     
     def add_user(self, tg_id, name, referrer_tg_id=None):
@@ -61,7 +251,7 @@ class DBManager:
                         if referrer:
                             referrer_id = referrer['id']
                     
-                    conn.execute(
+                    cursor = conn.execute(
                         "INSERT INTO users (telegram_id, name, referrer_id) VALUES (?, ?, ?)",
                         (str(tg_id), name, referrer_id)
                     )
@@ -69,15 +259,22 @@ class DBManager:
                     logger.info(f"Пользователь добавлен: {tg_id} ({name})")
                     
                     # Логирование в audit_log
-                    user_id = conn.execute(
-                        "SELECT id FROM users WHERE telegram_id = ?",
-                        (str(tg_id),)
-                    ).fetchone()['id']
+                    user_id = cursor.lastrowid
                     
                     conn.execute(
                         "INSERT INTO audit_log (action, user_id, details) VALUES (?, ?, ?)",
                         ('user_created', user_id, json.dumps({'name': name, 'referrer': referrer_id}))
                     )
+                    
+                    if referrer_id:
+                        conn.execute(
+                            "INSERT INTO referral_counts (user_id, invited) VALUES (?, 1) "
+                            "ON CONFLICT(user_id) DO UPDATE SET invited = invited + 1",
+                            (referrer_id,)
+                        )
+                
+                # Write-through: новый пользователь сразу попадает в кеш
+                self._cache_user(UserProfile(user_id, str(tg_id), name, 0, 0, referrer_id))
             except sqlite3.IntegrityError:
                 logger.warning(f"Пользователь уже существует: {tg_id}")
             except Exception as e:
@@ -97,6 +294,50 @@ class DBManager:
             logger.error(f"Ошибка получения пользователя {tg_id}: {e}", exc_info=True)
             return None
     
+    def _cache_user(self, profile):
+        """Кладёт профиль в кеш, вытесняя самые старые записи."""
+        with self._users_lock:
+            self._users[profile.telegram_id] = profile
+            self._users.move_to_end(profile.telegram_id)
+            while len(self._users) > self.user_cache_size:
+                self._users.popitem(last=False)
+    
+    def _cached_user(self, tg_id):
+        """Возвращает профиль из кеша или None (без обращения к БД)."""
+        with self._users_lock:
+            profile = self._users.get(str(tg_id))
+            if profile is not None:
+                self._users.move_to_end(profile.telegram_id)
+            return profile
+    
+    def get_user_profile(self, tg_id):
+        """Получает профиль пользователя из кеша (при промахе — из БД)."""
+        profile = self._cached_user(tg_id)
+        if profile is not None:
+            return profile
+        # Промах: чтение и запись в кеш — под self.lock. Иначе списание, прошедшее
+        # между ними (update_points правит только уже закешированный профиль),
+        # оставит в кеше старый баланс до вытеснения
+        with self.lock:
+            profile = self._cached_user(tg_id)
+            if profile is not None:
+                return profile
+            user = self.get_user_row(tg_id)
+            if not user:
+                return None
+            profile = UserProfile(user.id, user.telegram_id, user.name, user.points, user.orders, user.referrer_id)
+            self._cache_user(profile)
+            return profile
+    
+    def get_user_row(self, tg_id):
+        """Получает пользователя как UserRow (fast path, без dict)."""
+        try:
+            rows = self._fetch('user_by_tg', (str(tg_id),), UserRow)
+            return rows[0] if rows else None
+        except Exception as e:
+            logger.error(f"Ошибка получения пользователя {tg_id}: {e}", exc_info=True)
+            return None
+    
     def get_referrer(self, tg_id):
         """Получает telegram_id реферера."""
         try:
@@ -116,38 +357,179 @@ class DBManager:
             logger.error(f"Ошибка получения реферера {tg_id}: {e}", exc_info=True)
             return None
     
-    def update_points(self, tg_id, delta, reason='manual', order_id=None):
-        """Обновляет баллы пользователя (атомарно)."""
+    def update_points(self, tg_id, delta, reason='manual', order_id=None, idem_key=None):
+        """Проводит изменение баллов через журнал points_history (атомарно, идемпотентно).
+        
+        Ключ идемпотентности по умолчанию — "{order_id}:{reason}": повторное
+        начисление по тому же заказу не проводится. Возвращает True, если
+        проводка выполнена, и False для дубликата. Уход баланса в минус —
+        ValueError (без молчаливого обрезания до нуля, чтобы журнал сходился с балансом).
+        """
+        if idem_key is None and order_id is not None:
+            idem_key = f"{order_id}:{reason}"
+        
         with self.lock:
             try:
                 with self.get_connection() as conn:
-                    user = conn.execute(
-                        "SELECT id, points FROM users WHERE telegram_id = ?",
-                        (str(tg_id),)
-                    ).fetchone()
-                    
-                    if not user:
-                        raise ValueError(f"Пользователь не найден: {tg_id}")
-                    
-                    user_id = user['id']
-                    new_points = max(0, user['points'] + delta)  # Баллы не могут быть отрицательными
-                    
-                    conn.execute(
-                        "UPDATE users SET points = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-                        (new_points, user_id)
-                    )
-                    
-                    # Логирование в points_history
-                    conn.execute(
-                        "INSERT INTO points_history (user_id, change, reason, order_id) VALUES (?, ?, ?, ?)",
-                        (user_id, delta, reason, order_id)
-                    )
+                    profile = self._cached_user(tg_id)
+                    if profile is not None:
+                        user_id = profile.id
+                    else:
+                        user = conn.execute(
+                            "SELECT id FROM users WHERE telegram_id = ?",
+                            (str(tg_id),)
+                        ).fetchone()
+                        if not user:
+                            raise ValueError(f"Пользователь не найден: {tg_id}")
+                        user_id = user['id']
                     
-                    logger.info(f"Баллы обновлены: {tg_id}, изменение: {delta}, новое значение: {new_points}")
+                    new_points = self._post_points(conn, user_id, tg_id, delta, reason, order_id, idem_key)
+                    if new_points is None:
+                        return False
+                
+                if profile is not None:
+                    profile.points = new_points
+                return True
             except Exception as e:
                 logger.error(f"Ошибка обновления баллов {tg_id}: {e}", exc_info=True)
                 raise
     
+    def _post_points(self, conn, user_id, tg_id, delta, reason, order_id, idem_key):
+        """Проводка в транзакции conn: журнал + баланс. Новый баланс или None для дубликата."""
+        # Сначала журнал: UNIQUE(idem_key) отсекает повторную проводку
+        try:
+            conn.execute(
+                "INSERT INTO points_history (user_id, change, reason, order_id, idem_key) VALUES (?, ?, ?, ?, ?)",
+                (user_id, delta, reason, order_id, idem_key)
+            )
+        except sqlite3.IntegrityError as e:
+            if 'UNIQUE' not in str(e):
+                raise  # Например, order_id несуществующего заказа
+            logger.warning(f"Повторная проводка баллов пропущена: {tg_id}, ключ {idem_key}")
+            return None
+        
+        row = conn.execute(
+            "UPDATE users SET points = points + ?, updated_at = CURRENT_TIMESTAMP "
+            "WHERE id = ? AND points + ? >= 0 RETURNING points",
+            (delta, user_id, delta)
+        ).fetchone()
+        if row is None:
+            raise ValueError(f"Недостаточно баллов: {tg_id}, изменение {delta}")
+        
+        # Бонус за первый заказ друга: учитываем конверсию реферала
+        if reason == 'referral':
+            conn.execute(
+                "INSERT INTO referral_counts (user_id, converted) VALUES (?, 1) "
+                "ON CONFLICT(user_id) DO UPDATE SET converted = converted + 1",
+                (user_id,)
+            )
+        
+        logger.info(f"Баллы обновлены: {tg_id}, изменение: {delta}, новое значение: {row[0]}")
+        return row[0]
+    
+    def reconcile_points(self, after_user_id=0, batch_size=1000):
+        """Сверяет users.points с суммой журнала для пачки пользователей.
+        
+        Возвращает (расхождения [(user_id, telegram_id, баланс, сумма журнала)], последний id)
+        или ([], None), когда пользователи закончились.
+        """
+        try:
+            rows = self._read_cursor().execute("""
+                SELECT u.id, u.telegram_id, u.points,
+                       (SELECT COALESCE(SUM(p.change), 0) FROM points_history p WHERE p.user_id = u.id)
+                FROM users u
+                WHERE u.id > ?
+                ORDER BY u.id
+                LIMIT ?
+            """, (after_user_id, batch_size)).fetchall()
+        except Exception as e:
+            logger.error(f"Ошибка сверки баллов: {e}", exc_info=True)
+            raise
+        if not rows:
+            return [], None
+        return [r for r in rows if r[2] != r[3]], rows[-1][0]
+    
+    def log_action(self, action, user_id=None, details=None):
+        """Пишет событие в audit_log (details сериализуется в JSON)."""
+        try:
+            with self.get_connection() as conn:
+                conn.execute(
+                    "INSERT INTO audit_log (action, user_id, details) VALUES (?, ?, ?)",
+                    (action, user_id, json.dumps(details, ensure_ascii=False) if details is not None else None)
+                )
+        except Exception as e:
+            logger.error(f"Ошибка записи audit_log {action}: {e}", exc_info=True)
+    
+    # =============== РЕФЕРАЛЫ И ТОПЫ ===============
+    # Keyset-пагинация: cursor — значения сортировки последней строки страницы
+    
+    def get_top_referrers(self, limit=10, cursor=None):
+        """Топ рефереров по числу приглашённых (read-only соединение). cursor = (invited, user_id)."""
+        after = "AND (r.invited, r.user_id) < (?, ?)" if cursor else ""
+        try:
+            cur = self._analytics_cursor()
+            rows = cur.execute(f"""
+                SELECT r.user_id, u.telegram_id, u.name, r.invited, r.converted
+                FROM referral_counts r
+                JOIN users u ON u.id = r.user_id
+                WHERE r.invited > 0 {after}
+                ORDER BY r.invited DESC, r.user_id DESC
+                LIMIT ?
+            """, (*(cursor or ()), limit)).fetchall()
+            return self._dicts(cur, rows)
+        except Exception as e:
+            logger.error(f"Ошибка получения топа рефереров: {e}", exc_info=True)
+            return []
+    
+    def get_top_by_points(self, limit=10, cursor=None):
+        """Топ пользователей по баллам (read-only соединение). cursor = (points, id)."""
+        after = "WHERE (points, id) < (?, ?)" if cursor else ""
+        try:
+            cur = self._analytics_cursor()
+            rows = cur.execute(f"""
+                SELECT id, telegram_id, name, points
+                FROM users
+                {after}
+                ORDER BY points DESC, id DESC
+                LIMIT ?
+            """, (*(cursor or ()), limit)).fetchall()
+            return self._dicts(cur, rows)
+        except Exception as e:
+            logger.error(f"Ошибка получения топа по баллам: {e}", exc_info=True)
+            return []
+    
+    def get_referrals(self, tg_id, limit=10, cursor=None):
+        """Приглашённые пользователем друзья. cursor = id последнего друга."""
+        try:
+            with self.get_connection() as conn:
+                rows = conn.execute("""
+                    SELECT f.id, f.name, f.orders > 0 AS converted, f.created_at
+                    FROM users f
+                    WHERE f.referrer_id = (SELECT id FROM users WHERE telegram_id = ?)
+                      AND f.id > ?
+                    ORDER BY f.id
+                    LIMIT ?
+                """, (str(tg_id), cursor or 0, limit)).fetchall()
+                return [dict(r) for r in rows]
+        except Exception as e:
+            logger.error(f"Ошибка получения рефералов {tg_id}: {e}", exc_info=True)
+            return []
+    
+    def get_referral_counts(self, tg_id):
+        """Счётчики реферальной программы пользователя: (приглашено, с заказом)."""
+        try:
+            with self.get_connection() as conn:
+                row = conn.execute("""
+                    SELECT r.invited, r.converted
+                    FROM referral_counts r
+                    JOIN users u ON u.id = r.user_id
+                    WHERE u.telegram_id = ?
+                """, (str(tg_id),)).fetchone()
+                return (row['invited'], row['converted']) if row else (0, 0)
+        except Exception as e:
+            logger.error(f"Ошибка получения счётчиков рефералов {tg_id}: {e}", exc_info=True)
+            return (0, 0)
+    
     # =============== КАТЕГОРИИ ===============
     
     def get_categories(self):
@@ -230,6 +612,44 @@ class DBManager:
             logger.error(f"Ошибка получения товаров категории {cat_id}: {e}", exc_info=True)
             return []
     
+    def get_stock_row(self, stock_id):
+        """Получает товар как StockRow (fast path)."""
+        try:
+            rows = self._fetch('stock_item', (stock_id,), StockRow)
+            return rows[0] if rows else None
+        except Exception as e:
+            logger.error(f"Ошибка получения товара {stock_id}: {e}", exc_info=True)
+            return None
+    
+    def get_stock_rows_by_category(self, cat_name):
+        """Получает товары категории как список StockRow (fast path)."""
+        try:
+            return self._fetch('stock_by_category', (cat_name,), StockRow)
+        except Exception as e:
+            logger.error(f"Ошибка получения товаров категории {cat_name}: {e}", exc_info=True)
+            return []
+    
+    def get_stock_rows_by_category_id(self, cat_id):
+        """Получает товары категории по ID как список StockRow (fast path)."""
+        try:
+            return self._fetch('stock_by_category_id', (cat_id,), StockRow)
+        except Exception as e:
+            logger.error(f"Ошибка получения товаров категории {cat_id}: {e}", exc_info=True)
+            return []
+    
+    def search_stock(self, query, limit=20):
+        """Поиск доступных товаров по названию и категории (FTS5, префиксы)."""
+        # Каждое слово запроса — префиксный терм в кавычках (без синтаксиса FTS от пользователя)
+        terms = re.findall(r"\w+", query.lower())
+        if not terms:
+            return []
+        match = " ".join(f'"{t}"*' for t in terms[:8])
+        try:
+            return self._fetch('stock_search', (match, limit), StockRow)
+        except Exception as e:
+            logger.error(f"Ошибка поиска товаров '{query}': {e}", exc_info=True)
+            return []
+    
     def reduce_stock(self, stock_id, qty):
         """Уменьшает количество товара на складе."""
         with self.lock:
@@ -254,6 +674,126 @@ class DBManager:
                 logger.error(f"Ошибка уменьшения склада {stock_id}: {e}", exc_info=True)
                 raise
     
+    def reduce_stock_bulk(self, lines):
+        """Списывает со склада сразу все позиции заказа (всё или ничего).
+        
+        lines: [(stock_id, qty), ...]. Возвращает список нехватающих позиций
+        [(stock_id, нужно, осталось), ...]; пустой список — списание выполнено.
+        """
+        needed = {}
+        for stock_id, qty in lines:
+            needed[stock_id] = needed.get(stock_id, 0) + qty
+        if not needed:
+            return []
+        
+        with self.lock:
+            try:
+                with self.get_connection() as conn:
+                    # Блокировка записи на всю проверку + списание
+                    conn.execute("BEGIN IMMEDIATE")
+                    return self._take_stock(conn, needed)
+            except Exception as e:
+                logger.error(f"Ошибка пакетного списания склада {needed}: {e}", exc_info=True)
+                raise
+    
+    @staticmethod
+    def _take_stock(conn, needed):
+        """Проверка и списание {stock_id: qty} в транзакции conn. Нехватающие позиции или []."""
+        placeholders = ",".join("?" * len(needed))
+        available = dict(conn.execute(
+            f"SELECT id, quantity FROM stock WHERE id IN ({placeholders})",
+            tuple(needed)
+        ).fetchall())
+        
+        short = [
+            (stock_id, qty, available.get(stock_id, 0))
+            for stock_id, qty in needed.items()
+            if available.get(stock_id, 0) < qty
+        ]
+        if short:
+            logger.warning(f"Недостаточно товара при списании: {short}")
+            return short
+        
+        conn.executemany(
+            "UPDATE stock SET quantity = quantity - ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+            [(qty, stock_id) for stock_id, qty in needed.items()]
+        )
+        
+        logger.info(f"Склад обновлён пакетно: {needed}")
+        return []
+    
+    def bulk_adjust(self, field, mode, value, category_id=None, stock_ids=None, name_like=None):
+        """Массово меняет цену или остаток выбранных товаров одним UPDATE.
+        
+        field: 'price' | 'quantity'; mode: 'add' — прибавить value (может быть
+        отрицательным), 'percent' — изменить на value процентов, 'set' —
+        установить value. Цена не опускается ниже 1, остаток — ниже 0.
+        Товары: category_id, список stock_ids, подстрока названия name_like
+        (условия складываются; без условий — весь каталог).
+        
+        Каждое изменение — строка audit_log, версия каталога растёт на 1.
+        Возвращает AdjustResult.
+        """
+        if field not in ADJUST_FLOOR or mode not in ADJUST_EXPR:
+            raise ValueError(f"Неизвестное изменение: {field} {mode}")
+        floor = ADJUST_FLOOR[field]
+        if mode == 'set' and value < floor:
+            raise ValueError(f"Значение должно быть не меньше {floor}")
+        
+        where, params = ["1"], []
+        if category_id is not None:
+            where.append("category_id = ?")
+            params.append(category_id)
+        if stock_ids is not None:
+            # Список любой длины — одним параметром, без лимита переменных SQLite
+            where.append("id IN (SELECT value FROM json_each(?))")
+            params.append(json.dumps(list(stock_ids)))
+        if name_like:
+            where.append("name LIKE ? ESCAPE '\\'")
+            params.append("%" + re.sub(r"([%_\\])", r"\\\1", name_like) + "%")
+        where = " AND ".join(where)
+        new = f"MAX({floor}, {ADJUST_EXPR[mode].format(f=field)})"
+        action = f"{'price' if field == 'price' else 'stock'}_bulk_adjust"
+        
+        with self.lock:
+            try:
+                with self.get_connection() as conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    old = dict(conn.execute(f"SELECT id, {field} FROM stock WHERE {where}", params).fetchall())
+                    changed = conn.execute(
+                        f"UPDATE stock SET {field} = {new}, updated_at = CURRENT_TIMESTAMP "
+                        f"WHERE {where} AND {field} != {new} RETURNING id, {field}",
+                        (value, *params, value)
+                    ).fetchall()
+                    rows = sorted((stock_id, old[stock_id], v) for stock_id, v in changed)
+                    
+                    if rows:
+                        version = conn.execute(
+                            "UPDATE catalog_version SET version = version + 1 RETURNING version"
+                        ).fetchone()[0]
+                        conn.executemany(
+                            "INSERT INTO audit_log (action, details) VALUES (?, ?)",
+                            [
+                                (action, json.dumps({'stock_id': i, 'old': o, 'new': n, 'version': version}))
+                                for i, o, n in rows
+                            ]
+                        )
+                    else:
+                        version = conn.execute("SELECT version FROM catalog_version").fetchone()[0]
+                    
+                    logger.info(
+                        f"Массовое изменение {field} ({mode} {value}): "
+                        f"подходит {len(old)}, изменено {len(rows)}, версия каталога {version}"
+                    )
+                    return AdjustResult(len(old), len(rows), version, rows)
+            except Exception as e:
+                logger.error(f"Ошибка массового изменения {field} ({mode} {value}): {e}", exc_info=True)
+                raise
+    
+    def get_catalog_version(self):
+        """Номер версии каталога (растёт при массовых изменениях цен/остатков)."""
+        return self._read_cursor().execute("SELECT version FROM catalog_version").fetchone()[0]
+    
     # =============== КОРЗИНА ===============
     
     def add_to_cart(self, tg_id, stock_id, qty):
@@ -326,6 +866,14 @@ class DBManager:
             logger.error(f"Ошибка получения корзины {tg_id}: {e}", exc_info=True)
             return []
     
+    def get_cart_rows(self, tg_id):
+        """Получает корзину как список CartRow одним запросом (fast path)."""
+        try:
+            return self._fetch('cart_by_tg', (str(tg_id),), CartRow)
+        except Exception as e:
+            logger.error(f"Ошибка получения корзины {tg_id}: {e}", exc_info=True)
+            return []
+    
     def clear_cart(self, tg_id):
         """Очищает корзину пользователя."""
         with self.lock:
@@ -343,9 +891,49 @@ class DBManager:
                 logger.error(f"Ошибка очистки корзины {tg_id}: {e}", exc_info=True)
                 raise
     
+    def save_carts(self, carts):
+        """Записывает корзины из памяти (carts.py) одной транзакцией.
+        
+        carts — [(telegram_id, [CartRow, ...])]: корзина каждого пользователя
+        заменяется целиком. Строки удалённых товаров/пользователей пропускаются.
+        """
+        with self.lock:
+            with self.get_connection() as conn:
+                conn.executemany(
+                    "DELETE FROM cart WHERE user_id = (SELECT id FROM users WHERE telegram_id = ?)",
+                    [(tg,) for tg, _ in carts]
+                )
+                conn.executemany(
+                    "INSERT INTO cart (id, user_id, stock_id, name, size, price, qty) "
+                    "SELECT ?, u.id, ?, ?, ?, ?, ? FROM users u "
+                    "WHERE u.telegram_id = ? AND EXISTS (SELECT 1 FROM stock WHERE id = ?)",
+                    [(r.id, r.stock_id, r.name, r.size, r.price, r.qty, tg, r.stock_id)
+                     for tg, rows in carts for r in rows]
+                )
+    
+    def reserve_cart_ids(self, count):
+        """Резервирует count ID строк корзины. Возвращает первый.
+        
+        Счётчик AUTOINCREMENT (sqlite_sequence) не уменьшается после удаления
+        строк, поэтому ID не повторяются и после перезапуска.
+        """
+        with self.lock:
+            with self.get_connection() as conn:
+                row = conn.execute(
+                    "UPDATE sqlite_sequence SET seq = seq + ? WHERE name = 'cart' RETURNING seq",
+                    (count,)
+                ).fetchone()
+                if row is None:
+                    row = conn.execute(
+                        "INSERT INTO sqlite_sequence (name, seq) "
+                        "SELECT 'cart', COALESCE(MAX(id), 0) + ? FROM cart RETURNING seq",
+                        (count,)
+                    ).fetchone()
+                return row['seq'] - count + 1
+    
     # =============== ЗАКАЗЫ (С ТРАНЗАКЦИЯМИ) ===============
     
-    def create_order(self, tg_id, items, total):
+    def create_order(self, tg_id, items, total, discount=0):
         """Создаёт заказ (АТОМАРНАЯ ОПЕРАЦИЯ)."""
         with self.lock:
             try:
@@ -358,37 +946,592 @@ class DBManager:
                     if not user:
                         raise ValueError("Пользователь не найден")
                     
-                    user_id = user['id']
+                    order_id = self._insert_order(conn, user['id'], tg_id, items, total, discount)
+                
+                profile = self._cached_user(tg_id)
+                if profile is not None:
+                    profile.orders += 1
+                return order_id
+            except Exception as e:
+                logger.error(f"Ошибка создания заказа {tg_id}: {e}", exc_info=True)
+                raise
+    
+    def checkout(self, tg_id, items, total, discount=0):
+        """Списание склада, заказ и списание скидки баллами — одна транзакция.
+        
+        Возвращает (order_id, []) или (None, нехватающие позиции [(stock_id,
+        нужно, осталось)]). Нехватка баллов на скидку — ValueError; в обоих
+        случаях ничего не списано и заказа нет.
+        """
+        needed = {}
+        for item in items:
+            needed[item['stock_id']] = needed.get(item['stock_id'], 0) + item['qty']
+        
+        with self.lock:
+            try:
+                with self.get_connection() as conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    user = conn.execute(
+                        "SELECT id FROM users WHERE telegram_id = ?",
+                        (str(tg_id),)
+                    ).fetchone()
+                    if not user:
+                        raise ValueError("Пользователь не найден")
                     
-                    # Создание заказа
-                    cursor = conn.execute(
-                        "INSERT INTO orders (user_id, total, status) VALUES (?, ?, 'pending')",
-                        (user_id, total)
-                    )
-                    order_id = cursor.lastrowid
+                    short = self._take_stock(conn, needed)
+                    if short:
+                        return None, short
+                    order_id = self._insert_order(conn, user['id'], tg_id, items, total, discount)
+                    points = None
+                    if discount > 0:
+                        points = self._post_points(
+                            conn, user['id'], tg_id, -discount, 'discount', order_id, f"{order_id}:discount"
+                        )
+                
+                profile = self._cached_user(tg_id)
+                if profile is not None:
+                    profile.orders += 1
+                    if points is not None:
+                        profile.points = points
+                return order_id, []
+            except Exception as e:
+                logger.error(f"Ошибка оформления заказа {tg_id}: {e}", exc_info=True)
+                raise
+    
+    @staticmethod
+    def _insert_order(conn, user_id, tg_id, items, total, discount):
+        """Заказ, его позиции, счётчик заказов и audit_log в транзакции conn. Возвращает id заказа."""
+        # Создание заказа
+        cursor = conn.execute(
+            "INSERT INTO orders (user_id, total, discount, status) VALUES (?, ?, ?, 'pending')",
+            (user_id, total, discount)
+        )
+        order_id = cursor.lastrowid
+        
+        # Добавление позиций заказа (stock_id нужен для возврата на склад при отмене)
+        conn.executemany(
+            "INSERT INTO order_items (order_id, stock_id, name, size, price, qty) VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (order_id, item.get('stock_id'), item['name'], item['size'], item['price'], item['qty'])
+                for item in items
+            ]
+        )
+        
+        # Обновление счётчика заказов
+        conn.execute(
+            "UPDATE users SET orders = orders + 1 WHERE id = ?",
+            (user_id,)
+        )
+        
+        # Логирование
+        conn.execute(
+            "INSERT INTO audit_log (action, user_id, details) VALUES (?, ?, ?)",
+            ('order_created', user_id, json.dumps({'order_id': order_id, 'total': total}))
+        )
+        
+        logger.info(f"Заказ создан: {order_id}, пользователь {tg_id}, сумма {total}")
+        return order_id
+    
+    # =============== ЖИЗНЕННЫЙ ЦИКЛ ЗАКАЗА ===============
+    # Переходы только из 'pending': повторное нажатие кнопки или гонка
+    # с автоотменой не меняют уже закрытый заказ.
+    
+    def complete_orders(self, order_ids):
+        """Переводит заказы в 'completed'. Возвращает [(order_id, telegram_id)] реально закрытых."""
+        order_ids = list(order_ids)
+        if not order_ids:
+            return []
+        
+        placeholders = ",".join("?" * len(order_ids))
+        with self.lock:
+            try:
+                with self.get_connection() as conn:
+                    done = conn.execute(f"""
+                        UPDATE orders SET status = 'completed', completed_at = CURRENT_TIMESTAMP
+                        WHERE status = 'pending' AND id IN ({placeholders})
+                        RETURNING id, (SELECT telegram_id FROM users WHERE users.id = orders.user_id)
+                    """, order_ids).fetchall()
+                    done = [tuple(r) for r in done]
                     
-                    # Добавление позиций заказа
-                    for item in items:
+                    conn.executemany(
+                        "INSERT INTO audit_log (action, details) VALUES ('order_completed', ?)",
+                        [(json.dumps({'order_id': oid}),) for oid, _ in done]
+                    )
+                    if done:
                         conn.execute(
-                            "INSERT INTO order_items (order_id, name, size, price, qty) VALUES (?, ?, ?, ?, ?)",
-                            (order_id, item['name'], item['size'], item['price'], item['qty'])
+                            PAIRS_UPSERT.format(table="item_pairs", orders=",".join("?" * len(done))),
+                            [oid for oid, _ in done]
                         )
+                    logger.info(f"Заказы выданы: {[oid for oid, _ in done]}")
+                    return done
+            except Exception as e:
+                logger.error(f"Ошибка закрытия заказов {order_ids}: {e}", exc_info=True)
+                raise
+    
+    def cancel_orders(self, order_ids, reason='cancel'):
+        """Отменяет заказы одной транзакцией: возврат товара на склад и откат баллов.
+        
+        Баллы покупателя по заказу (списанная скидка и начисление за покупку)
+        сторнируются проводкой с ключом "{order_id}:{reason}". Если начисленные
+        баллы уже потрачены, забирается не больше текущего баланса — журнал
+        фиксирует фактическую сумму. Реферальный бонус не отзывается.
+        Возвращает [(order_id, telegram_id, изменение баллов)] реально отменённых.
+        """
+        order_ids = list(order_ids)
+        if not order_ids:
+            return []
+        
+        placeholders = ",".join("?" * len(order_ids))
+        with self.lock:
+            try:
+                with self.get_connection() as conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    cancelled = conn.execute(f"""
+                        UPDATE orders SET status = 'cancelled', completed_at = CURRENT_TIMESTAMP
+                        WHERE status = 'pending' AND id IN ({placeholders})
+                        RETURNING id, user_id
+                    """, order_ids).fetchall()
+                    cancelled = [tuple(r) for r in cancelled]
+                    if not cancelled:
+                        return []
                     
-                    # Обновление счётчика заказов
-                    conn.execute(
-                        "UPDATE users SET orders = orders + 1 WHERE id = ?",
-                        (user_id,)
-                    )
+                    ids = [oid for oid, _ in cancelled]
+                    placeholders = ",".join("?" * len(ids))
                     
-                    # Логирование
-                    conn.execute(
-                        "INSERT INTO audit_log (action, user_id, details) VALUES (?, ?, ?)",
-                        ('order_created', user_id, json.dumps({'order_id': order_id, 'total': total}))
+                    # Склад: одна агрегирующая выборка + пакетное обновление
+                    restock = conn.execute(f"""
+                        SELECT stock_id, SUM(qty) FROM order_items
+                        WHERE order_id IN ({placeholders}) AND stock_id IS NOT NULL
+                        GROUP BY stock_id
+                    """, ids).fetchall()
+                    conn.executemany(
+                        "UPDATE stock SET quantity = quantity + ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                        [(qty, stock_id) for stock_id, qty in restock]
                     )
                     
-                    logger.info(f"Заказ создан: {order_id}, пользователь {tg_id}, сумма {total}")
+                    # Баллы: сумма проводок покупателя по каждому заказу
+                    ledger = dict(conn.execute(f"""
+                        SELECT p.order_id, SUM(p.change) FROM points_history p
+                        JOIN orders o ON o.id = p.order_id AND o.user_id = p.user_id
+                        WHERE p.order_id IN ({placeholders})
+                        GROUP BY p.order_id
+                    """, ids).fetchall())
+                    
+                    result, balances = [], {}
+                    for oid, user_id in cancelled:
+                        change = -(ledger.get(oid) or 0)
+                        if change:
+                            # Не уводим баланс в минус: забираем максимум доступного
+                            change = conn.execute(
+                                "SELECT MAX(?, -points) FROM users WHERE id = ?", (change, user_id)
+                            ).fetchone()[0]
+                        if change:
+                            conn.execute(
+                                "INSERT INTO points_history (user_id, change, reason, order_id, idem_key) VALUES (?, ?, ?, ?, ?)",
+                                (user_id, change, reason, oid, f"{oid}:{reason}")
+                            )
+                            tg, balances[tg] = conn.execute(
+                                "UPDATE users SET points = points + ?, updated_at = CURRENT_TIMESTAMP "
+                                "WHERE id = ? RETURNING telegram_id, points",
+                                (change, user_id)
+                            ).fetchone()
+                        else:
+                            tg = conn.execute("SELECT telegram_id FROM users WHERE id = ?", (user_id,)).fetchone()[0]
+                        result.append((oid, tg, change))
                     
-                    return order_id
+                    conn.executemany(
+                        "INSERT INTO audit_log (action, user_id, details) VALUES ('order_cancelled', ?, ?)",
+                        [
+                            (user_id, json.dumps({'order_id': oid, 'reason': reason, 'points': change}))
+                            for (oid, user_id), (_, _, change) in zip(cancelled, result)
+                        ]
+                    )
+                    logger.info(f"Заказы отменены ({reason}): {ids}, возврат на склад: {restock}")
+                
+                # Write-through баланса в кеш профилей
+                for tg, points in balances.items():
+                    profile = self._cached_user(tg)
+                    if profile is not None:
+                        profile.points = points
+                return result
             except Exception as e:
-                logger.error(f"Ошибка создания заказа {tg_id}: {e}", exc_info=True)
+                logger.error(f"Ошибка отмены заказов {order_ids}: {e}", exc_info=True)
+                raise
+    
+    def get_stale_order_ids(self, max_age_hours, limit=200):
+        """ID заказов в 'pending' старше max_age_hours (по индексу status, created_at)."""
+        try:
+            rows = self._read_cursor().execute(
+                "SELECT id FROM orders WHERE status = 'pending' AND created_at < datetime('now', ?) "
+                "ORDER BY created_at, id LIMIT ?",
+                (f"-{max_age_hours} hours", limit)
+            ).fetchall()
+            return [r[0] for r in rows]
+        except Exception as e:
+            logger.error(f"Ошибка поиска просроченных заказов: {e}", exc_info=True)
+            return []
+    
+    # =============== ИСТОРИЯ ЗАКАЗОВ (KEYSET) ===============
+    # Курсор — ключ сортировки последнего заказа страницы, поэтому каждая
+    # следующая страница стоит столько же, сколько первая (без OFFSET).
+    
+    def _orders_with_items(self, cur, orders):
+        """Подтягивает позиции для страницы заказов одним IN-запросом."""
+        if not orders:
+            return []
+        placeholders = ",".join("?" * len(orders))
+        items = {}
+        for row in cur.execute(
+            f"SELECT order_id, name, size, price, qty FROM order_items "
+            f"WHERE order_id IN ({placeholders}) ORDER BY order_id, id",
+            tuple(o[0] for o in orders)
+        ).fetchall():
+            items.setdefault(row[0], []).append(OrderItemRow._make(row))
+        return [OrderRow(*o, items.get(o[0], [])) for o in orders]
+    
+    def get_user_orders(self, tg_id, limit=10, cursor=None):
+        """Заказы пользователя, новые сверху. cursor = id последнего заказа страницы."""
+        try:
+            cur = self._read_cursor()
+            orders = cur.execute(
+                STATEMENTS['orders_by_user'],
+                (str(tg_id), cursor or 2 ** 63 - 1, limit)
+            ).fetchall()
+            return self._orders_with_items(cur, orders)
+        except Exception as e:
+            logger.error(f"Ошибка получения истории заказов {tg_id}: {e}", exc_info=True)
+            return []
+    
+    def get_orders_by_status(self, status='pending', limit=10, cursor=None):
+        """Заказы в статусе status, новые сверху (админский экран, read-only). cursor = (created_at, id)."""
+        # Без курсора — «бесконечно новый» ключ, чтобы текст SQL не менялся
+        created_at, order_id = cursor or ('9999-12-31', 0)
+        try:
+            cur = self._analytics_cursor()
+            orders = cur.execute(
+                STATEMENTS['orders_by_status'],
+                (status, created_at, order_id, limit)
+            ).fetchall()
+            return self._orders_with_items(cur, orders)
+        except Exception as e:
+            logger.error(f"Ошибка получения заказов {status}: {e}", exc_info=True)
+            return []
+    
+    # =============== РЕКОМЕНДАЦИИ ===============
+    
+    def get_recommendations(self, stock_id, limit=3):
+        """Товары в наличии, чаще всего покупаемые вместе с stock_id (StockRow)."""
+        try:
+            return self._fetch('item_pairs_top', (stock_id, limit), StockRow)
+        except Exception as e:
+            logger.error(f"Ошибка рекомендаций для {stock_id}: {e}", exc_info=True)
+            return []
+    
+    def rebuild_item_pairs(self, batch_size=5000, pause=0.05, if_empty=False):
+        """Пересчитывает item_pairs по всем выданным заказам. Возвращает число пар.
+        
+        Заказы считаются пачками по batch_size во временную таблицу соединения
+        (рабочая БД в это время не заблокирована), затем одна короткая
+        транзакция подменяет item_pairs и досчитывает заказы, выданные за время
+        пересчёта. if_empty=True — только если item_pairs ещё пуста.
+        """
+        start = time.perf_counter()
+        with closing(sqlite3.connect(self.db_path, timeout=30, isolation_level=None)) as conn:
+            if if_empty and conn.execute("SELECT EXISTS (SELECT 1 FROM item_pairs)").fetchone()[0]:
+                return None
+            conn.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS pairs_rebuild ("
+                "stock_id INTEGER NOT NULL, other_id INTEGER NOT NULL, count INTEGER NOT NULL, "
+                "PRIMARY KEY (stock_id, other_id)) WITHOUT ROWID"
+            )
+            conn.execute("DELETE FROM temp.pairs_rebuild")
+            # Граница: заказы, выданные до since, — пачками; после — при подмене
+            since = conn.execute("SELECT CURRENT_TIMESTAMP").fetchone()[0]
+            batch = (
+                "SELECT id FROM orders WHERE status = 'completed' AND completed_at < ? "
+                "AND id > ? AND id <= ?"
+            )
+            last_id, orders = 0, 0
+            while True:
+                row = conn.execute(
+                    "SELECT MAX(id), COUNT(*) FROM (SELECT id FROM orders WHERE status = 'completed' "
+                    "AND completed_at < ? AND id > ? ORDER BY id LIMIT ?)",
+                    (since, last_id, batch_size)
+                ).fetchone()
+                if not row[1]:
+                    break
+                conn.execute(
+                    PAIRS_UPSERT.format(table="temp.pairs_rebuild", orders=batch), (since, last_id, row[0])
+                )
+                last_id, orders = row[0], orders + row[1]
+                time.sleep(pause)  # Отдаём диск рабочим запросам
+            
+            with self.lock:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    conn.execute("DELETE FROM item_pairs")
+                    conn.execute("INSERT INTO item_pairs SELECT stock_id, other_id, count FROM temp.pairs_rebuild")
+                    conn.execute(
+                        PAIRS_UPSERT.format(
+                            table="item_pairs",
+                            orders="SELECT id FROM orders WHERE status = 'completed' AND completed_at >= ?"
+                        ),
+                        (since,)
+                    )
+                    pairs = conn.execute("SELECT COUNT(*) FROM item_pairs").fetchone()[0]
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+            conn.execute("DROP TABLE temp.pairs_rebuild")
+        
+        logger.info(
+            f"Рекомендации пересчитаны: {orders} заказов, {pairs} пар, "
+            f"{time.perf_counter() - start:.2f}s"
+        )
+        return pairs
+    
+    # =============== ЖУРНАЛ ОПЕРАЦИЙ (KEYSET) ===============
+    
+    def query_audit(self, filters=None, cursor=None, limit=20):
+        """Записи audit_log, новые сверху (read-only). cursor = (created_at, id).
+        
+        filters — {ключ AUDIT_FILTERS: значение}, условия складываются.
+        """
+        where, params = [], []
+        for key in sorted(filters or {}):  # Один набор фильтров — один текст SQL
+            if key not in AUDIT_FILTERS:
+                raise ValueError(f"Неизвестный фильтр журнала: {key}")
+            where.append(AUDIT_FILTERS[key])
+            params.append(filters[key])
+        created_at, log_id = cursor or ('9999-12-31', 0)
+        where.append("(created_at, id) < (?, ?)")
+        try:
+            cur = self._analytics_cursor()
+            rows = cur.execute(
+                "SELECT id, action, user_id, details, created_at FROM audit_log "
+                f"WHERE {' AND '.join(where)} ORDER BY created_at DESC, id DESC LIMIT ?",
+                (*params, created_at, log_id, limit)
+            ).fetchall()
+            return list(map(AuditRow._make, rows))
+        except Exception as e:
+            logger.error(f"Ошибка чтения журнала {filters}: {e}", exc_info=True)
+            return []
+    
+    # =============== РАССЫЛКИ ===============
+    
+    def create_broadcast(self, text):
+        """Создаёт задание рассылки, возвращает его ID."""
+        with self.lock:
+            try:
+                with self.get_connection() as conn:
+                    cursor = conn.execute("INSERT INTO broadcasts (text) VALUES (?)", (text,))
+                    conn.execute(
+                        "INSERT INTO audit_log (action, details) VALUES (?, ?)",
+                        ('broadcast_created', json.dumps({'broadcast_id': cursor.lastrowid}))
+                    )
+                    logger.info(f"Рассылка создана: {cursor.lastrowid}")
+                    return cursor.lastrowid
+            except Exception as e:
+                logger.error(f"Ошибка создания рассылки: {e}", exc_info=True)
                 raise
+    
+    def get_running_broadcasts(self):
+        """Незавершённые рассылки (для продолжения после рестарта)."""
+        try:
+            with self.get_connection() as conn:
+                rows = conn.execute(
+                    "SELECT * FROM broadcasts WHERE status = 'running' ORDER BY id"
+                ).fetchall()
+                return [dict(r) for r in rows]
+        except Exception as e:
+            logger.error(f"Ошибка получения рассылок: {e}", exc_info=True)
+            return []
+    
+    def iter_recipients(self, after_user_id=0, batch_size=500):
+        """Построчно отдаёт (users.id, telegram_id) пачками по ключу id.
+        
+        Каждая пачка — отдельный короткий запрос: долгий открытый курсор
+        держал бы read-транзакцию и мешал WAL-checkpoint на всё время рассылки.
+        """
+        conn = sqlite3.connect(self.db_path)
+        try:
+            while True:
+                batch = conn.execute(
+                    "SELECT id, telegram_id FROM users WHERE id > ? ORDER BY id LIMIT ?",
+                    (after_user_id, batch_size)
+                ).fetchall()
+                if not batch:
+                    return
+                yield batch
+                after_user_id = batch[-1][0]
+        finally:
+            conn.close()
+    
+    def update_broadcast_progress(self, broadcast_id, last_user_id, sent, failed, status='running'):
+        """Сохраняет прогресс рассылки (вызывается после каждой пачки)."""
+        try:
+            with self.get_connection() as conn:
+                conn.execute("""
+                    UPDATE broadcasts
+                    SET last_user_id = ?, sent = sent + ?, failed = failed + ?, status = ?,
+                        finished_at = CASE WHEN ? = 'running' THEN NULL ELSE CURRENT_TIMESTAMP END
+                    WHERE id = ?
+                """, (last_user_id, sent, failed, status, status, broadcast_id))
+        except Exception as e:
+            logger.error(f"Ошибка сохранения прогресса рассылки {broadcast_id}: {e}", exc_info=True)
+            raise
+    
+    # =============== ТОКЕНЫ CALLBACK ===============
+    
+    def save_callback_token(self, token, payload):
+        """Сохраняет payload кнопки, не влезающий в callback_data."""
+        try:
+            with self.get_connection() as conn:
+                conn.execute(
+                    "INSERT INTO callback_tokens (token, payload) VALUES (?, ?)",
+                    (token, payload)
+                )
+        except Exception as e:
+            logger.error(f"Ошибка сохранения callback-токена: {e}", exc_info=True)
+            raise
+    
+    def load_callback_token(self, token):
+        """Возвращает payload по токену или None."""
+        try:
+            row = self._read_cursor().execute(
+                "SELECT payload FROM callback_tokens WHERE token = ?", (token,)
+            ).fetchone()
+            return row[0] if row else None
+        except Exception as e:
+            logger.error(f"Ошибка чтения callback-токена {token}: {e}", exc_info=True)
+            return None
+    
+    def purge_callback_tokens(self, max_age_days=30):
+        """Удаляет токены старых кнопок."""
+        with self.get_connection() as conn:
+            deleted = conn.execute(
+                "DELETE FROM callback_tokens WHERE created_at < datetime('now', ?)",
+                (f"-{int(max_age_days)} days",)
+            ).rowcount
+        logger.info(f"Удалено callback-токенов: {deleted}")
+        return deleted
+    
+    # =============== ИДЕМПОТЕНТНОСТЬ CALLBACK ===============
+    
+    def claim_callback(self, key, stale_seconds=300):
+        """Занимает ключ обработки. Возвращает (занят_нами, сохранённый ответ или None).
+        
+        Ключ без ответа старше stale_seconds считается брошенным (процесс упал
+        посреди обработки) и занимается заново.
+        """
+        try:
+            with self.get_connection() as conn:
+                if conn.execute(
+                    "INSERT OR IGNORE INTO processed_callbacks (key) VALUES (?)", (key,)
+                ).rowcount:
+                    return True, None
+                
+                if conn.execute(
+                    "UPDATE processed_callbacks SET created_at = CURRENT_TIMESTAMP "
+                    "WHERE key = ? AND result IS NULL AND created_at < datetime('now', ?)",
+                    (key, f"-{int(stale_seconds)} seconds")
+                ).rowcount:
+                    logger.warning(f"Повторно занят брошенный ключ обработки: {key}")
+                    return True, None
+                
+                row = conn.execute("SELECT result FROM processed_callbacks WHERE key = ?", (key,)).fetchone()
+                return False, row['result'] if row else None
+        except Exception as e:
+            logger.error(f"Ошибка захвата ключа обработки {key}: {e}", exc_info=True)
+            raise
+    
+    def finish_callback(self, key, result):
+        """Сохраняет ответ по ключу (result=None — освободить ключ для повторной попытки)."""
+        try:
+            with self.get_connection() as conn:
+                if result is None:
+                    conn.execute("DELETE FROM processed_callbacks WHERE key = ?", (key,))
+                else:
+                    conn.execute("UPDATE processed_callbacks SET result = ? WHERE key = ?", (result, key))
+        except Exception as e:
+            logger.error(f"Ошибка сохранения ключа обработки {key}: {e}", exc_info=True)
+    
+    def store_callback(self, key, result):
+        """Записывает ответ по ключу без захвата (перезаписывает прежний)."""
+        try:
+            with self.get_connection() as conn:
+                conn.execute(
+                    "INSERT INTO processed_callbacks (key, result) VALUES (?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET result = excluded.result, created_at = CURRENT_TIMESTAMP",
+                    (key, result)
+                )
+        except Exception as e:
+            logger.error(f"Ошибка сохранения ключа обработки {key}: {e}", exc_info=True)
+    
+    def get_callback_result(self, key):
+        """Сохранённый ответ по ключу или None."""
+        row = self._read_cursor().execute(
+            "SELECT result FROM processed_callbacks WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+    
+    def purge_processed_callbacks(self, max_age_seconds):
+        """Удаляет ключи обработки старше TTL."""
+        with self.get_connection() as conn:
+            deleted = conn.execute(
+                "DELETE FROM processed_callbacks WHERE created_at < datetime('now', ?)",
+                (f"-{int(max_age_seconds)} seconds",)
+            ).rowcount
+        logger.info(f"Удалено ключей обработки callback: {deleted}")
+        return deleted
+    
+    # =============== РЕЗЕРВНЫЕ КОПИИ И ВЫГРУЗКИ ===============
+    
+    def backup(self, dest_path, pages=1024, sleep=0.01):
+        """Онлайн-копия БД через sqlite3 backup API (в отличие от cp — без рваных страниц WAL).
+        
+        Копирует по pages страниц с паузой sleep между шагами. Источник держит
+        одну read-транзакцию (снимок WAL): писатели не ждут, а backup не
+        начинается заново после каждой чужой записи. Копия сначала пишется во
+        временный файл и проверяется quick_check, затем атомарно переименовывается.
+        """
+        tmp_path = dest_path + '.tmp'
+        start = time.perf_counter()
+        try:
+            with closing(sqlite3.connect(self.db_path, isolation_level=None)) as src, \
+                    closing(sqlite3.connect(tmp_path)) as dst:
+                src.execute("BEGIN")
+                src.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()  # Фиксируем снимок
+                src.backup(dst, pages=pages, sleep=sleep)
+                src.execute("COMMIT")
+                check = dst.execute("PRAGMA quick_check").fetchone()[0]
+                if check != 'ok':
+                    raise sqlite3.DatabaseError(f"Копия не прошла quick_check: {check}")
+            os.replace(tmp_path, dest_path)
+        except Exception as e:
+            logger.error(f"Ошибка резервного копирования в {dest_path}: {e}", exc_info=True)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        
+        size = os.path.getsize(dest_path)
+        logger.info(f"Резервная копия {dest_path}: {size // 1024} КБ за {time.perf_counter() - start:.2f}s")
+        return size
+    
+    def iter_export(self, name, batch_size=1000, snapshot=True):
+        """Генератор выгрузки: сначала кортеж имён колонок, затем строки.
+        
+        Строки читаются курсором по batch_size через fetchmany; отдельное
+        read-only соединение держит один снимок WAL, поэтому писатели не
+        блокируются, а выгрузка согласована на момент начала. При snapshot=True
+        и настроенном snapshot_path читается копия, а не рабочая БД.
+        """
+        with closing(self._connect_ro(snapshot)) as conn:
+            cur = conn.execute(EXPORTS[name])
+            yield tuple(d[0] for d in cur.description)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield from rows
@@ -0,0 +1,44 @@
+# export.py
+# coding: utf-8
+"""Потоковая выгрузка таблиц (DBManager.iter_export) в CSV / JSONL."""
+import csv
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('csv', 'jsonl')
+
+
+def write_csv(rows, fp):
+    """Пишет строки в CSV; первая строка rows — заголовок. Возвращает число записей."""
+    writer = csv.writer(fp)
+    writer.writerow(next(rows))
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+def write_jsonl(rows, fp):
+    """Пишет по одному JSON-объекту на строку. Возвращает число записей."""
+    columns = next(rows)
+    count = 0
+    for row in rows:
+        fp.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+        fp.write("\n")
+        count += 1
+    return count
+
+
+def export_table(db, name, path, fmt='csv'):
+    """Выгружает таблицу name в файл path, не загружая её целиком в память."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+    
+    writer = write_csv if fmt == 'csv' else write_jsonl
+    with open(path, 'w', encoding='utf-8', newline='') as fp:
+        count = writer(db.iter_export(name), fp)
+    logger.info(f"Выгрузка {name} -> {path}: {count} строк")
+    return count
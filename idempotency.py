@@ -0,0 +1,121 @@
+# idempotency.py
+# coding: utf-8
+"""Идемпотентная обработка нажатий.
+
+Telegram может доставить один callback повторно, а пользователь — нажать
+«Оформить» дважды. Ключ (id callback или намерение «этот пользователь
+оформляет эту корзину») занимается атомарно в processed_callbacks; повтор
+получает сохранённый ответ и не трогает склад, баллы и заказы.
+
+Ключи операций, чей результат и так живёт в памяти (добавление в корзину,
+см. carts.py), занимаются только в памяти (durable=False): две записи в
+SQLite на нажатие защищали бы то, что при падении процесса всё равно теряется.
+"""
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+PENDING = "⏳ Уже обрабатывается..."
+
+
+class IdempotencyStore:
+    """Ответы на обработанные ключи: LRU с TTL в памяти поверх таблицы processed_callbacks."""
+    
+    def __init__(self, db, ttl=24 * 60 * 60, maxsize=10000):
+        self.db = db
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.local = OrderedDict()  # {key: (истекает, ответ)}
+        self.running = set()        # Ключи durable=False, чья func() выполняется
+        self.lock = threading.Lock()
+    
+    def _get_local(self, key):
+        with self.lock:
+            entry = self.local.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.local[key]
+                return None
+            self.local.move_to_end(key)
+            return entry[1]
+    
+    def _put_local(self, key, answer):
+        with self.lock:
+            self.local[key] = (time.monotonic() + self.ttl, answer)
+            self.local.move_to_end(key)
+            while len(self.local) > self.maxsize:
+                self.local.popitem(last=False)
+    
+    def run(self, key, func, answer=str, keep=bool, durable=True):
+        """Выполняет func() не более одного раза на key.
+        
+        Возвращает (результат func, False) для первой доставки и
+        (сохранённый ответ, True) для повтора. answer(result) — строка,
+        которую получат повторы; keep(result) — запоминать ли результат
+        (неуспешную попытку, например нехватку товара, можно повторить).
+        durable=False — ключ только в памяти процесса, без processed_callbacks.
+        """
+        cached = self._get_local(key)
+        if cached is not None:
+            return cached, True
+        if not durable:
+            return self._run_local(key, func, answer, keep)
+        
+        claimed, stored = self.db.claim_callback(key)
+        if not claimed:
+            logger.info(f"Повторная доставка: {key}")
+            if stored is not None:
+                self._put_local(key, stored)
+            return (stored if stored is not None else PENDING), True
+        
+        try:
+            result = func()
+        except Exception:
+            self.db.finish_callback(key, None)
+            raise
+        
+        if keep(result):
+            self.db.finish_callback(key, answer(result))
+            self._put_local(key, answer(result))
+        else:
+            self.db.finish_callback(key, None)
+        return result, False
+    
+    def _run_local(self, key, func, answer, keep):
+        with self.lock:
+            if key in self.running:
+                return PENDING, True
+            self.running.add(key)
+        try:
+            result = func()
+            if keep(result):
+                # Ответ запоминается раньше, чем снимается отметка: повтор
+                # увидит либо одно, либо другое
+                self._put_local(key, answer(result))
+            return result, False
+        finally:
+            with self.lock:
+                self.running.discard(key)
+    
+    def remember(self, key, answer):
+        """Сохраняет ответ по key без выполнения func (для чтения через recall)."""
+        self.db.store_callback(key, answer)
+        self._put_local(key, answer)
+    
+    def recall(self, key):
+        """Сохранённый ответ по key или None."""
+        cached = self._get_local(key)
+        if cached is not None:
+            return cached
+        stored = self.db.get_callback_result(key)
+        if stored is not None:
+            self._put_local(key, stored)
+        return stored
+    
+    def purge(self):
+        """Чистит просроченные ключи в таблице (память чистится по ходу чтения)."""
+        return self.db.purge_processed_callbacks(self.ttl)
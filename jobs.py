@@ -0,0 +1,110 @@
+# jobs.py
+# coding: utf-8
+import os
+import re
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def run_periodically(interval, func, name, stop_event=None, quiet=False):
+    """Запускает func каждые interval секунд в фоновом потоке.
+    
+    Ошибка одного запуска логируется и не останавливает расписание.
+    quiet=True — частая задача: успешные запуски не пишутся в лог.
+    """
+    stop_event = stop_event or threading.Event()
+    
+    def loop():
+        while not stop_event.wait(interval):
+            start = time.perf_counter()
+            try:
+                func()
+            except Exception as e:
+                logger.error(f"Ошибка фоновой задачи {name}: {e}", exc_info=True)
+            else:
+                if not quiet:
+                    logger.info(f"Фоновая задача {name} выполнена за {time.perf_counter() - start:.2f}s")
+    
+    threading.Thread(target=loop, name=name, daemon=True).start()
+    return stop_event
+
+
+# =============== СВЕРКА БАЛЛОВ ===============
+
+def reconcile_points(db, notify, batch_size=1000, pause=0.05):
+    """Проходит всех пользователей пачками и сверяет баланс с журналом баллов.
+    
+    notify(text) вызывается только при найденных расхождениях.
+    """
+    drift, checked, after = [], 0, 0
+    while True:
+        batch_drift, after = db.reconcile_points(after, batch_size)
+        if after is None:
+            break
+        drift.extend(batch_drift)
+        checked += batch_size
+        time.sleep(pause)  # Не занимаем диск подряд на больших таблицах
+    
+    if not drift:
+        logger.info(f"Сверка баллов: расхождений нет (~{checked} пользователей)")
+        return drift
+    
+    db.log_action('ledger_drift', details={'count': len(drift), 'sample': drift[:20]})
+    logger.warning(f"Сверка баллов: {len(drift)} расхождений, например {drift[:5]}")
+    lines = [f"• {tg}: баланс {points}, журнал {ledger}" for _, tg, points, ledger in drift[:10]]
+    notify(
+        f"⚠️ <b>Сверка баллов:</b> {len(drift)} расхождений\n" + "\n".join(lines)
+    )
+    return drift
+
+
+# =============== АВТООТМЕНА ЗАКАЗОВ ===============
+
+def expire_orders(db, max_age_hours, notify_user, batch_size=200):
+    """Отменяет заказы, зависшие в 'pending' дольше max_age_hours, пачками.
+    
+    notify_user(telegram_id, text) вызывается для каждого отменённого заказа.
+    """
+    total = 0
+    while True:
+        ids = db.get_stale_order_ids(max_age_hours, batch_size)
+        if not ids:
+            break
+        cancelled = db.cancel_orders(ids, reason='expired')
+        total += len(cancelled)
+        for oid, tg, change in cancelled:
+            notify_user(int(tg), f"⌛ Заказ №{oid} отменён: истёк срок ожидания." + (
+                f"\n💎 Баллы: {change:+d}" if change else ""
+            ))
+        if len(ids) < batch_size:
+            break
+    
+    if total:
+        logger.info(f"Автоотмена: отменено {total} заказов старше {max_age_hours} ч")
+    return total
+
+
+# =============== РЕЗЕРВНЫЕ КОПИИ ===============
+
+def backup_database(db, directory, keep):
+    """Делает онлайн-копию БД в directory и оставляет только keep последних.
+    
+    Удаляются только копии этой БД ("<имя>-ГГГГММДД-ЧЧММСС.db"): у БД "coffee"
+    не совпадут копии "coffee-bar". Точкам с одинаковым именем файла БД нужны
+    разные directory.
+    """
+    os.makedirs(directory, exist_ok=True)
+    name = os.path.splitext(os.path.basename(db.db_path))[0]
+    path = os.path.join(directory, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.db")
+    db.backup(path)
+    
+    # Имена с меткой времени сортируются хронологически
+    pattern = re.compile(rf"{re.escape(name)}-\d{{8}}-\d{{6}}\.db")
+    old = sorted(f for f in os.listdir(directory) if pattern.fullmatch(f))
+    for f in old[:-keep] if keep > 0 else []:
+        os.remove(os.path.join(directory, f))
+        logger.info(f"Удалена старая резервная копия: {f}")
+    return path
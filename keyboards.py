@@ -110,6 +110,19 @@ def admin_keyboard():
         types.KeyboardButton("💎 Топ по баллам")
     )
     
+    # Массовые изменения цен и остатков
+    kb.add(
+        types.KeyboardButton("💲 Цены"),
+        types.KeyboardButton("📦 Остатки")
+    )
+    
+    # Рассылки и данные
+    kb.add(types.KeyboardButton("📣 Рассылка"))
+    kb.add(
+        types.KeyboardButton("💾 Бэкап"),
+        types.KeyboardButton("📤 Выгрузка")
+    )
+    
     # Другое
     kb.add(types.KeyboardButton("🔴 Выход"))
     
@@ -166,6 +179,7 @@ def stock_management_keyboard():
         types.KeyboardButton("📈 Увеличить остатки"),
         types.KeyboardButton("📉 Уменьшить остатки")
     )
+    kb.add(types.KeyboardButton("⚖️ Установить остатки"))
     kb.add(types.KeyboardButton("🔴 Отмена"))
     return kb
 
@@ -226,6 +240,14 @@ def pagination_keyboard(page, total_pages, callback_prefix):
     return kb
 
 
+def cursor_pagination_keyboard(next_callback_data):
+    """Клавиатура keyset-пагинации: курсор следующей страницы уже упакован в callback_data."""
+    kb = types.InlineKeyboardMarkup()
+    if next_callback_data:
+        kb.add(types.InlineKeyboardButton("Вперёд ▶️", callback_data=next_callback_data))
+    return kb
+
+
 # ===============================
 # ==== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===
 # ===============================
@@ -278,3 +300,12 @@ def build_admin_user_actions(user_id):
         types.InlineKeyboardButton("🚫 Блокировать", callback_data=f"user_block|{user_id}")
     )
     return kb
+
+
+def reply_labels():
+    """Тексты кнопок всех reply-клавиатур (без категорий): это команды, а не поисковые запросы."""
+    keyboards = (
+        main_keyboard([]), add_more_kb(), profile_keyboard(), referral_keyboard(), support_keyboard(),
+        admin_keyboard(), stock_management_keyboard(), price_update_keyboard(), back_to_menu_keyboard()
+    )
+    return frozenset(button['text'] for kb in keyboards for row in kb.keyboard for button in row)
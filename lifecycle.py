@@ -0,0 +1,232 @@
+# lifecycle.py
+# coding: utf-8
+"""Жизненный цикл процесса бота: polling, мягкая остановка и смена процесса.
+
+SIGTERM / SIGINT — остановка:
+1. новые обновления больше не забираются (ответ висящего getUpdates
+   отбрасывается — эти обновления не подтверждены и придут снова);
+2. начатые обработчики дорабатывают, но не дольше drain_timeout;
+3. буферы (корзины, шаги диалогов) пишутся на диск, offset последнего
+   обработанного обновления подтверждается в Telegram;
+4. досылаются отложенные сообщения и правки, закрываются пулы.
+
+SIGHUP — перезапуск без простоя: запускается новый процесс с тем же
+argv, он полностью инициализируется (импорт, миграции, точки) и сообщает о
+готовности. Только после этого старый процесс выполняет шаги 1-3 и передаёт
+новому offset по socketpair; новый начинает polling ровно с него, пока
+старый в фоне выполняет шаг 4. Если новый процесс не поднялся, старый
+продолжает работать.
+"""
+import os
+import sys
+import time
+import signal
+import socket
+import logging
+import threading
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+HANDOFF_ENV = "BOT_HANDOFF_FD"  # Дескриптор socketpair в процессе-сменщике
+
+
+def sd_notify(state):
+    """Сообщение systemd (Type=notify); без NOTIFY_SOCKET ничего не делает."""
+    path = os.environ.get("NOTIFY_SOCKET")
+    if not path:
+        return
+    if path.startswith("@"):
+        path = "\0" + path[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as s:
+            s.sendto(state.encode(), path)
+    except OSError as e:
+        logger.warning(f"sd_notify не удался: {e}")
+
+
+def run_with_timeout(func, timeout):
+    """Вызывает func в отдельном потоке; False — не уложилась в timeout."""
+    t = threading.Thread(target=func, name="drain", daemon=True)
+    t.start()
+    t.join(max(0, timeout))
+    return not t.is_alive()
+
+
+class InFlight:
+    """Число задач обработчиков, поставленных в пул и ещё не завершённых."""
+    
+    def __init__(self):
+        self.count = 0
+        self.cond = threading.Condition()
+    
+    def enter(self):
+        with self.cond:
+            self.count += 1
+    
+    def exit(self):
+        with self.cond:
+            self.count -= 1
+            if self.count == 0:
+                self.cond.notify_all()
+    
+    def wait_idle(self, timeout):
+        """Ждёт завершения всех задач. False — по истечении timeout они ещё идут."""
+        with self.cond:
+            return self.cond.wait_for(lambda: self.count == 0, timeout)
+
+
+class Lifecycle:
+    """Polling TeleBot с остановкой и сменой процесса по сигналам."""
+    
+    def __init__(self, bot, inflight, drain_timeout=20, poll_timeout=30, handoff_timeout=60):
+        self.bot = bot
+        self.inflight = inflight
+        self.drain_timeout = drain_timeout
+        self.poll_timeout = poll_timeout
+        self.handoff_timeout = handoff_timeout
+        self.stopping = threading.Event()   # Больше не забирать обновления
+        self.dispatch = threading.Lock()    # Раздача пачки обновлений в пул
+        self.signals = []                   # Полученные сигналы, обрабатываются в главном потоке
+        self.flushers = []                  # [(название, func)] — до передачи offset
+        self.closers = []                   # [(название, func)] — после
+    
+    def before_handoff(self, name, func):
+        """func() сохраняет состояние, которое должен увидеть следующий процесс."""
+        self.flushers.append((name, func))
+    
+    def after_handoff(self, name, func):
+        """func() дорабатывает хвосты (отправки, пулы) — уже параллельно новому процессу."""
+        self.closers.append((name, func))
+    
+    # =============== ЗАПУСК ===============
+    
+    def run(self, on_start=None):
+        """Главный цикл процесса; возвращается после остановки."""
+        offset = self._take_over()
+        if offset is not None:
+            self.bot.last_update_id = offset
+            logger.info(f"Процесс {os.getpid()} принял смену с update_id {offset}")
+        if on_start:
+            on_start()
+        
+        for sig, handler in ((signal.SIGTERM, "stop"), (signal.SIGINT, "stop"), (signal.SIGHUP, "restart")):
+            signal.signal(sig, lambda signum, frame, handler=handler: self.signals.append(handler))
+        threading.Thread(target=self._poll, name="polling", daemon=True).start()
+        sd_notify(f"READY=1\nMAINPID={os.getpid()}")
+        
+        while True:
+            time.sleep(0.2)
+            if not self.signals:
+                continue
+            handler = self.signals.pop(0)
+            if handler == "stop":
+                self.shutdown()
+                return
+            successor = self._spawn_successor()
+            if successor is not None:
+                self.shutdown(successor)
+                return
+    
+    def _take_over(self):
+        """В процессе-сменщике: сообщить о готовности и получить offset."""
+        fd = os.environ.pop(HANDOFF_ENV, None)
+        if fd is None:
+            return None
+        with socket.socket(fileno=int(fd)) as sock, sock.makefile("rw") as f:
+            f.write("ready\n")
+            f.flush()
+            line = f.readline().strip()  # Старый процесс дорабатывает начатое
+        if not line:
+            logger.warning("Старый процесс не передал offset, продолжаем с подтверждённого в Telegram")
+            return None
+        return int(line)
+    
+    def _poll(self):
+        while not self.stopping.is_set():
+            try:
+                updates = self.bot.get_updates(
+                    offset=self.bot.last_update_id + 1,
+                    timeout=self.poll_timeout + 10, long_polling_timeout=self.poll_timeout
+                )
+            except Exception as e:
+                if not self.stopping.is_set():
+                    logger.error(f"⚠️ Ошибка polling: {e}")
+                    self.stopping.wait(3)
+                continue
+            with self.dispatch:
+                if self.stopping.is_set():
+                    return  # Не подтверждены — их получит следующий процесс
+                self.bot.process_new_updates(updates)
+            try:
+                self.bot.worker_pool.raise_exceptions()
+            except Exception as e:
+                logger.error(f"Ошибка обработчика: {e}", exc_info=e)
+                self.bot.worker_pool.clear_exceptions()
+    
+    # =============== СМЕНА И ОСТАНОВКА ===============
+    
+    def _spawn_successor(self):
+        """Запускает новый процесс и ждёт его готовности. Сокет связи или None."""
+        ours, theirs = socket.socketpair()
+        env = dict(os.environ, **{HANDOFF_ENV: str(theirs.fileno())})
+        logger.info("🔄 Перезапуск: поднимаем новый процесс")
+        try:
+            proc = subprocess.Popen([sys.executable, *sys.argv], pass_fds=[theirs.fileno()], env=env)
+        except OSError as e:
+            logger.error(f"Не удалось запустить новый процесс: {e}", exc_info=True)
+            ours.close()
+            return None
+        finally:
+            theirs.close()
+        
+        ours.settimeout(self.handoff_timeout)
+        try:
+            ready = ours.makefile("r").readline().strip() == "ready"
+        except OSError:
+            ready = False
+        if not ready:
+            logger.error(f"Новый процесс {proc.pid} не сообщил о готовности, работаем дальше")
+            proc.kill()
+            proc.wait()
+            ours.close()
+            return None
+        return ours
+    
+    def shutdown(self, successor=None):
+        """Шаги 1-4 из описания модуля; successor — сокет процесса-сменщика."""
+        deadline = time.monotonic() + self.drain_timeout
+        self.stopping.set()
+        with self.dispatch:
+            offset = self.bot.last_update_id
+        logger.info(f"🛑 Остановка: обновления до {offset} приняты, ждём обработчики")
+        
+        if not self.inflight.wait_idle(deadline - time.monotonic()):
+            logger.warning(f"Не дождались {self.inflight.count} обработчиков за {self.drain_timeout} сек")
+        for name, func in self.flushers:
+            try:
+                func()
+            except Exception as e:
+                logger.error(f"Ошибка сохранения ({name}) при остановке: {e}", exc_info=True)
+        
+        if successor is not None:
+            try:
+                successor.sendall(f"{offset}\n".encode())
+            except OSError as e:
+                logger.error(f"Не удалось передать offset новому процессу: {e}")
+            successor.close()
+        else:
+            self._confirm(offset)
+        
+        for name, func in self.closers:
+            if not run_with_timeout(func, deadline - time.monotonic()):
+                logger.warning(f"Остановка: не дождались «{name}»")
+        logger.info("🛑 Бот остановлен")
+    
+    def _confirm(self, offset):
+        """Подтверждает Telegram обновления до offset включительно."""
+        try:
+            # Вернувшееся обновление (если есть) не подтверждается этим вызовом
+            self.bot.get_updates(offset=offset + 1, limit=1, timeout=10, long_polling_timeout=0)
+        except Exception as e:
+            logger.warning(f"Не удалось подтвердить offset {offset}: {e}")
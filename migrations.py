@@ -0,0 +1,186 @@
+# migrations.py
+# coding: utf-8
+"""Версионирование схемы через PRAGMA user_version.
+
+models.sql — базовая схема (версия 1). Любое изменение схемы после неё —
+новая запись в MIGRATIONS с номером на 1 больше; старые записи не меняются.
+"""
+import os
+import time
+import sqlite3
+import logging
+import threading
+from collections import namedtuple
+from contextlib import closing
+
+logger = logging.getLogger(__name__)
+
+MODELS_SQL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models.sql')
+
+# online=True — миграция только добавляет индексы/ANALYZE: бот может работать
+# без неё, поэтому она выполняется в фоне и не задерживает старт. Фон не
+# значит «без блокировок»: CREATE INDEX держит write-lock всё время построения
+# индекса, и записи бота ждут его (busy_timeout DBManager) — см. steps().
+Migration = namedtuple('Migration', 'version name apply online')
+STEP_PAUSE = 0.2  # секунд между шагами online-миграции
+
+
+def sql(script):
+    """Миграция из SQL-скрипта: одна транзакция вместе с установкой версии."""
+    def apply(conn, version):
+        conn.executescript(f"BEGIN IMMEDIATE;\n{script}\nPRAGMA user_version = {version};\nCOMMIT;")
+    return apply
+
+
+def steps(*statements):
+    """Online-миграция: каждый оператор — своя короткая транзакция, версия — в конце.
+    
+    Write-lock держится на время одного индекса, а не всех сразу: между
+    шагами проходят записи бота. Операторы идемпотентны (IF NOT EXISTS),
+    поэтому прерванная миграция при следующем старте просто повторяется.
+    """
+    def apply(conn, version):
+        for statement in statements:
+            conn.executescript(f"BEGIN IMMEDIATE;\n{statement}\nCOMMIT;")
+            time.sleep(STEP_PAUSE)  # Ждущие записи успевают взять lock раньше следующего шага
+        conn.execute(f"PRAGMA user_version = {version}")
+    return apply
+
+
+def baseline(conn, version):
+    """Версия 1: models.sql + однократное заполнение производных таблиц."""
+    with open(MODELS_SQL, 'r', encoding='utf-8') as f:
+        conn.executescript(f.read())
+    sql("""
+        -- БД, созданные до появления referral_counts
+        INSERT INTO referral_counts (user_id, invited, converted)
+        SELECT referrer_id, COUNT(*), SUM(orders > 0)
+        FROM users
+        WHERE referrer_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM referral_counts)
+        GROUP BY referrer_id;
+        
+        -- Товары, добавленные до появления stock_fts
+        INSERT INTO stock_fts (rowid, name, category)
+        SELECT s.id, s.name, c.name FROM stock s JOIN categories c ON c.id = s.category_id
+        WHERE NOT EXISTS (SELECT 1 FROM stock_fts);
+    """)(conn, version)
+
+
+MIGRATIONS = [
+    Migration(1, 'baseline', baseline, False),
+    Migration(2, 'points_ledger_idempotency', sql("""
+        -- Ключ идемпотентности проводки; у исторических записей NULL (NULL-ы в UNIQUE различны)
+        ALTER TABLE points_history ADD COLUMN idem_key TEXT;
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_points_history_idem_key ON points_history(idem_key);
+    """), False),
+    Migration(3, 'points_ledger_reconcile_index', steps(
+        # Покрывающий индекс для сверки SUM(change) по пользователю
+        "CREATE INDEX IF NOT EXISTS idx_points_history_user_change ON points_history(user_id, change);",
+    ), True),
+    Migration(4, 'processed_callbacks', sql("""
+        -- Идемпотентность нажатий: ключ (id callback / намерение заказа) -> ответ; result NULL — в обработке
+        CREATE TABLE IF NOT EXISTS processed_callbacks (
+            key TEXT PRIMARY KEY,
+            result TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_processed_callbacks_created_at ON processed_callbacks(created_at);
+    """), False),
+    Migration(5, 'catalog_version', sql("""
+        -- Счётчик изменений каталога: +1 на каждое массовое изменение цен/остатков
+        CREATE TABLE IF NOT EXISTS catalog_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0);
+    """), False),
+    Migration(6, 'audit_log_json_columns', sql("""
+        -- Ключи из details для фильтров журнала. ALTER TABLE добавляет только
+        -- VIRTUAL-колонки (STORED — пересборка таблицы), а значения для поиска
+        -- хранят индексы миграции 7. Невалидный JSON старых строк -> NULL
+        ALTER TABLE audit_log ADD COLUMN order_id INTEGER
+            GENERATED ALWAYS AS (CASE WHEN json_valid(details) THEN json_extract(details, '$.order_id') END) VIRTUAL;
+        ALTER TABLE audit_log ADD COLUMN total INTEGER
+            GENERATED ALWAYS AS (CASE WHEN json_valid(details) THEN json_extract(details, '$.total') END) VIRTUAL;
+        ALTER TABLE audit_log ADD COLUMN referrer INTEGER
+            GENERATED ALWAYS AS (CASE WHEN json_valid(details) THEN json_extract(details, '$.referrer') END) VIRTUAL;
+        ALTER TABLE audit_log ADD COLUMN stock_id INTEGER
+            GENERATED ALWAYS AS (CASE WHEN json_valid(details) THEN json_extract(details, '$.stock_id') END) VIRTUAL;
+    """), False),
+    Migration(7, 'audit_log_indexes', steps(
+        # Журнал по типу события и времени (keyset по created_at, id)
+        "CREATE INDEX IF NOT EXISTS idx_audit_log_action_created ON audit_log(action, created_at);",
+        # Частичные индексы: у большинства событий ключа нет
+        "CREATE INDEX IF NOT EXISTS idx_audit_log_order_id ON audit_log(order_id) WHERE order_id IS NOT NULL;",
+        "CREATE INDEX IF NOT EXISTS idx_audit_log_total ON audit_log(total) WHERE total IS NOT NULL;",
+        "CREATE INDEX IF NOT EXISTS idx_audit_log_referrer ON audit_log(referrer) WHERE referrer IS NOT NULL;",
+        "CREATE INDEX IF NOT EXISTS idx_audit_log_stock_id ON audit_log(stock_id) WHERE stock_id IS NOT NULL;",
+    ), True),
+    Migration(8, 'item_pairs', sql("""
+        -- «Часто берут вместе»: в скольких выданных заказах были оба товара.
+        -- Заполняется при выдаче заказов и пересчитывается целиком по расписанию
+        CREATE TABLE IF NOT EXISTS item_pairs (
+            stock_id INTEGER NOT NULL,
+            other_id INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (stock_id, other_id)
+        ) WITHOUT ROWID;
+        -- Топ-k для товара — чтение k первых записей индекса
+        CREATE INDEX IF NOT EXISTS idx_item_pairs_top ON item_pairs(stock_id, count DESC, other_id);
+    """), False),
+    Migration(9, 'points_ledger_opening', sql("""
+        -- До журнала update_points обрезал баланс до 0, но писал в журнал полное
+        -- изменение: старые БД расходятся навсегда. Одна проводка 'opening' на
+        -- пользователя сводит журнал с балансом, и сверка видит только новые расхождения
+        INSERT OR IGNORE INTO points_history (user_id, change, reason, idem_key)
+        SELECT u.id, u.points - COALESCE(SUM(p.change), 0), 'opening', 'opening:' || u.id
+        FROM users u LEFT JOIN points_history p ON p.user_id = u.id
+        GROUP BY u.id
+        HAVING u.points != COALESCE(SUM(p.change), 0);
+    """), False),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1].version
+
+
+def _connect(db_path):
+    # Миграция может ждать write-lock, пока старый процесс дописывает транзакцию
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA foreign_keys = ON")
+    return closing(conn)
+
+
+def _run(db_path, pending):
+    with _connect(db_path) as conn:
+        for m in pending:
+            start = time.perf_counter()
+            m.apply(conn, m.version)
+            logger.info(f"Миграция {m.version} ({m.name}) применена за {time.perf_counter() - start:.2f}s")
+
+
+def _run_online(db_path, pending):
+    try:
+        _run(db_path, pending)
+    except Exception as e:
+        logger.error(f"Ошибка фоновой миграции: {e}", exc_info=True)
+
+
+def migrate(db_path):
+    """Доводит схему до SCHEMA_VERSION. Возвращает версию на момент старта."""
+    with _connect(db_path) as conn:
+        # Быстрый путь: схема актуальна — одно чтение PRAGMA
+        current = conn.execute("PRAGMA user_version").fetchone()[0]
+        if current >= SCHEMA_VERSION:
+            return current
+        conn.execute("PRAGMA journal_mode = WAL")
+    
+    pending = [m for m in MIGRATIONS if m.version > current]
+    # Всё до последней блокирующей миграции включительно — сразу (версии идут
+    # строго по порядку), online-миграции после неё — в фоне
+    split = max((i + 1 for i, m in enumerate(pending) if not m.online), default=0)
+    _run(db_path, pending[:split])
+    if pending[split:]:
+        threading.Thread(
+            target=_run_online, args=(db_path, pending[split:]), name="migrations", daemon=True
+        ).start()
+    return current
@@ -1,5 +1,6 @@
 -- models.sql
 -- Полная схема с защитой от race conditions и оптимизацией
+-- Базовая схема (версия 1): применяется один раз, дальнейшие изменения — в migrations.py
 
 PRAGMA foreign_keys = ON;
 PRAGMA journal_mode = WAL;      -- Write-Ahead Logging (лучшая параллелизация)
@@ -21,6 +22,19 @@ CREATE TABLE IF NOT EXISTS users (
 -- Индексы для ускорения поиска
 CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id);
 CREATE INDEX IF NOT EXISTS idx_users_referrer_id ON users(referrer_id);
+CREATE INDEX IF NOT EXISTS idx_users_points ON users(points, id);  -- Для топа по баллам (keyset)
+
+
+-- ======== СЧЁТЧИКИ РЕФЕРАЛОВ ========
+-- Поддерживаются инкрементально (add_user / реферальный бонус), вместо GROUP BY по users
+CREATE TABLE IF NOT EXISTS referral_counts (
+    user_id INTEGER PRIMARY KEY,                    -- Реферер (users.id)
+    invited INTEGER NOT NULL DEFAULT 0 CHECK (invited >= 0),      -- Приглашено друзей
+    converted INTEGER NOT NULL DEFAULT 0 CHECK (converted >= 0),  -- Из них сделали первый заказ
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_referral_counts_invited ON referral_counts(invited, user_id);
 
 
 -- ======== ТАБЛИЦА КАТЕГОРИЙ ========
@@ -52,6 +66,37 @@ CREATE INDEX IF NOT EXISTS idx_stock_category_id ON stock(category_id);
 CREATE INDEX IF NOT EXISTS idx_stock_quantity ON stock(quantity);  -- Для быстрого поиска доступных товаров
 
 
+-- ======== ПОЛНОТЕКСТОВЫЙ ПОИСК ПО МЕНЮ (FTS5) ========
+-- rowid = stock.id; синхронизируется триггерами ниже
+CREATE VIRTUAL TABLE IF NOT EXISTS stock_fts USING fts5(
+    name,
+    category,
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3 4'                            -- Индексы префиксов для поиска «на лету»
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_stock_fts_insert AFTER INSERT ON stock BEGIN
+    INSERT INTO stock_fts (rowid, name, category)
+    VALUES (new.id, new.name, (SELECT name FROM categories WHERE id = new.category_id));
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_stock_fts_delete AFTER DELETE ON stock BEGIN
+    DELETE FROM stock_fts WHERE rowid = old.id;
+END;
+
+-- Только name/category_id: списание остатков не трогает индекс
+CREATE TRIGGER IF NOT EXISTS trg_stock_fts_update AFTER UPDATE OF name, category_id ON stock BEGIN
+    UPDATE stock_fts
+    SET name = new.name, category = (SELECT name FROM categories WHERE id = new.category_id)
+    WHERE rowid = new.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_categories_fts_update AFTER UPDATE OF name ON categories BEGIN
+    UPDATE stock_fts SET category = new.name
+    WHERE rowid IN (SELECT id FROM stock WHERE category_id = new.id);
+END;
+
+
 -- ======== ТАБЛИЦА КОРЗИНЫ ========
 CREATE TABLE IF NOT EXISTS cart (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -87,6 +132,9 @@ CREATE TABLE IF NOT EXISTS orders (
 CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders(user_id);
 CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders(created_at);
 CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status);
+-- Покрывающие индексы для keyset-пагинации истории заказов
+CREATE INDEX IF NOT EXISTS idx_orders_user_history ON orders(user_id, id, total, discount, status, created_at);
+CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders(status, created_at, id, user_id, total, discount);
 
 
 -- ======== ТАБЛИЦА СОДЕРЖИМОГО ЗАКАЗА ========
@@ -134,3 +182,28 @@ CREATE TABLE IF NOT EXISTS points_history (
 
 CREATE INDEX IF NOT EXISTS idx_points_history_user_id ON points_history(user_id);
 CREATE INDEX IF NOT EXISTS idx_points_history_created_at ON points_history(created_at);
+
+
+-- ======== ТАБЛИЦА РАССЫЛОК ========
+-- Прогресс хранится в last_user_id: после рестарта рассылка продолжается с места остановки
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    text TEXT NOT NULL,
+    status TEXT DEFAULT 'running' CHECK (status IN ('running', 'done', 'cancelled')),
+    last_user_id INTEGER DEFAULT 0,       -- Последний обработанный users.id
+    sent INTEGER DEFAULT 0 CHECK (sent >= 0),
+    failed INTEGER DEFAULT 0 CHECK (failed >= 0),
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    finished_at TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status);
+
+
+-- ======== ТОКЕНЫ ДЛИННЫХ CALLBACK_DATA ========
+-- Для кнопок, чей payload не влезает в 64 байта Telegram (см. callbacks.py)
+CREATE TABLE IF NOT EXISTS callback_tokens (
+    token TEXT PRIMARY KEY,
+    payload BLOB NOT NULL,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP
+) WITHOUT ROWID;
@@ -0,0 +1,256 @@
+# profiler.py
+# coding: utf-8
+"""Профилирование работающего бота без перезапуска.
+
+Сессия ограничена по времени, одновременно идёт только одна:
+- sample — сэмплер: раз в interval секунд снимает стеки всех потоков
+  (sys._current_frames). Почти ничего не стоит, результат — collapsed
+  stacks для flamegraph.pl / speedscope и топ функций;
+- cprofile — cProfile каждой задачи обработчика (call() в точке запуска
+  задач), статистика всех потоков складывается в один pstats;
+- memory — tracemalloc: самые большие места выделения памяти и рост за
+  сессию.
+
+В любой отчёт входят размеры наблюдаемых структур (watch()): словари
+состояния бота, которые растут вместе с числом пользователей.
+"""
+import os
+import io
+import re
+import sys
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+MODES = ("sample", "cprofile", "memory")
+IDLE = {"threading.py:wait", "threading.py:_wait_for_tstate_lock"}  # Простаивающий поток пула
+
+
+def footprint(obj, depth=3):
+    """Примерный размер obj в байтах вместе с содержимым контейнеров до глубины depth."""
+    seen = set()
+    
+    def size(o, level):
+        if id(o) in seen:
+            return 0
+        seen.add(id(o))
+        total = sys.getsizeof(o)
+        if level < depth:
+            if isinstance(o, dict):
+                total += sum(size(k, level + 1) + size(v, level + 1) for k, v in list(o.items()))
+            elif isinstance(o, (list, tuple, set, frozenset)):
+                total += sum(size(v, level + 1) for v in list(o))
+            elif hasattr(o, '__slots__'):
+                total += sum(size(getattr(o, s), level + 1) for s in o.__slots__ if hasattr(o, s))
+        return total
+    
+    return size(obj, 0)
+
+
+def thread_kind(name):
+    """Имя потока без номера: потоки одного пула — одна ветка flame graph."""
+    return re.sub(r"[-_]?\d+(_\d+)?$", "", name) or name
+
+
+class Profiler:
+    """Сессии профилирования по команде админа или флагу запуска."""
+    
+    def __init__(self, out_dir="profiles", interval=0.01, top=30, frames=25):
+        self.out_dir = out_dir
+        self.interval = interval
+        self.top = top
+        self.frames = frames         # Глубина трассировки tracemalloc
+        self.watches = {}            # {имя: функция, возвращающая структуру}
+        self.lock = threading.Lock()
+        self.mode = None             # Режим идущей сессии
+        self.stats = None            # pstats.Stats задач, cprofile
+        self.local = threading.local()
+    
+    def watch(self, name, get):
+        """Добавляет структуру get() в раздел размеров отчёта."""
+        self.watches[name] = get
+    
+    # =============== ЗАДАЧИ ОБРАБОТЧИКОВ ===============
+    
+    def call(self, func, *args, **kwargs):
+        """Вызывает func; во время сессии cprofile — под cProfile."""
+        if self.mode != "cprofile" or getattr(self.local, 'active', False):
+            return func(*args, **kwargs)
+        
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            # Python 3.12+: активен cProfile другой задачи (sys.monitoring общий
+            # на процесс и видит все потоки) — эта задача попадёт в его профиль
+            return func(*args, **kwargs)
+        self.local.active = True
+        try:
+            return func(*args, **kwargs)
+        finally:
+            prof.disable()
+            self.local.active = False
+            with self.lock:
+                if self.mode == "cprofile":
+                    if self.stats is None:
+                        self.stats = pstats.Stats(prof)
+                    else:
+                        self.stats.add(prof)
+    
+    # =============== СЕССИЯ ===============
+    
+    def start(self, mode, seconds, done):
+        """Запускает сессию в фоне; по окончании вызывает done(пути файлов отчёта).
+        
+        RuntimeError — если сессия уже идёт.
+        """
+        if mode not in MODES:
+            raise ValueError(f"Неизвестный режим: {mode} (есть {', '.join(MODES)})")
+        with self.lock:
+            if self.mode is not None:
+                raise RuntimeError(f"Уже идёт профилирование ({self.mode})")
+            self.mode = mode
+            self.stats = None
+        
+        def run():
+            try:
+                paths = self.run(mode, seconds)
+            except Exception as e:
+                logger.error(f"Ошибка профилирования: {e}", exc_info=True)
+                paths = []
+            finally:
+                with self.lock:
+                    self.mode = None
+                    self.stats = None
+            done(paths)
+        
+        logger.info(f"Профилирование {mode} на {seconds} сек")
+        threading.Thread(target=run, name="profiler", daemon=True).start()
+    
+    def run(self, mode, seconds):
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        base = os.path.join(self.out_dir, f"profile-{mode}-{stamp}")
+        os.makedirs(self.out_dir, exist_ok=True)
+        lines = [f"# {mode}, {seconds} сек, {datetime.now():%Y-%m-%d %H:%M:%S}", ""]
+        paths = []
+        
+        if mode == "sample":
+            stacks = self._sample(seconds)
+            with open(base + ".collapsed", "w", encoding="utf-8") as f:
+                for stack, count in stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            paths.append(base + ".collapsed")
+            lines += self._sample_report(stacks)
+        elif mode == "cprofile":
+            time.sleep(seconds)
+            with self.lock:
+                stats, self.mode = self.stats, None  # Новые задачи — уже без cProfile
+            lines += self._cprofile_report(stats, base + ".prof", paths)
+        else:
+            lines += self._memory(seconds)
+        
+        lines += ["", "## Размеры структур", ""] + self._watch_report()
+        with open(base + ".txt", "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        paths.insert(0, base + ".txt")
+        logger.info(f"Профилирование {mode} завершено: {', '.join(paths)}")
+        return paths
+    
+    # =============== РЕЖИМЫ ===============
+    
+    def _sample(self, seconds):
+        me = threading.get_ident()
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(thread_kind(names.get(ident, str(ident))))
+                stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+        return stacks
+    
+    def _sample_report(self, stacks):
+        own, inclusive = Counter(), Counter()
+        idle = 0
+        for stack, count in stacks.items():
+            frames = stack.split(";")
+            if frames[-1] in IDLE:
+                idle += count
+                continue
+            own[frames[-1]] += count
+            for name in set(frames[1:]):
+                inclusive[name] += count
+        total = sum(own.values()) or 1
+        lines = [
+            f"Сэмплов (стек × поток): {total + idle}, из них поток простаивал: {idle}",
+            "Доли — от непростаивающих", "", "## Собственное время", ""
+        ]
+        lines += [f"{count / total:7.1%}  {name}" for name, count in own.most_common(self.top)]
+        lines += ["", "## Включая вызванные", ""]
+        lines += [f"{count / total:7.1%}  {name}" for name, count in inclusive.most_common(self.top)]
+        return lines
+    
+    def _cprofile_report(self, stats, prof_path, paths):
+        if stats is None:
+            return ["За время сессии не было обработанных обновлений."]
+        stats.dump_stats(prof_path)
+        paths.append(prof_path)
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats("cumulative").print_stats(self.top)
+        stats.sort_stats("tottime").print_stats(self.top)
+        return [out.getvalue()]
+    
+    def _memory(self, seconds):
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start(self.frames)
+        try:
+            before = tracemalloc.take_snapshot()
+            time.sleep(seconds)
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            if started:
+                tracemalloc.stop()
+        
+        skip = (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        )
+        before, after = before.filter_traces(skip), after.filter_traces(skip)
+        lines = [f"Отслежено: {current / 2**20:.1f} МБ, пик {peak / 2**20:.1f} МБ", "", "## Больше всего памяти", ""]
+        lines += [str(stat) for stat in after.statistics("lineno")[:self.top]]
+        lines += ["", "## Рост за сессию", ""]
+        lines += [str(stat) for stat in after.compare_to(before, "lineno")[:self.top]]
+        lines += ["", "## Крупнейшая трассировка", ""]
+        biggest = after.statistics("traceback")[:1]
+        if biggest:
+            lines += biggest[0].traceback.format()
+        return lines
+    
+    def _watch_report(self):
+        lines = []
+        for name, get in self.watches.items():
+            try:
+                obj = get()
+                size = len(obj) if hasattr(obj, '__len__') else "-"
+                lines.append(f"{name}: {size} элементов, ~{footprint(obj) / 1024:.0f} КБ")
+            except Exception as e:
+                lines.append(f"{name}: ошибка ({e})")
+        return lines or ["(нет)"]
@@ -0,0 +1,70 @@
+# render.py
+# coding: utf-8
+"""Тексты сообщений о корзине и заказах.
+
+Шаблоны — функции с f-строками: Python компилирует их при импорте, вызов не
+разбирает строку формата заново (в отличие от str.format). Строки позиций
+кешируются: одна и та же позиция в корзине, в подтверждении заказа, в
+сообщении админу и в истории форматируется один раз.
+"""
+
+
+def cart_text(*, lines, total, disc, final, points, remaining):
+    return (
+        f"🛒 <b>Твоя корзина:</b>\n{lines}\n\n"
+        f"💰 Итого: {total}₽\n"
+        f"🎁 Скидка (баллов: {disc}): -{disc}₽\n"
+        f"📦 <b>К оплате: {final}₽</b>\n"
+        f"💎 Баллов: {points} → {remaining} (после использования)"
+    )
+
+
+def order_placed_text(*, oid, lines, final, earned):
+    return (
+        f"✅ <b>Заказ №{oid} оформлен!</b>\n"
+        f"{lines}\n"
+        f"💳 К оплате: {final}₽\n"
+        f"🎯 Баллы: +{earned} 💎"
+    )
+
+
+def admin_order_text(*, oid, name, tg, lines, final, disc, time):
+    return (
+        f"📦 <b>Новый заказ №{oid}</b>\n"
+        f"👤 {name} (ID: {tg})\n"
+        f"📋 {lines}\n"
+        f"💰 <b>К оплате: {final}₽</b>\n"
+        f"🎁 Скидка: {disc}₽\n"
+        f"⏰ {time}"
+    )
+
+
+def order_summary_text(*, oid, total, status, created_at, lines):
+    return f"🧾 <b>Заказ №{oid}</b> — {total}₽ ({status}, {created_at})\n{lines}"
+
+
+# Кеш строк позиций: ключ — (name, size, price, qty), хвост и CartRow, и
+# OrderItemRow. Название в ключе вместо stock_id: товар могут переименовать.
+LINE_CACHE_SIZE = 4096
+_lines = {}
+
+
+def item_line(name, size, price, qty):
+    """Строка одной позиции (без кеша)."""
+    sz = f" {size}л" if size else ""
+    return f"• {name}{sz} x{qty} — {price}₽"
+
+
+def cart_lines(rows):
+    """Позиции корзины или заказа (CartRow / OrderItemRow), по строке на позицию."""
+    get = _lines.get
+    out = []
+    for r in rows:
+        key = r[-4:]
+        line = get(key)
+        if line is None:
+            if len(_lines) >= LINE_CACHE_SIZE:
+                _lines.clear()
+            line = _lines[key] = item_line(*key)
+        out.append(line)
+    return "\n".join(out)
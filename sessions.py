@@ -0,0 +1,132 @@
+# sessions.py
+# coding: utf-8
+"""Сессии сообщений: бот правит своё сообщение вместо отправки нового.
+
+Для каждого чата помнится последнее «живое» сообщение бота (категория,
+поиск, корзина): что в нём сейчас показано и как его перерисовать. Правка
+без изменений в API не уходит, а правки одного сообщения чаще раза в window
+секунд склеиваются — по окончании окна уходит только последняя версия.
+
+Сама отправка — функция рантайма edit(chat_id, message_id, text, reply_markup):
+в bot.py она синхронная, в bot_async.py возвращает корутину.
+"""
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def _timer(delay, func):
+    t = threading.Timer(delay, func)
+    t.daemon = True
+    t.start()
+
+
+def markup_key(markup):
+    """Сравнимое представление клавиатуры telebot (или None)."""
+    return markup.to_json() if markup is not None else None
+
+
+class _Live:
+    """Живое сообщение чата: показанное содержимое и отложенная правка."""
+    __slots__ = ('message_id', 'text', 'markup', 'view', 'sent_at', 'pending')
+    
+    def __init__(self, message_id, text=None, markup=None, view=None, sent_at=0.0):
+        self.message_id = message_id
+        self.text = text
+        self.markup = markup
+        self.view = view          # () -> (text, reply_markup): перерисовка страницы
+        self.sent_at = sent_at
+        self.pending = None       # (text, reply_markup), ждущие конца окна
+
+
+class MessageSessions:
+    """Живые сообщения по чатам (LRU) и склейка частых правок."""
+    
+    def __init__(self, edit, window=1.0, maxsize=10000, schedule=_timer):
+        self._edit = edit
+        self.window = window
+        self.maxsize = maxsize
+        self._schedule = schedule  # schedule(delay, func) — отложенный вызов
+        self._chats = OrderedDict()  # {chat_id: _Live}, LRU
+        self._lock = threading.Lock()
+    
+    def _remember(self, chat_id, live):
+        self._chats[chat_id] = live
+        self._chats.move_to_end(chat_id)
+        if len(self._chats) > self.maxsize:
+            self._chats.popitem(last=False)
+    
+    def track(self, chat_id, message, text, reply_markup=None, view=None):
+        """Запоминает только что отправленное message как живое сообщение чата."""
+        if message is None:  # Отправка не удалась
+            return
+        with self._lock:
+            self._remember(chat_id, _Live(
+                message.message_id, text, markup_key(reply_markup), view, time.monotonic()
+            ))
+    
+    def view(self, chat_id, message_id):
+        """Функция перерисовки сообщения или None, если оно не живое."""
+        with self._lock:
+            live = self._chats.get(chat_id)
+            return live.view if live is not None and live.message_id == message_id else None
+    
+    def close(self, chat_id, message_id):
+        """Сообщение больше не правится (например, с него убрали кнопки)."""
+        with self._lock:
+            live = self._chats.get(chat_id)
+            if live is not None and live.message_id == message_id:
+                del self._chats[chat_id]
+    
+    def edit(self, chat_id, message_id, text, reply_markup=None, view=None):
+        """Показывает text и reply_markup в сообщении message_id.
+        
+        Возвращает результат edit() рантайма, если правка ушла сразу, иначе
+        None: содержимое не изменилось или правка отложена до конца окна.
+        """
+        now = time.monotonic()
+        markup = markup_key(reply_markup)
+        with self._lock:
+            live = self._chats.get(chat_id)
+            if live is None or live.message_id != message_id:
+                # Нажатие в более старом сообщении — теперь живое оно
+                live = _Live(message_id)
+                self._remember(chat_id, live)
+            live.view = view
+            
+            if live.pending is not None:
+                live.pending = (text, reply_markup)  # Таймер уже взведён
+                return None
+            if live.text == text and live.markup == markup:
+                return None
+            wait = live.sent_at + self.window - now
+            if wait > 0:
+                live.pending = (text, reply_markup)
+                self._schedule(wait, lambda: self._flush(chat_id, live))
+                return None
+            live.text, live.markup, live.sent_at = text, markup, now
+        return self._edit(chat_id, message_id, text, reply_markup)
+    
+    def flush_pending(self):
+        """Отправляет все отложенные правки, не дожидаясь конца окна (остановка бота)."""
+        with self._lock:
+            pending = [(chat_id, live) for chat_id, live in self._chats.items() if live.pending is not None]
+        for chat_id, live in pending:
+            self._flush(chat_id, live)
+        return len(pending)
+    
+    def _flush(self, chat_id, live):
+        with self._lock:
+            if live.pending is None:  # Уже отправлена flush_pending()
+                return None
+            text, reply_markup = live.pending
+            live.pending = None
+            markup = markup_key(reply_markup)
+            if live.text == text and live.markup == markup:
+                return None
+            live.text, live.markup, live.sent_at = text, markup, time.monotonic()
+        logger.debug(f"Склеенная правка сообщения {chat_id}/{live.message_id}")
+        return self._edit(chat_id, live.message_id, text, reply_markup)
@@ -0,0 +1,186 @@
+# tenants.py
+# coding: utf-8
+"""Несколько точек (магазинов) в одном процессе бота.
+
+У каждой точки свой файл SQLite со своим DBManager, корзинами и админской
+группой, поэтому записи разных точек не ждут общий write-lock.
+
+Обновление относится к точке:
+- админской группы, если пришло из неё;
+- из deep-link "/start <точка>" или "/start <точка>-<реферер>" — чат
+  запоминается за точкой в отдельном файле привязок;
+- привязанной к чату ранее; иначе — к первой точке из списка.
+
+Код обработчиков не меняется: db, carts и т.п. в bot.py — прокси на точку
+текущего обновления (contextvars), см. Current.
+"""
+import os
+import sqlite3
+import logging
+import threading
+import contextvars
+import urllib.parse
+from collections import namedtuple
+from contextlib import closing
+
+logger = logging.getLogger(__name__)
+
+Tenant = namedtuple('Tenant', 'slug title admin_group_id db carts processed broadcaster')
+
+current = contextvars.ContextVar('tenant', default=None)
+
+MAX_ATTACHED = 10      # SQLITE_MAX_ATTACHED по умолчанию
+BINDING_CACHE_SIZE = 100_000
+
+# Сводка по точкам: одна строка на схему, подставленную через ATTACH
+REPORT = (
+    "SELECT ? AS shop, "
+    "(SELECT COUNT(*) FROM {s}.users) AS users, "
+    "(SELECT COUNT(*) FROM {s}.orders WHERE status = 'pending') AS pending, "
+    "(SELECT COUNT(*) FROM {s}.orders WHERE status != 'cancelled' "
+    "AND created_at >= datetime('now', '-1 day')) AS orders_24h, "
+    "(SELECT COALESCE(SUM(total), 0) FROM {s}.orders WHERE status != 'cancelled' "
+    "AND created_at >= datetime('now', '-1 day')) AS revenue_24h"
+)
+
+
+def start_payload(text):
+    """Разбирает "/start <точка>-<реферер>": (точка или None, реферальный код или None)."""
+    if not (text and text.startswith("/start ")):
+        return None, None
+    payload = text.split(" ", 1)[1].strip()
+    if payload.isdigit():
+        return None, payload
+    slug, _, ref = payload.partition("-")
+    return slug, ref or None
+
+
+class TenantRegistry:
+    """Точки по slug, маршрутизация обновлений и привязки чатов к точкам."""
+    
+    def __init__(self, shops, open_tenant, bindings_path):
+        # shops — {slug: настройки}; open_tenant(slug, настройки) -> Tenant
+        self.tenants = {slug: open_tenant(slug, shop) for slug, shop in shops.items()}
+        self.default = next(iter(self.tenants.values()))
+        self.by_admin_chat = {str(t.admin_group_id): t for t in self.tenants.values()}
+        self.bindings_path = bindings_path
+        self.bindings = {}  # {chat_id: slug или None}
+        self.lock = threading.Lock()
+        if len(self.tenants) > 1:
+            with closing(self._connect()) as conn, conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS chat_tenants ("
+                    "chat_id TEXT PRIMARY KEY, shop TEXT NOT NULL, "
+                    "bound_at TEXT DEFAULT CURRENT_TIMESTAMP) WITHOUT ROWID"
+                )
+    
+    def __iter__(self):
+        return iter(self.tenants.values())
+    
+    def __len__(self):
+        return len(self.tenants)
+    
+    def _connect(self):
+        return sqlite3.connect(self.bindings_path, timeout=10)
+    
+    # =============== ПРИВЯЗКИ ЧАТОВ ===============
+    
+    def _bound(self, chat_id):
+        with self.lock:
+            if chat_id in self.bindings:
+                return self.bindings[chat_id]
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT shop FROM chat_tenants WHERE chat_id = ?", (chat_id,)).fetchone()
+        self._remember(chat_id, row[0] if row else None)
+        return row[0] if row else None
+    
+    def _remember(self, chat_id, slug):
+        with self.lock:
+            if len(self.bindings) >= BINDING_CACHE_SIZE:
+                self.bindings.clear()
+            self.bindings[chat_id] = slug
+    
+    def bind(self, chat_id, slug):
+        """Закрепляет чат за точкой (переход по deep-link точки)."""
+        chat_id = str(chat_id)
+        if self._bound(chat_id) == slug:
+            return
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT INTO chat_tenants (chat_id, shop) VALUES (?, ?) "
+                "ON CONFLICT (chat_id) DO UPDATE SET shop = excluded.shop, bound_at = CURRENT_TIMESTAMP",
+                (chat_id, slug)
+            )
+        self._remember(chat_id, slug)
+        logger.info(f"Чат {chat_id} привязан к точке {slug}")
+    
+    # =============== МАРШРУТИЗАЦИЯ ===============
+    
+    def route(self, update):
+        """Точка для сообщения, нажатия или inline-запроса (или None)."""
+        if len(self.tenants) == 1:
+            return self.default
+        
+        message = getattr(update, 'message', None) if hasattr(update, 'data') else update
+        chat = getattr(message, 'chat', None)
+        user = getattr(update, 'from_user', None)
+        chat_id = str(chat.id) if chat is not None else str(user.id) if user is not None else None
+        if chat_id is None:
+            return None
+        
+        tenant = self.by_admin_chat.get(chat_id)
+        if tenant is not None:
+            return tenant
+        slug, _ = start_payload(getattr(update, 'text', None))
+        if slug in self.tenants:
+            self.bind(chat_id, slug)
+            return self.tenants[slug]
+        return self.tenants.get(self._bound(chat_id), self.default)
+    
+    def get(self):
+        """Точка текущего обновления."""
+        tenant = current.get()
+        if tenant is not None:
+            return tenant
+        if len(self.tenants) == 1:
+            return self.default
+        raise LookupError("Обращение к данным точки вне обработки обновления")
+    
+    # =============== СВОДКА ПО ТОЧКАМ ===============
+    
+    def report(self):
+        """Сводка по всем точкам одним запросом через ATTACH их файлов (только чтение)."""
+        tenants = list(self.tenants.values())
+        rows = []
+        for i in range(0, len(tenants), MAX_ATTACHED):
+            chunk = tenants[i:i + MAX_ATTACHED]
+            with closing(sqlite3.connect(":memory:", uri=True)) as conn:
+                for n, t in enumerate(chunk):
+                    uri = f"file:{urllib.parse.quote(os.path.abspath(t.db.db_path))}?mode=ro"
+                    conn.execute(f"ATTACH DATABASE ? AS s{n}", (uri,))
+                cur = conn.execute(
+                    " UNION ALL ".join(REPORT.format(s=f"s{n}") for n in range(len(chunk))),
+                    [t.slug for t in chunk]
+                )
+                rows.extend(cur.fetchall())
+        return rows
+
+
+class Current:
+    """Прокси на атрибут точки текущего обновления: Current(registry, 'db').get_user(...)."""
+    
+    def __init__(self, registry, attr):
+        self._registry = registry
+        self._attr = attr
+    
+    def __getattr__(self, name):
+        return getattr(getattr(self._registry.get(), self._attr), name)
+
+
+def run_in(tenant, func, *args, **kwargs):
+    """Вызывает func в контексте точки tenant."""
+    token = current.set(tenant)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        current.reset(token)
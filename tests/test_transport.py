@@ -0,0 +1,41 @@
+# tests/test_transport.py
+# coding: utf-8
+import threading
+from types import SimpleNamespace
+from concurrent.futures import wait
+
+from transport import TelegramTransport
+
+URL = "https://api.telegram.org/bot0:test/sendMessage"
+
+
+def test_fallback_send_does_not_deadlock_pool():
+    """Каждая задача submit() в один чат: первая отправка падает, запасная уходит следом."""
+    transport = TelegramTransport(max_in_flight=2)
+    sent = []
+    submitted = threading.Event()
+    
+    def fake_request(method, url, params=None, **kwargs):
+        sent.append(params['text'])
+        if not params['text'].startswith("fallback"):
+            raise ConnectionError("send failed")
+        return SimpleNamespace(status_code=200)
+    
+    transport.session.request = fake_request
+    
+    def safe_send(text):
+        # Как bot.safe_send_message: при ошибке — второе сообщение в тот же чат
+        submitted.wait()  # Все номера очереди уже выданы
+        try:
+            return transport.request('post', URL, params={'chat_id': 1, 'text': text})
+        except ConnectionError:
+            return transport.request('post', URL, params={'chat_id': 1, 'text': f"fallback {text}"})
+    
+    tasks = 2 * 2  # Вдвое больше, чем исполнителей
+    futures = [transport.submit(1, safe_send, str(i)) for i in range(tasks)]
+    submitted.set()
+    done, not_done = wait(futures, timeout=5)
+    assert not not_done, "пул исполнителей встал"
+    assert sent == [text for i in range(tasks) for text in (str(i), f"fallback {i}")]
+    assert transport.turns == {}
+    transport.close()
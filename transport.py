@@ -0,0 +1,175 @@
+# transport.py
+# coding: utf-8
+"""HTTP-транспорт запросов к Telegram Bot API для TeleBot.
+
+Вместо сессии requests на каждый поток telebot — одна сессия с пулом
+keep-alive соединений на все потоки (обработчики, рассылка, админский пул,
+таймеры правок):
+- одновременно в полёте не больше max_in_flight запросов;
+- запросы в один чат уходят строго по очереди — в порядке, в котором их
+  поставили, так что сообщения не перемешиваются;
+- 429 Too Many Requests повторяется после retry_after (очередь чата ждёт),
+  а пауза сообщается подписчикам on_retry_after() — например, ограничителю
+  рассылки, чтобы остальные её потоки тоже остановились.
+
+submit() отправляет запрос в фоне, не дожидаясь ответа: несколько сообщений
+в разные чаты идут параллельно по разным соединениям пула.
+"""
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from telebot import apihelper
+
+logger = logging.getLogger(__name__)
+
+LONG_POLL = "/getUpdates"  # Висит до timeout секунд — слот пула ему не нужен
+
+
+class _Turns:
+    """Очередь запросов одного чата: выданные номера и номер, чья очередь."""
+    __slots__ = ('next', 'serving', 'done')
+    
+    def __init__(self):
+        self.next = 0
+        self.serving = 0
+        self.done = set()  # Завершённые номера, до которых очередь ещё не дошла
+
+
+class TelegramTransport:
+    """Общий пул соединений к API с ограничением параллелизма и порядком по чатам."""
+    
+    def __init__(self, max_in_flight=8, max_retries=3, connect_retries=2):
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        # +1 соединение под long polling; max_retries — только ошибки соединения,
+        # POST после отправки не повторяется (иначе возможен дубль сообщения)
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=max_in_flight + 1, max_retries=connect_retries
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.executor = ThreadPoolExecutor(max_in_flight, thread_name_prefix="tg-api")
+        self.turns = {}  # {chat_id: _Turns}, только чаты с запросами в очереди
+        self.cond = threading.Condition()
+        self.local = threading.local()  # Номер в очереди, занятый submit()
+        self.retry_listeners = []       # func(секунды) на каждый 429
+    
+    def on_retry_after(self, func):
+        """func(seconds) вызывается при каждом 429 до паузы перед повтором."""
+        self.retry_listeners.append(func)
+    
+    def install(self):
+        """Все запросы TeleBot (apihelper) идут через этот транспорт."""
+        apihelper.CUSTOM_REQUEST_SENDER = self.request
+    
+    # =============== ОЧЕРЕДЬ ЧАТА ===============
+    
+    def _take(self, chat_id):
+        with self.cond:
+            turns = self.turns.get(chat_id)
+            if turns is None:
+                turns = self.turns[chat_id] = _Turns()
+            turns.next += 1
+            return turns.next - 1
+    
+    def _wait(self, chat_id, ticket):
+        with self.cond:
+            self.cond.wait_for(lambda: self.turns[chat_id].serving == ticket)
+    
+    def _release(self, chat_id, ticket):
+        with self.cond:
+            turns = self.turns[chat_id]
+            turns.done.add(ticket)
+            while turns.serving in turns.done:
+                turns.done.remove(turns.serving)
+                turns.serving += 1
+            if turns.serving == turns.next:
+                del self.turns[chat_id]
+            self.cond.notify_all()
+    
+    # =============== ЗАПРОСЫ ===============
+    
+    def request(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        """CUSTOM_REQUEST_SENDER для apihelper: возвращает requests.Response."""
+        chat_id = str(params['chat_id']) if params and 'chat_id' in params else None
+        if chat_id is None:
+            return self._send(method, url, params, files, timeout, proxies)
+        
+        reserved = getattr(self.local, 'reserved', None)
+        if reserved is not None and reserved[0] == chat_id:
+            # Все запросы func из submit() в этот чат идут под его номером:
+            # повтор после ошибки (запасное сообщение safe_send_message) не
+            # встаёт в хвост за задачами, которые ещё ждут исполнителя
+            self._wait(chat_id, reserved[1])
+            return self._send(method, url, params, files, timeout, proxies)
+        
+        ticket = self._take(chat_id)
+        try:
+            self._wait(chat_id, ticket)
+            return self._send(method, url, params, files, timeout, proxies)
+        finally:
+            self._release(chat_id, ticket)
+    
+    def _send(self, method, url, params, files, timeout, proxies):
+        if url.endswith(LONG_POLL):
+            return self.session.request(method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+        
+        for attempt in range(self.max_retries + 1):
+            with self.slots:
+                response = self.session.request(
+                    method, url, params=params, files=files, timeout=timeout, proxies=proxies
+                )
+            if response.status_code != 429 or attempt == self.max_retries:
+                return response
+            # Остальные запросы этого чата ждут в очереди, другие чаты — нет
+            delay = retry_after(response)
+            logger.warning(f"Telegram API: 429, повтор через {delay} сек")
+            for listener in self.retry_listeners:
+                listener(delay)
+            time.sleep(delay)
+        return response
+    
+    def submit(self, chat_id, func, *args, **kwargs):
+        """Выполняет func(*args, **kwargs) (вызов bot.*) в фоне. Возвращает Future.
+        
+        Место в очереди chat_id занимается сразу: запросы в этот чат уйдут в
+        порядке вызовов submit(), даже если исполнители стартуют в другом.
+        Номер держится до конца func, и все её запросы в chat_id идут под ним.
+        Исполнитель ждёт только номера, выданные раньше, — их задачи уже
+        запущены (пул берёт задачи по порядку), поэтому пул не встаёт.
+        """
+        chat_id = str(chat_id)
+        ticket = self._take(chat_id)
+        
+        def run():
+            self.local.reserved = (chat_id, ticket)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.local.reserved = None
+                self._release(chat_id, ticket)
+        
+        try:
+            return self.executor.submit(run)
+        except RuntimeError:
+            # Транспорт закрыт (close()): run не выполнится — номер освобождается здесь,
+            # иначе следующие запросы в этот чат ждали бы его вечно
+            self._release(chat_id, ticket)
+            raise
+    
+    def close(self):
+        """Дожидается запросов, поставленных submit(); новые больше не принимаются."""
+        self.executor.shutdown(wait=True)
+
+
+def retry_after(response):
+    """Секунды ожидания из ответа 429 (parameters.retry_after)."""
+    try:
+        return response.json().get('parameters', {}).get('retry_after', 1)
+    except ValueError:
+        return 1